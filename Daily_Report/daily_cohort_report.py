@@ -1,34 +1,17 @@
-import pandas as pd
-import pandahouse as ph
-import seaborn as sns
-import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import ttest_ind
-from scipy import stats
 from datetime import datetime, timedelta
 from airflow.decorators import dag, task
+from airflow.models.param import Param
+
+from common.queries import (as_date, feed_per_user_query, feed_segments_query, log_query_stats, mess_per_user_query,
+                            preaggregates_enabled)
+from common.instrumentation import instrumented
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
-# Параметры для подключения к базе CH с данными для выгрузки
-connection = {
-    'host': 'https://clickhouse.lab.karpov.courses',
-    'database':'simulator_20230220',
-    'user':os.environ.get("DB_LOGIN"),
-    'password':os.environ.get("DB_PASS")
-}
-
-
-# Параметры для подключения к базе CH куда выгружаются готовые отчеты
-connection_test = {
-    'host': 'https://clickhouse.lab.karpov.courses',
-    'database':'test',
-    'user':os.environ.get("test_DB_LOGIN"),
-    'password':os.environ.get("test_DB_PASS")
-
-}
+# Планировщик перечитывает этот файл на каждом цикле, поэтому на верхнем уровне импортируется только Airflow.
+# pandas, клиент ClickHouse и сборка отчета импортируются внутри тасков, которым они нужны
 
 
 # Дефолтные параметры для dag, которые прокидываются в таски
@@ -41,144 +24,216 @@ default_args = {
 }
 
 
-# Интервал запуска DAG
+# Интервал запуска DAG. Отчет строится за логический день запуска (ds): запуск в 23:00 дня D
+# обрабатывает день D - 1
 schedule_interval = '0 23 * * *'  # каждый день в 23:00
 
 
+# Срезы отчета. Новый срез (например country, source или city) достаточно добавить в этот список:
+# он попадет в выгрузки и в общий проход transform_cube без отдельной группировки
+report_dimensions = ['gender', 'os', 'age']
+
+
+# Таблица отчета в схеме test и параметры загрузки: размер блока вставки и число параллельных вставок
+report_table = 'kozhevatov_dag'
+load_block_size = 100000
+load_parallel = 4
+
+
+# Потоковый режим: если больше 0, поюзерные данные читаются этим количеством частей по хешу user_id
+# и сворачиваются по частям - память воркера не растет вместе с DAU
+stream_chunks = 0
+
+
+# Глубина треугольника retention: удержание когорты считается на дни 0..retention_days от первого появления
+retention_days = 30
+
+
 @dag(default_args = default_args, schedule_interval = schedule_interval, catchup = False)
 def dag_kozhevatov ():
         
     @task
-    # Таск выгружает в DataFrame кол-во лайков и просмотров для каждого юзера за вчерашний день
-    def extract_feed ():
-        query_feed = '''SELECT 
-                            user_id, os, gender, age, toDate(time) as event_date,
-                            CountIf(action = 'like') as likes, 
-                            CountIf(action = 'view') as views
-                        FROM {db}.feed_actions
-                        WHERE toDate(time) = today() - 1
-                        GROUP BY user_id, os, gender, age, event_date'''
-        df_feed = ph.read_clickhouse(query = query_feed, connection=connection)
+    # Таск выгружает в DataFrame кол-во лайков и просмотров для каждого юзера за отчетный день
+    @instrumented
+    def extract_feed (ds = None):
+        from common import clickhouse as ch
+        from common import schemas
+        from common.clickhouse import connection
+        query_feed = feed_per_user_query(ds, report_dimensions)
+        log_query_stats('extract_feed', query_feed, connection)
+        df_feed = ch.read_clickhouse(query = query_feed, connection=connection,
+                                     schema = schemas.with_dimensions(schemas.feed_per_user, report_dimensions))
         return df_feed
     
         
     @task
-    # Таск выгружает в DataFrame кол-во отпр/получ. сообщений и кол-во человек кому каждый юзер отправил сообщ.
-    # и кол-во человек от кого этот юзер получил сообщения за вчерашний день.
-    def extract_mess ():
-        query_mess = '''
-            WITH 
-            users AS (
-                SELECT distinct user_id as user_id, os, gender, age
-                FROM simulator_20230220.message_actions),
-            
-            recieve AS (
-                SELECT  reciever_id, count(reciever_id) as messages_received, 
-                        count(distinct user_id) as users_received
-                FROM simulator_20230220.message_actions
-                WHERE toDate(time) = today() - 1
-                GROUP BY reciever_id),
-            
-            sent AS (
-                SELECT user_id, count(user_id) messages_sent, 
-                       count(distinct reciever_id) users_sent, 
-                       toDate(time) event_date
-                FROM simulator_20230220.message_actions
-                WHERE toDate(time) = today() - 1
-                GROUP BY user_id, event_date)
-            
-            SELECT * FROM 
-                 (SELECT * FROM users
-                 FULL outer join sent
-                 on sent.user_id = users.user_id) A
-            FULL outer join recieve
-            on A.user_id = recieve.reciever_id
-            WHERE event_date = today() - 1 '''
+    # Таск (при USE_PREAGGREGATES=1) берет лайки и просмотры сразу по срезам из предагрегата test.kozhevatov_feed_daily
+    # (common/migrations.py) - поюзерная выгрузка ленты не нужна. Пока миграция не в статусе ready,
+    # поюзерная выгрузка ленты сворачивается до того же зерна (срезы, день)
+    @instrumented
+    def extract_feed_segments (ds = None):
+        from common import clickhouse as ch
+        from common import schemas
+        from common.clickhouse import connection, connection_test
+        from common.cube import partial_cube
+        from common.migrations import Migrations
+        if not Migrations().ready(['kozhevatov_feed_daily']):
+            query_feed = feed_per_user_query(ds, report_dimensions)
+            log_query_stats('extract_feed_segments', query_feed, connection)
+            df_feed = ch.read_clickhouse(query = query_feed, connection = connection,
+                                         schema = schemas.with_dimensions(schemas.feed_per_user, report_dimensions))
+            return partial_cube(df_feed, report_dimensions, ['likes', 'views'])
+        query_feed = feed_segments_query(ds, report_dimensions)
+        log_query_stats('extract_feed_segments', query_feed, connection_test)
+        return ch.read_clickhouse(query = query_feed, connection = connection_test,
+                                  schema = schemas.with_dimensions(schemas.feed_segments, report_dimensions))
+    
         
-        df_mess = ph.read_clickhouse(query = query_mess, connection=connection)
+    @task
+    # Таск выгружает в DataFrame кол-во отпр/получ. сообщений и кол-во человек кому каждый юзер отправил сообщ.
+    # и кол-во человек от кого этот юзер получил сообщения за отчетный день.
+    @instrumented
+    def extract_mess (ds = None):
+        from common import clickhouse as ch
+        from common import schemas
+        from common.clickhouse import connection
+        query_mess = mess_per_user_query(ds, report_dimensions)
+        log_query_stats('extract_mess', query_mess, connection)
+        df_mess = ch.read_clickhouse(query = query_mess, connection=connection,
+                                     schema = schemas.with_dimensions(schemas.mess_per_user, report_dimensions))
         return df_mess
     
         
     @task
     # Таск объединяет данные тасков extract_feed и extract_mes
+    @instrumented
     def join_extracts (df_feed, df_mess):        
-        merged_data = df_feed.merge(df_mess, how='outer', on= ['user_id', 'os', 'gender', 'age', 'event_date'])
+        from common.cube import join_per_user
+        merged_data = join_per_user(df_feed, df_mess, report_dimensions)
         return merged_data
     
     
     @task
-    # Таск суммирует информацию в разрезе возраста   
-    def transform_age (merged_data):
-        age_report = merged_data.drop(columns=['gender', 'os','user_id','reciever_id'], axis = 1) \
-            .groupby(['age', 'event_date'], as_index=False) \
-            .sum() \
-            .rename(columns = {'age':'dimension_value'})
-        age_report.insert(0, 'dimension', 'age')
-        return age_report
-
-           
-    @task
-    # Таск суммирует информацию в разрезе пола   
-    def transform_gender (merged_data):
-        gender_report = merged_data.drop(columns=['age', 'os','user_id','reciever_id'], axis = 1) \
-            .groupby(['gender', 'event_date'], as_index=False) \
-            .sum() \
-            .rename(columns = {'gender':'dimension_value'})
-        gender_report.insert(0, 'dimension', 'gender')
-        return gender_report
-
-    @task
-    # Таск суммирует информацию в разрезе ОС   
-    def transform_os (merged_data):
-        os_report = merged_data.drop(columns=['age', 'gender','user_id','reciever_id'], axis = 1) \
-            .groupby(['os', 'event_date'], as_index=False) \
-            .sum() \
-            .rename(columns = {'os':'dimension_value'})
-        os_report.insert(0, 'dimension', 'os')
-        return os_report
+    # Таск за один проход по поюзерным данным собирает все срезы из report_dimensions
+    # и объединяет их в один Датафрейм
+    @instrumented
+    def transform_cube (merged_data):
+        from common.cube import build_cube, format_report
+        concat_reports = format_report(build_cube(merged_data, report_dimensions))
+        return concat_reports 
+    
     
     @task
-    # Таск объединяет информацию в различных разрезах в один Датафрейм
-    def join_transforms (gender_report, os_report, age_report):
-        concat_reports = pd.concat([gender_report, os_report, age_report], axis=0)
-        cols = ['views', 'likes','messages_received', 'messages_sent','users_received', 'users_sent']
-        concat_reports[cols] = concat_reports[cols].astype(int)
-        concat_reports= concat_reports[['event_date','dimension','dimension_value','views','likes','messages_received','messages_sent','users_received','users_sent']]
-
-        return concat_reports 
+    # Таск в потоковом режиме выгружает и сворачивает поюзерные данные по частям,
+    # результат совпадает с extract_* -> join_extracts -> transform_cube
+    @instrumented
+    def transform_cube_streaming (ds = None):
+        from common.cube import format_report
+        from common.streaming import stream_cube
+        concat_reports = format_report(stream_cube(ds, report_dimensions, stream_chunks))
+        return concat_reports
         
         
     @task
-    # Таск вносит объединенные данные в таблицу kozhevatov_dag схемы данных test
-    def load (concat_reports):
-        query = '''  CREATE TABLE if not exists test.kozhevatov_dag
-                                             (event_date date,
-                                              dimension String,
-                                              dimension_value String,
-                                              views Int32,
-                                              likes Int32,
-                                              messages_received Int32,
-                                              messages_sent Int32,
-                                              users_received Int32,
-                                              users_sent Int32) 
-                                              ENGINE = MergeTree()
-                                              ORDER BY event_date''' 
+    # Таск собирает срезы из ленты по срезам и поюзерных данных мессенджера
+    @instrumented
+    def transform_segments (feed_segments, df_mess):
+        from common.cube import build_cube_from_segments, format_report
+        concat_reports = format_report(build_cube_from_segments(feed_segments, df_mess, report_dimensions))
+        return concat_reports
+        
         
-        ph.execute(query, connection=connection_test)
-                   
-                   
-        # Выгрузка датафрейма в базу данных test Clickhouse
-        ph.to_clickhouse(concat_reports, 'kozhevatov_dag', connection=connection_test, index=False)
+    @task
+    # Таск вносит объединенные данные в таблицу kozhevatov_dag схемы данных test: партиция каждого дня
+    # отчета заменяется целиком, поэтому ретрай или перезапуск не создает дублей (пустой день удаляет партицию)
+    @instrumented
+    def load (concat_reports, ds = None):
+        from common.loader import ReportLoader
+        ReportLoader(report_table, block_size = load_block_size, parallel = load_parallel).load(concat_reports,
+                                                                                                days = [ds])
+
+
+    @task
+    # Таск дописывает битмапы пользователей за день и новую диагональ треугольника retention по когортам
+    # (test.kozhevatov_retention). Новые пользователи дня берутся из индекса первого появления: его обновляет
+    # daily_APP_report, а если тот запуск пропущен или опаздывает, индекс дописывается здесь же перед загрузкой
+    @instrumented
+    def update_retention (ds = None):
+        from common.retention import RetentionEngine
+        RetentionEngine(report_dimensions, max_days = retention_days).update(ds)
 
 
     
-    df_feed = extract_feed()
-    df_mes = extract_mess()
-    merged_data = join_extracts(df_feed, df_mes)
-    gender_report = transform_gender(merged_data)
-    os_report = transform_os(merged_data) 
-    age_report = transform_age(merged_data)
-    concat_reports = join_transforms(gender_report, os_report, age_report)
+    if stream_chunks:
+        concat_reports = transform_cube_streaming()
+    elif preaggregates_enabled:
+        concat_reports = transform_segments(extract_feed_segments(), extract_mess())
+    else:
+        df_feed = extract_feed()
+        df_mes = extract_mess()
+        merged_data = join_extracts(df_feed, df_mes)
+        concat_reports = transform_cube(merged_data)
     load(concat_reports)
+    update_retention()
     
 dag_kozhevatov_test = dag_kozhevatov()
+
+
+# Перерасчет отчета за диапазон дней (включительно) одним проходом по источнику.
+# Запуск: airflow dags trigger dag_kozhevatov_backfill --conf '{"start": "2023-03-01", "end": "2023-03-30"}'
+@dag(default_args = default_args, schedule_interval = None, catchup = False,
+     params = {'start': Param('2023-03-20', type = 'string', format = 'date'),
+               'end': Param('2023-03-20', type = 'string', format = 'date')})
+def dag_kozhevatov_backfill ():
+    
+    @task
+    # Таск возвращает список дней диапазона - по нему раскладываются маппированные таски
+    @instrumented
+    def backfill_days (params = None):
+        start, end = as_date(params['start']), as_date(params['end'])
+        return [str(start + timedelta(days = i)) for i in range((end - start).days + 1)]
+    
+    
+    @task
+    # Таск выгружает поюзерные данные сразу за весь диапазон (строки по каждому event_date), объединяет их
+    # и сворачивает до зерна (срезы, день): маппированным таскам передается маленькая таблица, а не поюзерные данные
+    @instrumented
+    def extract_range (params = None):
+        from common import clickhouse as ch
+        from common import schemas
+        from common.clickhouse import connection
+        from common.cube import join_per_user, partial_cube
+        start, end = as_date(params['start']), as_date(params['end'])
+        days = (end - start).days + 1
+        df_feed = ch.read_clickhouse(query = feed_per_user_query(start, report_dimensions, days = days), connection=connection,
+                                     schema = schemas.with_dimensions(schemas.feed_per_user, report_dimensions))
+        df_mess = ch.read_clickhouse(query = mess_per_user_query(start, report_dimensions, days = days), connection=connection,
+                                     schema = schemas.with_dimensions(schemas.mess_per_user, report_dimensions))
+        return partial_cube(join_per_user(df_feed, df_mess, report_dimensions), report_dimensions)
+    
+    
+    @task
+    # Таск создает таблицу отчета и переносит ее из старого формата до запуска маппированных тасков:
+    # параллельные загрузки дней не должны одновременно запускать перенос (EXCHANGE TABLES)
+    @instrumented
+    def prepare_table ():
+        from common.loader import ReportLoader
+        ReportLoader(report_table).ensure_table()
+    
+    
+    @task
+    # Маппированный таск: срезы за один день из свернутой таблицы и замена партиции этого дня в таблице отчета
+    @instrumented
+    def transform_load_day (partial, day):
+        from common.cube import format_report, rollup_cube
+        from common.loader import ReportLoader
+        day_partial = partial[partial['event_date'] == as_date(day)]
+        concat_reports = format_report(rollup_cube(day_partial, report_dimensions))
+        return ReportLoader(report_table, block_size = load_block_size, parallel = load_parallel).load(concat_reports,
+                                                                                                       days = [day])
+    
+    
+    partial = extract_range()
+    prepare_table() >> transform_load_day.partial(partial = partial).expand(day = backfill_days())
+    
+dag_kozhevatov_backfill = dag_kozhevatov_backfill()
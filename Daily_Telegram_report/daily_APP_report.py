@@ -1,33 +1,37 @@
-import telegram
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import io
-import pandas as pd
-import pandahouse as ph
+import os
 from datetime import datetime, timedelta
 from airflow.decorators import dag, task
 
+from common.queries import days_ago, uniq_mode
+from common.instrumentation import instrumented
+
 import warnings
 warnings.filterwarnings("ignore")
 
 
+# Планировщик перечитывает этот файл на каждом цикле, поэтому на верхнем уровне импортируется только Airflow.
+# pandas, отправка в Телеграм и общие модули с выгрузками импортируются внутри тасков, которым они нужны
+
 
-# ТОКЕН для доступа к боту
-my_token = os.environ.get("TOKEN") 
-bot = telegram.Bot(token=my_token) # получаем доступ
+# Отправка в Телеграм (common/telegram_delivery.py) импортируется при отправке,
+# ТОКЕН для доступа к боту берется из окружения воркера
+def send(text=None, photos=()):
+    from common.telegram_delivery import deliver
+    return deliver(chat_id, text, photos)
 
-# id Чата
+# id Чата (или несколько через запятую - отчет уходит во все)
 chat_id = os.environ.get("CHAT_ID")
 
 
-# Параметры для подключения к базе CH с данными для выгрузки
-connection = {
-    'host': 'https://clickhouse.lab.karpov.courses',
-    'database':'simulator_20230220',
-    'user':os.environ.get("DB_LOGIN"),
-    'password':os.environ.get("DB_PASS")
-}
+# Хранилище дневных метрик (общее с daily_FEED_report)
+def get_metrics_store():
+    from common.metrics_store import DailyMetricsStore
+    return DailyMetricsStore()
+
+# Индекс первого появления пользователей
+def get_first_seen():
+    from common.first_seen import FirstSeenIndex
+    return FirstSeenIndex()
 
 
 # Дефолтные параметры для dag, которые прокидываются в таски
@@ -48,54 +52,46 @@ schedule_interval = '0 11 * * *'
 def dag_kozhevatov_7_2 ():
     
     @task
-    # Таск выгружает метрики приложения за прошлый день / этот день неделю назад / этот день месяц назад
-    def extract():
-        query = '''
-        SELECT * FROM 
-            (SELECT toDate(time) as day, 
-                    COUNT(distinct user_id) as dau, 
-                    CountIf(action = 'view') as views, CountIf(action = 'like') as likes,
-                    CountIf(action = 'like') / CountIf(action = 'view') as ctr
-            FROM simulator_20230220.feed_actions
-            WHERE day = today() - 1 or day = today() - 8  or day = today() - 29  
-            GROUP BY toDate(time)) t1
-        JOIN 
-            (SELECT toDate(time) as day , 
-                    count (user_id) as messages
-            FROM simulator_20230220.message_actions
-            WHERE day = today() - 1 or day = today() - 8  or day = today() - 29  
-            GROUP BY toDate(time)) t2
-        using day
-        order by day asc
-        '''
-    
-        data = ph.read_clickhouse(query = query, connection=connection)
+    # Таск выгружает метрики приложения за отчетный день / этот день неделю назад / этот день месяц назад
+    # Метрики берутся из хранилища дневных метрик, из сырых таблиц считаются только дни, которых там еще нет
+    @instrumented
+    def extract(ds = None):
+        data = get_metrics_store().get(days_ago(ds, 28, 7, 0))
+        # При UNIQ_MODE=approx добавляются уникальные за 7 дней и пик уникальных за скользящий час -
+        # слиянием сохраненных состояний uniqCombined, без чтения feed_actions
+        if uniq_mode == 'approx':
+            from common.sketches import UniqSketchStore
+            data = UniqSketchStore().with_report_uniques(data)
         return data
 
     @task
-    # Таск вычисляет кол-во новых (new Id) пользователей за вчера / тот же день неделю назад / тот же день месяц назад
-    def extract_new_users ():
-        query = '''
-            SELECT 
-                toDate(start_day) AS timestamp,
-                source,
-                count(DISTINCT user_id) AS cnt_dis
-            FROM
-              (SELECT DISTINCT ON (user_id) user_id,
-                                  toDate(time) AS start_day,
-                                  source
-               FROM simulator_20230220.feed_actions
-               order by start_day asc) AS virtual_table
-            GROUP BY source, timestamp
-            HAVING timestamp = today() - 7 or timestamp = today() - 1 or timestamp = today() - 28
-            '''
-
-        new_users = ph.read_clickhouse(query = query, connection=connection)
+    # Таск дописывает в индекс первого появления пользователей отчетного дня и пропущенных перед ним дней
+    # (пустой индекс пересобирается целиком)
+    @instrumented
+    def update_first_seen (ds = None):
+        return get_first_seen().update(ds)
+
+
+    @task
+    # Таск (только при UNIQ_MODE=approx) сохраняет состояния uniqCombined отчетного дня по бакетам и за день:
+    # DAU за любые диапазоны и скользящие окна потом считаются из них, без чтения feed_actions
+    @instrumented
+    def update_uniq_sketches (ds = None):
+        from common.sketches import UniqSketchStore
+        return UniqSketchStore().update(ds)
+
+
+    @task
+    # Таск вычисляет кол-во новых (new Id) пользователей за отчетный день / неделю назад / месяц назад по индексу
+    @instrumented
+    def extract_new_users (ds = None):
+        new_users = get_first_seen().new_users(days_ago(ds, 0, 6, 27))
         return new_users
 
 
     @task
     # Таск возвращает пользователей с Рекламного трафика в виде сортированного в хронологическом порядке DF с кол-вом new Id
+    @instrumented
     def new_users_transform_ads(new_users):
         new_users['days_ago'] = new_users.timestamp.apply(lambda x: new_users.timestamp.max() - x + timedelta(days = 1))
         new_users_ads = new_users[new_users.source == 'ads'].sort_values(by = 'days_ago')
@@ -104,6 +100,7 @@ def dag_kozhevatov_7_2 ():
     
     @task
     # Таск возвращает пользователей с Органического трафика в виде сортированного в хронологическом порядке DF с кол-вом new Id
+    @instrumented
     def new_users_transform_org(new_users):
         new_users['days_ago'] = new_users.timestamp.apply(lambda x: new_users.timestamp.max() - x + timedelta(days = 1))
         new_users_org = new_users[new_users.source == 'organic'].sort_values(by = 'days_ago')
@@ -111,10 +108,11 @@ def dag_kozhevatov_7_2 ():
     
     @task
     # Таск отправляет в ТГ сводку по кол-ву новых id в сравнении с неделей назад и месяцем назад
+    @instrumented
     def new_users_info_sender(new_users_org, new_users_ads):
         base = new_users_ads.iloc[0].cnt_dis 
         base1= new_users_org.iloc[0].cnt_dis
-        bot.sendMessage(chat_id=chat_id, text = 'Новые пользователи:'+ f'''
+        send(text = 'Новые пользователи:'+ f'''
 "Рекламные"
 {base}  |  {round((base -  int(new_users_ads.iloc[1].cnt_dis)) / new_users_ads.iloc[1].cnt_dis * 100, 2)}%   |   { round((base -int(new_users_ads.iloc[2].cnt_dis))/ new_users_ads.iloc[2].cnt_dis * 100,2)}%
     
@@ -125,8 +123,11 @@ def dag_kozhevatov_7_2 ():
     
     
     @task  
+    @instrumented
     def prepare(raw_data): 
-        raw_data = raw_data[['dau', 'views', 'likes', 'ctr', 'messages']]
+        import pandas as pd
+        raw_data = raw_data[['dau', 'views', 'likes', 'ctr', 'messages']
+                            + [column for column in ['wau', 'peak_hour_users'] if column in raw_data]]
         res_df = pd.DataFrame(index=raw_data.columns, data = {'prev_day': round(raw_data.iloc[-1],2), 
                                 "% vs_week_ago": round((raw_data.iloc[-1] - raw_data.iloc[1])/ raw_data.iloc[1] * 100, 2), 
                                 "% vs_month_ago":round((raw_data.iloc[-1] - raw_data.iloc[0])/ raw_data.iloc[0] * 100, 2)})
@@ -134,9 +135,21 @@ def dag_kozhevatov_7_2 ():
 
     
     
+    # Строки WAU и пика уникальных за скользящий час (есть только при UNIQ_MODE=approx)
+    def approx_uniques_text(df):
+        text = ''
+        for metric, title in [('wau', 'WAU (7 дней)'), ('peak_hour_users', 'Пик уникальных за час')]:
+            if metric in df.index:
+                text += f'''{title}: 
+{int(df.loc[metric][0]):,}   |   {df.loc[metric][1]:,}%   |   {df.loc[metric][2]:,}% 
+
+'''
+        return text
+    
     @task
+    @instrumented
     def sender (df):   
-        bot.sendMessage(chat_id=chat_id, 
+        send(
                     text = f'''
 Ключевые метрики за
 {df.columns.values[0]} в формате:
@@ -157,15 +170,18 @@ Messages sent:
 CTR: 
 {df.loc['ctr'][0]:,}   |   {df.loc['ctr'][1]:,}%   |  {df.loc['ctr'][2]:,}% 
 
-''')
+''' + approx_uniques_text(df))
     
     
     data = extract()
     df = prepare(data)
     sender(df)
     new_users = extract_new_users()
+    update_first_seen() >> new_users
     new_users_org = new_users_transform_org(new_users)
     new_users_ads = new_users_transform_ads(new_users)
     new_users_info_sender(new_users_org, new_users_ads)
+    if uniq_mode == 'approx':
+        update_uniq_sketches() >> data
 
 dag_kozhevatov_7_2 = dag_kozhevatov_7_2()
\ No newline at end of file
@@ -1,33 +1,32 @@
-import telegram
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import io
-import pandas as pd
-import pandahouse as ph
+import os
 from datetime import datetime, timedelta
 from airflow.decorators import dag, task
 
+from common.queries import days_ago
+from common.instrumentation import instrumented
+
 import warnings
 warnings.filterwarnings("ignore")
 
 
+# Планировщик перечитывает этот файл на каждом цикле, поэтому на верхнем уровне импортируется только Airflow.
+# графики, отправка в Телеграм и общие модули с выгрузками импортируются внутри тасков, которым они нужны
+
 
-# ТОКЕН для доступа к боту
-my_token = os.environ.get("TOKEN") 
-bot = telegram.Bot(token=my_token) # получаем доступ
+# Отправка в Телеграм (common/telegram_delivery.py) импортируется при отправке,
+# ТОКЕН для доступа к боту берется из окружения воркера
+def send(text=None, photos=()):
+    from common.telegram_delivery import deliver
+    return deliver(chat_id, text, photos)
 
-# id Чата
+# id Чата (или несколько через запятую - отчет уходит во все)
 chat_id = os.environ.get("CHAT_ID")
 
 
-# Параметры для подключения к базе CH с данными для выгрузки
-connection = {
-    'host': 'https://clickhouse.lab.karpov.courses',
-    'database':'simulator_20230220',
-    'user':os.environ.get("DB_LOGIN"),
-    'password':os.environ.get("DB_PASS")
-}
+# Хранилище дневных метрик (общее с daily_APP_report)
+def get_metrics_store():
+    from common.metrics_store import DailyMetricsStore
+    return DailyMetricsStore()
 
 
 # Дефолтные параметры для dag, которые прокидываются в таски
@@ -48,26 +47,18 @@ schedule_interval = '0 11 * * *'
 def dag_kozhevatov_7_1 ():
     
     @task
-    #  Таск выгружает необходимые метрики за последние 7 дней
-    def extract_feed():
-        query_week = '''
-        SELECT
-            toDate(time) as date,
-            count(DISTINCT user_id) as dau, 
-            CountIf(action = 'like') as likes, 
-            CountIf(action = 'view') as views,  
-            likes / views as ctr
-        FROM simulator_20230220.feed_actions
-        WHERE toDate(time) <= today() - 1 and toDate(time) > today() - 8
-        GROUP BY date
-        '''
-        
-        feed_data = ph.read_clickhouse(query = query_week, connection=connection)
+    #  Таск выгружает необходимые метрики за 7 дней, заканчивая отчетным днем.
+    #  Метрики берутся из хранилища дневных метрик, из сырых таблиц считаются только дни, которых там еще нет
+    @instrumented
+    def extract_feed(ds = None):
+        feed_data = get_metrics_store().get(days_ago(ds, *range(7))) \
+            .rename(columns = {'day': 'date'})[['date', 'dau', 'likes', 'views', 'ctr']]
         return feed_data
     
     
     @task
     #  Таск возвращает значения метрик за вчерашний день
+    @instrumented
     def transform(feed_data):
         date = feed_data.iloc[-1]['date']
         dau = feed_data.iloc[-1]['dau']
@@ -75,7 +66,7 @@ def dag_kozhevatov_7_1 ():
         views = feed_data.iloc[-1]['views']
         ctr = feed_data.iloc[-1]['ctr']
           
-        bot.sendMessage(chat_id=chat_id, 
+        send(
                         text = 
     f'''{date.day} {date.month_name()} {date.year}: 
     DAU = {dau:,}
@@ -88,41 +79,15 @@ def dag_kozhevatov_7_1 ():
     
     @task
     #  Таск отправляет графики по основным метрикам Просмотры/ Лайки/ CTR/ DAU
+    @instrumented
     def plot_builder (feed_data):
+        from common import charts
         
-        plt.figure(figsize=(15,15))
-        plt.subplots_adjust(hspace=0.3, wspace=0.3)
-           
-        plt.subplot(2,2,1)
-        plt.title('VIEWS')
-        sns.lineplot(data = feed_data, x ='date', y='views', markers=True)
-        plt.grid()
-        plt.xticks(rotation = 25)
-        
-        plt.subplot(2,2,2)
-        sns.lineplot(data = feed_data, x ='date', y='likes')
-        plt.title('LIKES')
-        plt.grid()
-        plt.xticks(rotation = 25)
-        
-        plt.subplot(2,2,3)
-        plt.title('CTR')
-        sns.lineplot(feed_data.date, feed_data.ctr)
-        plt.grid()
-        plt.xticks(rotation = 25)
-        
-        plt.subplot(2,2,4)
-        sns.lineplot(feed_data.date, feed_data.dau)
-        plt.title('DAU')
-        plt.grid()
-        plt.xticks(rotation = 25);
-        
-        plot_object = io.BytesIO()
-        plt.savefig(plot_object)
-        plot_object.seek(0)
-        plot_object.name = 'test_plot.png'
-        plt.close()
-        bot.sendPhoto(chat_id=chat_id, photo=plot_object)
+        # Сетка 2x2 рисуется шаблоном без pyplot, неизменившийся график берется из кеша
+        plot_object = charts.render('metrics_grid', cache = True, dates = feed_data['date'].to_numpy(),
+                                    panels = [(column.upper(), feed_data[column].to_numpy())
+                                              for column in ['views', 'likes', 'ctr', 'dau']])
+        send(photos = [plot_object])
     
 
     
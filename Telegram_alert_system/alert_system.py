@@ -1,28 +1,19 @@
-import sys
 import os
-import telegram
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import io
-import pandas as pd
-import pandahouse as ph
 from datetime import datetime, timedelta
 from airflow.decorators import dag, task
-from datetime import date
+from airflow.models import Variable
+
+from common.queries import alert_slices_query, preaggregates_enabled, uniq_mode
+from common.instrumentation import instrumented
 
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
-# Параметры для подключения к базе CH с данными для выгрузки
-connection = {
-    'host': 'https://clickhouse.lab.karpov.courses',
-    'database':'simulator_20230220',
-    'user':os.environ.get("DB_LOGIN"),
-    'password':os.environ.get("DB_PASS")
-}
+# Планировщик перечитывает этот файл каждые несколько секунд, а DAG запускается каждые 15 минут,
+# поэтому на верхнем уровне импортируется только Airflow. pandas, детектор, клиент ClickHouse,
+# графики и отправка в Телеграм импортируются внутри функций, которым они нужны
 
 
 # Дефолтные параметры для dag, которые прокидываются в таски
@@ -38,93 +29,187 @@ default_args = {
 # Интервал запуска DAG (Каждый день в 11:00)
 schedule_interval = '*/15 * * * *'
 
-    
-    # Таск hеализует алгоритм поиска аномалий -межквартильный рахмах
-def chack_anomaly(df, metric, a=3, n=5):
-    df['q25'] = df[metric].shift(1).rolling(n).quantile(0.25)
-    df['q75'] = df[metric].shift(1).rolling(n).quantile(0.75)
-    df['iqr'] = df['q75'] - df['q25'] 
-    df['up'] = df['q75'] + a*df['iqr']
-    df['low'] = df['q25'] - a*df['iqr']
-    
-    df['up'] = df['up'].rolling(n, center = True, min_periods=1).mean()
-    df['low'] = df['low'].rolling(n, center = True,  min_periods=1).mean()
-        
-    if df[metric].iloc[-1] < df['low'].iloc[-1] or df[metric].iloc[-1] > df['up'].iloc[-1]:
-        is_alert = 1
-    else: 
-        is_alert = 0
-        
-    set_to_return = (is_alert, df)
-    
-    return set_to_return
+
+# Настройки запросов алертов: проверка должна уложиться в интервал запуска и не забирать все ядра сервера
+alert_query_settings = {'max_threads': 4}
+alert_query_timeout = 120
+
+
+# Проверяемые метрики 15-минутных бакетов
+alert_metrics = ['users_feed', 'views', 'likes']
+
+
+# Детектор: 'rolling' - межквартильный размах по предыдущим n бакетам, 'seasonal' - полосы сезонного профиля
+# по (метрика, день недели, время суток), который строит dag_kozhevatov_8_1_baseline
+detector = 'rolling'
+baseline_weeks = 4
+
+
+def make_baseline():
+    if detector != 'seasonal':
+        return None
+    from common.baseline import SeasonalBaseline
+    return SeasonalBaseline(alert_metrics, weeks = baseline_weeks)
+
+
+# При UNIQ_MODE=approx users_feed бакетов берется из сохраненных состояний uniqCombined (common/sketches.py)
+def make_sketches():
+    if uniq_mode != 'approx':
+        return None
+    from common.sketches import UniqSketchStore
+    return UniqSketchStore()
+
+
+# Ключ Airflow Variable, в которой между запусками хранится состояние скользящего окна
+alert_state_key = 'kozhevatov_alert_state'
+
+# Загружает состояние детектора из прошлого запуска (None, если его нет). Пересборка устаревшего
+# или несовместимого состояния - в AlertEvaluator.refresh
+def load_alert_state():
+    from common.anomaly import IncrementalAnomalyState
+    return IncrementalAnomalyState.from_dict(Variable.get(alert_state_key, default_var=None, deserialize_json=True))
+
+
+def save_alert_state(state):
+    Variable.set(alert_state_key, state.to_dict(), serialize_json=True)
+
+
+# Срезы для поштучных алертов: название среза -> выражение ClickHouse для значения среза
+slice_dimensions = {
+    'os': 'os',
+    'source': 'source',
+    'country': 'country',
+    'age': "multiIf(age < 18, '0-17', age < 25, '18-24', age < 35, '25-34', age < 45, '35-44', age < 55, '45-54', '55+')",
+}
+
+# Сколько алертов по срезам попадает в одно сообщение
+slice_alerts_limit = 30
 
 
 @dag(default_args = default_args, schedule_interval = schedule_interval, catchup = False)
 def dag_kozhevatov_8_1():
     
     @task
-    def run_alerts(chat = None):
+    # Таск проверяет последний закрывшийся 15-минутный бакет. В инкрементальном режиме пересчитывается
+    # только хвост ряда из сохраненного состояния, иначе - весь ряд со вчерашнего дня
+    @instrumented
+    def run_alerts(chat = None, incremental = True):
+        from common.alert_evaluator import AlertEvaluator
+        from common.anomaly import chack_anomaly
+        
+        metrics_list = alert_metrics
+        evaluator = AlertEvaluator(metrics_list, chat_id = chat, settings = alert_query_settings,
+                                   timeout = alert_query_timeout, baseline = make_baseline(),
+                                   preaggregated = preaggregates_enabled, sketches = make_sketches())
+        
+        if incremental:
+            evaluator.state = load_alert_state()
+            evaluator.evaluate()
+            save_alert_state(evaluator.state)
+            return evaluator.state.frame
+        
+        data = evaluator.buckets()
+        if evaluator.baseline is not None:
+            checks = evaluator.baseline.load().check(data).items()
+        else:
+            checks = [(metric, chack_anomaly(data[['ts', 'date', 'hm', metric]].copy(), metric)) for metric in metrics_list]
+        evaluator.send([(metric, df) for metric, (is_alert, df) in checks if is_alert == 1])
+        return data
+    
+    
+    @task
+    # Таск проверяет последний бакет по всем срезам (метрика x os/source/country/age) одним
+    # векторизованным вызовом и отправляет одно сводное сообщение по сработавшим рядам
+    @instrumented
+    def run_slice_alerts(chat = None, a = 3, n = 5):
+        import pandas as pd
+        from common import clickhouse as ch
+        from common import schemas
+        from common.anomaly import batch_alerts, state_window
+        from common.clickhouse import connection
+        from common.telegram_delivery import deliver
+        
         chat_id = chat or os.environ.get("ALERT_CHAT_ID")
-        bot = telegram.Bot(token = os.environ.get("TOKEN"))
         
-        query = '''
-            SELECT toStartOfFifteenMinutes(time) as ts,
-                toDate(time) as date,
-                formatDateTime(ts, '%R') as hm,
-                uniqExact(user_id) as users_feed,
-                countIf(user_id, action = 'view') as views,
-                countIf(user_id, action = 'like') as likes
-            FROM simulator_20230220.feed_actions
-            WHERE time >= today() - 1 and time < toStartOfFifteenMinutes(now())
-            GROUP BY ts, date, hm
-            ORDER BY ts'''
+        metrics_list = alert_metrics
         
-        data = ph.read_clickhouse(query = query, connection = connection)
+        data = ch.read_clickhouse(query = alert_slices_query(slice_dimensions, state_window(n)), connection = connection,
+                                  settings = alert_query_settings, timeout = alert_query_timeout,
+                                  schema = schemas.alert_slices)
+        if data.empty:
+            return 0
         
-        metrics_list = ['users_feed', 'views', 'likes']
+        ts_grid = pd.date_range(end = data['ts'].max(), periods = state_window(n), freq = '15min')
+        report = batch_alerts(data, ['dimension', 'dimension_value'], metrics_list, a = a, n = n, ts_grid = ts_grid)
+        alerts = report[report.is_alert == 1]
         
-        for metric in metrics_list:
-            df = data[['ts', 'date', 'hm', metric]].copy()
-            is_alert, df = chack_anomaly(df, metric)
+        if not alerts.empty:
+            alerts = alerts.assign(deviation = (alerts.value / alerts.prev_value - 1).abs()) \
+                .sort_values('deviation', ascending = False)
+            lines = ['{metric} [{dimension} = {dimension_value}]: {value:.0f} (границы {low:.0f} - {up:.0f})'.format(**row)
+                     for row in alerts.head(slice_alerts_limit).to_dict(orient = 'records')]
+            msg = 'Аномалии по срезам на {ts:%H:%M}, всего {total}:\n'.format(ts = report.ts.iloc[0], total = len(alerts)) \
+                + '\n'.join(lines)
+            deliver(chat_id, msg)
         
-            if is_alert == 1: 
-                msg = '''Метрика {metric}:\nтекущее значение {current_val:.2f}\n
-отклонение от предыдущего значения {last_val_diff:.2%}'''.format(metric = metric, 
-                                                                 current_val = df[metric].iloc[-1], 
-                                                                 last_val_diff=abs(1-(df[metric].iloc[-1]/df[metric].iloc[-2])))
-            
-                sns.set(rc={'figure.figsize':(16, 10)})
-                plt.tight_layout()
-                
-                ax = sns.lineplot(x=df['ts'], y=df[metric], label = 'metric')
-                ax = sns.lineplot(x=df['ts'], y=df['up'], label = 'up')
-                ax = sns.lineplot(x=df['ts'], y=df['low'], label = 'low')
-                
-                for ind, label in enumerate(ax.get_xticklabels()):
-                    if ind % 2 == 0:
-                        label.set_visible(True)
-                    else: 
-                        label.set_visible(False)
-            
-                ax.set(xlabel = 'time')
-                ax.set(ylabel = metric)
-                
-                ax.set_title = (metric)
-                ax.set(ylim = (0,None))
-                
-                plot_object = io.BytesIO()
-                ax.figure.savefig(plot_object)            
-                plot_object.seek(0)
-                plot_object.name = '0.png'
-                plt.close()
-                
-                bot.sendMessage(chat_id = chat_id, text=msg)
-                bot.sendPhoto(chat_id=chat_id, photo=plot_object)            
-    
-        return data
+        return len(alerts)
 
 
 
     run_alerts()
-dag_kozhevatov_8_1 = dag_kozhevatov_8_1()
\ No newline at end of file
+    run_slice_alerts()
+dag_kozhevatov_8_1 = dag_kozhevatov_8_1()
+
+
+# "Теплый" режим: один долгоживущий таск в течение часа проверяет каждый бакет через warm_settle секунд
+# после его закрытия, не перезапуская процесс, клиент ClickHouse и лимиты отправки. Следующий запуск подхватывает
+# состояние из той же Variable. Включать вместо dag_kozhevatov_8_1 (тот нужно поставить на паузу)
+warm_schedule_interval = '0 * * * *'
+warm_settle = 30
+
+
+@dag(default_args = default_args, schedule_interval = warm_schedule_interval, catchup = False,
+     max_active_runs = 1, is_paused_upon_creation = True)
+def dag_kozhevatov_8_1_warm():
+    
+    @task(execution_timeout = timedelta(minutes = 75))
+    # Таск проверяет бакеты, закрывающиеся до конца часа запуска, сохраняя состояние после каждой проверки
+    @instrumented
+    def run_alerts_warm(chat = None, data_interval_end = None):
+        import time
+        from common.alert_evaluator import AlertEvaluator
+        
+        metrics_list = alert_metrics
+        evaluator = AlertEvaluator(metrics_list, chat_id = chat, state = load_alert_state(),
+                                   settings = alert_query_settings, timeout = alert_query_timeout,
+                                   baseline = make_baseline(), preaggregated = preaggregates_enabled,
+                                   sketches = make_sketches())
+        # Бакет, закрывающийся в конце часа, проверяется этим запуском (через warm_settle после закрытия);
+        # следующий запуск стартует после него (max_active_runs = 1) и начинает с бакета hh:15
+        until = (data_interval_end.timestamp() if data_interval_end else time.time()) + 3600 + warm_settle
+        try:
+            results = evaluator.run(until = until, settle = warm_settle,
+                                    on_evaluated = lambda evaluator, result: save_alert_state(evaluator.state))
+        finally:
+            evaluator.delivery.close()
+        return [round(result['latency_s'], 1) for result in results if not result['skipped']]
+    
+    
+    run_alerts_warm()
+dag_kozhevatov_8_1_warm = dag_kozhevatov_8_1_warm()
+
+
+# Сезонный профиль для detector = 'seasonal': каждую ночь пересчитывается по последним baseline_weeks неделям
+@dag(default_args = default_args, schedule_interval = '30 0 * * *', catchup = False)
+def dag_kozhevatov_8_1_baseline():
+    
+    @task
+    # Таск пересчитывает полосы по (метрика, день недели, время суток) по неделям, заканчивая отчетным днем
+    @instrumented
+    def build_baseline(ds = None):
+        from common.baseline import SeasonalBaseline
+        return SeasonalBaseline(alert_metrics, weeks = baseline_weeks).build(ds)
+    
+    
+    build_baseline()
+dag_kozhevatov_8_1_baseline = dag_kozhevatov_8_1_baseline()
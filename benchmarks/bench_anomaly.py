@@ -0,0 +1,95 @@
+# Бенчмарк векторизованного детектора аномалий против цикла по рядам с chack_anomaly.
+# Перед замерами проверяется, что batch_check_anomaly и IncrementalAnomalyState дают те же флаги, что chack_anomaly.
+# Запуск: python -m benchmarks.bench_anomaly --series 10000 --buckets 96
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from common.anomaly import IncrementalAnomalyState, batch_alerts, batch_check_anomaly, chack_anomaly
+
+
+# Синтетическая длинная выгрузка того же вида, что отдает query_slices
+def synthetic_slices(series, buckets, metrics, seed=0):
+    rng = np.random.default_rng(seed)
+    ts = pd.date_range('2023-03-23', periods=buckets, freq='15min')
+    per_metric = max(series // len(metrics), 1)
+    frame = pd.DataFrame({'ts': np.repeat(ts, per_metric),
+                          'dimension': 'slice',
+                          'dimension_value': np.tile(np.arange(per_metric).astype(str), buckets)})
+    for metric in metrics:
+        frame[metric] = rng.poisson(100, len(frame))
+    return frame
+
+
+# Флаги по последней точке каждого префикса ряда: chack_anomaly на префиксе, batch_check_anomaly
+# (полная история и last_only) и IncrementalAnomalyState, в который бакеты приходят по одному
+# с перечитыванием окна, как в AlertEvaluator.refresh
+def check_equivalence(values, a=3, n=5):
+    mismatches = 0
+    for row in values:
+        ts = pd.date_range('2023-03-23', periods=len(row), freq='15min')
+        frame = pd.DataFrame({'ts': ts, 'date': ts.normalize(), 'hm': ts.strftime('%H:%M'), 'm': row})
+        state = IncrementalAnomalyState(frame.iloc[:n], ['m'], a=a, n=n)
+        for end in range(n + 1, len(row) + 1):
+            expected, expected_df = chack_anomaly(frame.iloc[:end].copy(), 'm', a=a, n=n)
+            full = batch_check_anomaly(row[None, :end], a=a, n=n)
+            last = batch_check_anomaly(row[None, :end], a=a, n=n, last_only=True)
+            state.merge(frame.iloc[max(0, end - len(state.frame) - 1):end])
+            incremental = state.check()['m'][0]
+            flags = (int(full['is_alert'][0]), int(last['is_alert'][0]), incremental)
+            if flags != (expected,) * 3 or not np.allclose(full['up'][0], expected_df['up'], equal_nan=True) \
+                    or not np.allclose(full['low'][0], expected_df['low'], equal_nan=True):
+                mismatches += 1
+    return mismatches
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=10000)
+    parser.add_argument('--buckets', type=int, default=96)
+    parser.add_argument('--loop-sample', type=int, default=200)
+    parser.add_argument('--check-sample', type=int, default=50)
+    args = parser.parse_args()
+
+    metrics = ['users_feed', 'views', 'likes']
+    data = synthetic_slices(args.series, args.buckets, metrics)
+    values = np.random.default_rng(1).poisson(100, (args.series, args.buckets)).astype(float)
+
+    # Выбросы, чтобы в проверке были и срабатывания, а не только нули
+    checked = values[:min(args.check_sample, args.series)].copy()
+    spikes = np.random.default_rng(2).random(checked.shape) < 0.05
+    checked[spikes] *= 3
+    mismatches = check_equivalence(checked)
+    assert mismatches == 0, '{} prefix(es) differ from chack_anomaly'.format(mismatches)
+    print('equivalence with chack_anomaly: {} series x {} prefixes - ok'.format(len(checked), args.buckets - 5))
+
+    full = timed(batch_check_anomaly, values)
+    last = timed(batch_check_anomaly, values, last_only=True)
+    grouped = timed(batch_alerts, data, ['dimension', 'dimension_value'], metrics)
+
+    sample = min(args.loop_sample, args.series)
+    frames = [pd.DataFrame({'m': row}) for row in values[:sample]]
+    loop = timed(lambda: [chack_anomaly(df.copy(), 'm') for df in frames], repeat=1) * args.series / sample
+
+    print('series: {}, buckets: {}'.format(args.series, args.buckets))
+    print('loop chack_anomaly (extrapolated): {:8.3f} s'.format(loop))
+    print('batch, full history:               {:8.3f} s'.format(full))
+    print('batch, last bucket only:           {:8.3f} s'.format(last))
+    print('batch_alerts incl. pivot:          {:8.3f} s'.format(grouped))
+    print('budget (15-minute schedule):       {:8.3f} s'.format(15 * 60))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Бэктест детекторов на синтетическом месяце 15-минутных бакетов с суточной сезонностью и вставленными
+# инцидентами: сверка iqr-детектора с chack_anomaly, прогнанным по точкам как по последнему бакету,
+# и время перебора сеток всех детекторов последовательно и в пуле процессов.
+# Запуск: python -m benchmarks.bench_backtest --days 30 --processes 4
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from common.anomaly import chack_anomaly, state_window
+from common.backtest import buckets_per_day, iqr_detector, sweep
+
+
+def synthetic_history(days, metrics, incidents=12, seed=0):
+    rng = np.random.default_rng(seed)
+    ts = pd.date_range('2023-02-20', periods=days * buckets_per_day, freq='15min')
+    daily = 1 + 0.8 * np.sin(2 * np.pi * (np.arange(len(ts)) % buckets_per_day) / buckets_per_day - np.pi / 2)
+    values = np.vstack([rng.poisson(scale * daily + scale * 0.1) for scale in [500, 5000, 1000][:len(metrics)]])
+    rows = []
+    for _ in range(incidents):
+        start = rng.integers(buckets_per_day, len(ts) - 8)
+        length = rng.integers(1, 6)
+        metric = rng.integers(len(metrics))
+        values[metric, start:start + length] = values[metric, start:start + length] * rng.choice([0.3, 2.5])
+        rows.append({'start': ts[start], 'end': ts[start] + pd.Timedelta(minutes=15 * int(length)),
+                     'metric': metrics[metric]})
+    return ts, values.astype('float64'), pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--check-points', type=int, default=300)
+    args = parser.parse_args()
+
+    metrics = ['users_feed', 'views', 'likes']
+    ts, values, incidents = synthetic_history(args.days, metrics)
+
+    alerts = iqr_detector(values)
+    rng = np.random.default_rng(1)
+    points = rng.integers(state_window(5), values.shape[1], args.check_points)
+    mismatches = 0
+    for point in points:
+        frame = pd.DataFrame({'m': values[0, :point + 1]})
+        mismatches += chack_anomaly(frame, 'm')[0] != int(alerts[0, point])
+    print('iqr vs chack_anomaly: {} mismatches in {} points'.format(mismatches, len(points)))
+
+    print('{} days x {} metrics = {} buckets, {} incidents'.format(args.days, len(metrics), values.size, len(incidents)))
+    for processes in [1, args.processes]:
+        start = time.perf_counter()
+        report = sweep(ts, values, metrics, incidents, processes=processes)
+        print('sweep of {} parameter sets, {} process(es): {:.2f} s'.format(
+            len(report), processes, time.perf_counter() - start))
+    print(report.head(10).to_string())
+
+
+if __name__ == '__main__':
+    main()
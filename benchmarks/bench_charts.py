@@ -0,0 +1,121 @@
+# Время рендера графиков: прежний код (seaborn + глобальный pyplot, tight_layout, savefig) против
+# шаблонов common/charts.py - первый рендер, повторный рендер шаблона, повтор из кеша и пул процессов.
+# Запуск: python -m benchmarks.bench_charts --charts 10
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from common import charts
+
+
+def alert_frame(points=100, seed=0):
+    rng = np.random.default_rng(seed)
+    ts = pd.date_range('2023-03-20', periods=points, freq='15min')
+    values = 1000 + 200 * np.sin(np.arange(points) / 10) + rng.normal(0, 30, points)
+    return pd.DataFrame({'ts': ts, 'views': values, 'up': values + 150, 'low': values - 150})
+
+
+def feed_frame(days=7):
+    return pd.DataFrame({'date': pd.date_range('2023-03-14', periods=days, freq='D'),
+                         'views': np.arange(days) * 1000.0, 'likes': np.arange(days) * 200.0,
+                         'ctr': np.linspace(0.19, 0.21, days), 'dau': np.arange(days) * 100.0})
+
+
+# Прежний рендер алерта из run_alerts
+def seaborn_alert(metric, df):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    sns.set(rc={'figure.figsize': (16, 10)})
+    plt.tight_layout()
+    ax = sns.lineplot(x=df['ts'], y=df[metric], label='metric')
+    ax = sns.lineplot(x=df['ts'], y=df['up'], label='up')
+    ax = sns.lineplot(x=df['ts'], y=df['low'], label='low')
+    for ind, label in enumerate(ax.get_xticklabels()):
+        label.set_visible(ind % 2 == 0)
+    ax.set(xlabel='time', ylabel=metric, ylim=(0, None))
+    plot_object = io.BytesIO()
+    ax.figure.savefig(plot_object)
+    plot_object.seek(0)
+    plt.close()
+    return plot_object
+
+
+# Прежний рендер сетки 2x2 из daily_FEED_report.plot_builder
+def seaborn_grid(feed_data):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plt.figure(figsize=(15, 15))
+    plt.subplots_adjust(hspace=0.3, wspace=0.3)
+    for i, column in enumerate(['views', 'likes', 'ctr', 'dau']):
+        plt.subplot(2, 2, i + 1)
+        plt.title(column.upper())
+        sns.lineplot(data=feed_data, x='date', y=column)
+        plt.grid()
+        plt.xticks(rotation=25)
+    plot_object = io.BytesIO()
+    plt.savefig(plot_object)
+    plot_object.seek(0)
+    plt.close()
+    return plot_object
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--charts', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    charts.chart_cache_dir = os.environ['CHART_CACHE_DIR'] = tempfile.mkdtemp(prefix='charts_')
+    df, feed_data = alert_frame(), feed_frame()
+    grid = {'dates': feed_data['date'].to_numpy(),
+            'panels': [(column.upper(), feed_data[column].to_numpy()) for column in ['views', 'likes', 'ctr', 'dau']]}
+
+    rows = []
+    start = time.perf_counter()
+    charts.alert_chart('views', df)
+    rows.append(('alert: charts, first render', [time.perf_counter() - start]))
+    rows.append(('alert: seaborn + pyplot', timed(lambda: seaborn_alert('views', df), args.repeat)))
+    rows.append(('alert: charts template', timed(lambda: charts.alert_chart('views', df), args.repeat)))
+    rows.append(('grid: seaborn + pyplot', timed(lambda: seaborn_grid(feed_data), args.repeat)))
+    rows.append(('grid: charts template', timed(lambda: charts.render('metrics_grid', **grid), args.repeat)))
+    charts.render('metrics_grid', cache=True, **grid)
+    rows.append(('grid: charts cached', timed(lambda: charts.render('metrics_grid', cache=True, **grid), args.repeat)))
+
+    print('{:<32} {:>12} {:>12}'.format('per chart', 'median, ms', 'min, ms'))
+    for name, times in rows:
+        print('{:<32} {:>12.1f} {:>12.1f}'.format(name, statistics.median(times) * 1000, min(times) * 1000))
+
+    jobs = charts.alert_jobs([('views', alert_frame(seed=seed)) for seed in range(args.charts)])
+    print('\n{} alert charts'.format(args.charts))
+    for name, processes in [('sequential', 0), ('process pool x{}, cold'.format(args.processes), args.processes),
+                            ('process pool x{}, warm'.format(args.processes), args.processes)]:
+        start = time.perf_counter()
+        charts.render_many(jobs, processes=processes)
+        print('{:<32} {:>12.1f} ms'.format(name, (time.perf_counter() - start) * 1000))
+    charts.shutdown_pool()
+
+
+if __name__ == '__main__':
+    main()
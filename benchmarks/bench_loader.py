@@ -0,0 +1,63 @@
+# Пропускная способность загрузки отчета: ch.to_clickhouse (как раньше в load) против ReportLoader.
+# Нужен доступный сервер ClickHouse (CLICKHOUSE_HOST, учетные данные схемы test), таблицы создаются с префиксом bench_.
+# Запуск: python -m benchmarks.bench_loader --rows 1000000
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from common import clickhouse as ch
+from common.clickhouse import connection_test
+from common.loader import ReportLoader, report_table_columns
+
+
+def synthetic_report(rows, days=1, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2023-03-01', periods=days, freq='D')
+    return pd.DataFrame({
+        'event_date': rng.choice(dates, rows),
+        'dimension': rng.choice(['age', 'gender', 'os'], rows),
+        'dimension_value': rng.integers(0, 100, rows).astype(str),
+        'views': rng.integers(0, 10**6, rows).astype('int32'),
+        'likes': rng.integers(0, 10**5, rows).astype('int32'),
+        'messages_received': rng.integers(0, 10**4, rows).astype('int32'),
+        'messages_sent': rng.integers(0, 10**4, rows).astype('int32'),
+        'users_received': rng.integers(0, 10**3, rows).astype('int32'),
+        'users_sent': rng.integers(0, 10**3, rows).astype('int32'),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--block-size', type=int, default=100000)
+    parser.add_argument('--parallel', type=int, default=4)
+    args = parser.parse_args()
+
+    df = synthetic_report(args.rows, args.days)
+
+    ch.execute('DROP TABLE IF EXISTS {db}.bench_loader_old', connection=connection_test)
+    ch.execute('''CREATE TABLE {{db}}.bench_loader_old ({}) ENGINE = MergeTree() ORDER BY event_date'''
+               .format(report_table_columns), connection=connection_test)
+    start = time.perf_counter()
+    ch.to_clickhouse(df, 'bench_loader_old', connection=connection_test, index=False)
+    old = time.perf_counter() - start
+
+    ch.execute('DROP TABLE IF EXISTS {db}.bench_loader_new', connection=connection_test)
+    loader = ReportLoader('bench_loader_new', block_size=args.block_size, parallel=args.parallel)
+    new = loader.load(df)['seconds']
+    # повторная загрузка тех же дней заменяет партиции, строк не становится больше
+    loader.load(df)
+    count = ch.read_clickhouse('SELECT count() AS rows FROM {db}.bench_loader_new FINAL',
+                               connection=connection_test, format='tsv')['rows'].iloc[0]
+
+    print('rows: {}, days: {}'.format(args.rows, args.days))
+    print('to_clickhouse:  {:8.2f} s  {:>10.0f} rows/sec'.format(old, args.rows / old))
+    print('ReportLoader:   {:8.2f} s  {:>10.0f} rows/sec'.format(new, args.rows / new))
+    print('rows after a repeated load: {}'.format(count))
+
+
+if __name__ == '__main__':
+    main()
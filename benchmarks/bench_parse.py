@@ -0,0 +1,66 @@
+# Время разбора DAG-файлов планировщиком: каждый файл импортируется в отдельном чистом процессе,
+# отдельно замеряется импорт самого Airflow и импорт DAG-файла поверх него.
+# Кроме времени печатается, какие тяжелые библиотеки загрузил DAG-файл - после разбора их быть не должно.
+# Запуск: python -m benchmarks.bench_parse --repeat 5
+import argparse
+import importlib
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+dag_modules = [
+    'Daily_Report.daily_cohort_report',
+    'Daily_Telegram_report.daily_APP_report',
+    'Daily_Telegram_report.daily_FEED_report',
+    'Telegram_alert_system.alert_system',
+]
+
+heavy_modules = ['pandas', 'numpy', 'scipy', 'matplotlib', 'seaborn', 'telegram', 'httpx', 'pyarrow', 'pandahouse', 'requests']
+
+
+def run_child(module_name):
+    start = time.perf_counter()
+    # DAG-файлы берут Variable и Param из airflow.models, подмодули которого загружаются лениво:
+    # их импорт - часть Airflow, а не DAG-файла
+    for name in ('airflow.decorators', 'airflow.models.param', 'airflow.models.variable'):
+        importlib.import_module(name)
+    airflow_loaded = time.perf_counter()
+    before = {name for name in heavy_modules if name in sys.modules}
+    importlib.import_module(module_name)
+    end = time.perf_counter()
+    print(json.dumps({'airflow_s': airflow_loaded - start, 'dag_s': end - airflow_loaded,
+                      'heavy': sorted(name for name in heavy_modules if name in sys.modules and name not in before)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dags', nargs='*', default=dag_modules)
+    parser.add_argument('--child')
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return 0
+
+    failed = False
+    print('{:<42} {:>12} {:>12}  {}'.format('dag file', 'airflow, ms', 'dag, ms', 'heavy imports'))
+    for module_name in args.dags:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_parse', '--child', module_name],
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        heavy = sorted({name for run in runs for name in run['heavy']})
+        failed = failed or bool(heavy)
+        print('{:<42} {:>12.1f} {:>12.1f}  {}'.format(
+            module_name, statistics.median(run['airflow_s'] for run in runs) * 1000,
+            statistics.median(run['dag_s'] for run in runs) * 1000, ', '.join(heavy) or '-'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
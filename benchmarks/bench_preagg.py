@@ -0,0 +1,86 @@
+# Сырые таблицы против предагрегатов (common/migrations.py) на локальном clickhouse-server: синтетические события,
+# apply + backfill, затем по каждой выгрузке - прочитанные строки и байты (X-ClickHouse-Summary), время
+# и совпадение результата. Для выгрузки ленты отчета в разрезах поюзерный результат сворачивается до срезов
+# в том же запросе - так он сравним с предагрегатом, а число прочитанных строк не меняется.
+#   clickhouse server -- --http_port=8123 --path=/tmp/ch &
+#   CLICKHOUSE_HOST=http://localhost:8123 python -m benchmarks.bench_preagg --users 100000 --days 35
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+
+def run(query, connection):
+    from common import clickhouse as ch
+
+    start = time.perf_counter()
+    response = ch.get_client(connection).execute(query + ' FORMAT TabSeparated', settings={'wait_end_of_query': 1})
+    elapsed = time.perf_counter() - start
+    summary = json.loads(response.headers.get('X-ClickHouse-Summary') or '{}')
+    return {'read_rows': int(summary.get('read_rows', 0)), 'read_bytes': int(summary.get('read_bytes', 0)),
+            'seconds': elapsed, 'result': response.content}
+
+
+def cases(ds, dimensions):
+    from common.clickhouse import connection, connection_test
+    from common.queries import (alert_buckets_query, app_metrics_query, days_ago, feed_per_user_query,
+                                feed_segments_query, preaggregated_alert_buckets_query,
+                                preaggregated_app_metrics_query)
+
+    dims = ', '.join(dimensions)
+    return [
+        ('alert buckets (run_alerts)', (alert_buckets_query(), connection),
+         (preaggregated_alert_buckets_query(), connection_test)),
+        ('app metrics (extract / extract_feed)', (app_metrics_query(days_ago(ds, 28, 7, 0)), connection),
+         (preaggregated_app_metrics_query(days_ago(ds, 28, 7, 0)), connection_test)),
+        ('feed by segments (cohort extract_feed)',
+         ('SELECT {dims}, event_date, sum(likes), sum(views) FROM ({query}) GROUP BY {dims}, event_date '
+          'ORDER BY {dims}, event_date'.format(dims=dims, query=feed_per_user_query(ds, dimensions)), connection),
+         ('SELECT * FROM ({query}) ORDER BY {dims}, event_date'.format(dims=dims,
+                                                                      query=feed_segments_query(ds, dimensions)),
+          connection_test)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=35)
+    parser.add_argument('--events-per-user', type=float, default=20)
+    parser.add_argument('--skip-populate', action='store_true')
+    parser.add_argument('--ds', default=str(date.today() - timedelta(days=1)))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    os.environ.setdefault('CLICKHOUSE_HOST', 'http://localhost:8123')
+    # Синтетические таблицы источника - в отдельной базе simulator (по умолчанию клиент читает simulator_20230220)
+    os.environ.setdefault('CLICKHOUSE_DATABASE', 'simulator')
+
+    from common.clickhouse import connection, connection_test
+    from common.migrations import Migrations
+
+    if not args.skip_populate:
+        from benchmarks.synthetic import populate
+        print(populate(connection, connection_test, users=args.users, days=args.days,
+                       events_per_user=args.events_per_user))
+    # Источник больше не пишется, поэтому cutoff - сейчас по часам сервера: вся история заливается backfill
+    migrations = Migrations()
+    start = time.perf_counter()
+    migrations.reset(cutoff=migrations.server_time())
+    migrations.backfill(settle=timedelta(0))
+    print('apply + backfill: {:.2f} s'.format(time.perf_counter() - start))
+
+    print('{:<40} {:>12} {:>12} {:>10} {:>10} {:>10}  {}'.format(
+        'query', 'raw rows', 'preagg rows', 'raw MB', 'preagg MB', 'speedup', 'same result'))
+    for name, (raw_query, raw_connection), (preagg_query, preagg_connection) in cases(args.ds, ['gender', 'os', 'age']):
+        raw = run(raw_query, raw_connection)
+        preagg = run(preagg_query, preagg_connection)
+        print('{:<40} {:>12} {:>12} {:>10.1f} {:>10.2f} {:>9.1f}x  {}'.format(
+            name, raw['read_rows'], preagg['read_rows'], raw['read_bytes'] / 2**20, preagg['read_bytes'] / 2**20,
+            raw['seconds'] / max(preagg['seconds'], 1e-6), raw['result'] == preagg['result']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Сравнение разбора результата ClickHouse: TSVWithNamesAndTypes (pandahouse) против ArrowStream.
+# Ответы сервера имитируются локально в том же виде, в каком их отдает ClickHouse
+# (Date - UInt16, LowCardinality - словарь), каждый режим запускается в отдельном процессе ради честного пика RSS.
+# Запуск: python -m benchmarks.bench_reader --rows 2000000
+import argparse
+import io
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from common.clickhouse import arrow_to_pandas
+
+
+# Поюзерная выгрузка как у extract_feed
+def synthetic_feed(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'user_id': rng.integers(0, 10**7, rows).astype('uint32'),
+        'os': rng.choice(['iOS', 'Android'], rows),
+        'gender': rng.integers(0, 2, rows).astype('uint8'),
+        'age': rng.integers(14, 80, rows).astype('uint8'),
+        'event_date': np.full(rows, 19439, dtype='uint16'),
+        'likes': rng.integers(0, 50, rows).astype('uint64'),
+        'views': rng.integers(0, 200, rows).astype('uint64'),
+    })
+
+
+types = {'user_id': 'UInt32', 'os': 'LowCardinality(String)', 'gender': 'UInt8', 'age': 'UInt8',
+         'event_date': 'Date', 'likes': 'UInt64', 'views': 'UInt64'}
+
+
+def tsv_payload(df):
+    text = df.assign(event_date=pd.to_datetime(df.event_date, unit='D').dt.strftime('%Y-%m-%d'))
+    header = '\t'.join(df.columns) + '\n' + '\t'.join(types[c].replace('LowCardinality(String)', 'String')
+                                                     for c in df.columns) + '\n'
+    return (header + text.to_csv(sep='\t', header=False, index=False)).encode()
+
+
+def arrow_payload(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.set_column(table.schema.get_field_index('os'), 'os', table.column('os').dictionary_encode())
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def parse(mode, payload):
+    if mode == 'tsv':
+        from pandahouse.convert import to_dataframe
+        return to_dataframe(io.BytesIO(payload))
+    with pa.ipc.open_stream(io.BytesIO(payload)) as reader:
+        return arrow_to_pandas(reader.read_all(), types)
+
+
+# Один замер в отдельном процессе: время разбора и прирост пикового RSS
+def run_child(mode, rows):
+    df = synthetic_feed(rows)
+    payload = tsv_payload(df) if mode == 'tsv' else arrow_payload(df)
+    del df
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    result = parse(mode, payload)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'seconds': elapsed, 'peak_rss_mb': (after - before) / 1024,
+                      'payload_mb': len(payload) / 2**20,
+                      'frame_mb': result.memory_usage(deep=True).sum() / 2**20,
+                      'dtypes': {k: str(v) for k, v in result.dtypes.items()}}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--child', choices=['tsv', 'arrow'])
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, args.rows)
+
+    print('rows: {}'.format(args.rows))
+    print('{:<6} {:>10} {:>14} {:>12} {:>10}'.format('format', 'parse, s', 'peak RSS+, MB', 'payload, MB', 'frame, MB'))
+    for mode in ('tsv', 'arrow'):
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_reader', '--child', mode,
+                                 '--rows', str(args.rows)], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        print('{mode:<6} {seconds:>10.3f} {peak_rss_mb:>14.1f} {payload_mb:>12.1f} {frame_mb:>10.1f}'.format(**result))
+        print('       dtypes: {}'.format(', '.join('{}={}'.format(k, v) for k, v in result['dtypes'].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# Офлайн-прогон DAG-ов с замером каждого @task: время, пиковый RSS, строки на входе и выходе.
+# Таски выполняются в текущем процессе в топологическом порядке, результаты передаются напрямую,
+# ClickHouse - локальный сервер (CLICKHOUSE_HOST), Телеграм и Variable - заглушки из benchmarks/stubs.py.
+#
+#   clickhouse server -- --http_port=8123 --path=/tmp/ch &
+#   CLICKHOUSE_HOST=http://localhost:8123 python -m benchmarks.harness --populate --users 100000 \
+#       --baseline benchmarks/baseline.json
+#
+# С --baseline замеры сравниваются с сохраненными, превышение порога (--tolerance) - ненулевой код выхода;
+# --update-baseline перезаписывает файл текущими замерами
+import argparse
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+from common.instrumentation import PeakRss
+
+
+log = logging.getLogger(__name__)
+
+
+dag_modules = [
+    'Daily_Report.daily_cohort_report',
+    'Daily_Telegram_report.daily_APP_report',
+    'Daily_Telegram_report.daily_FEED_report',
+    'Telegram_alert_system.alert_system',
+]
+
+
+# Таски, которые по расписанию работают час и дольше: в офлайн-прогоне не выполняются. Теплый таск алертов
+# ждет закрытия каждого бакета до конца часа, а одна его проверка - та же, что у run_alerts
+long_running_tasks = {
+    'dag_kozhevatov_8_1_warm.run_alerts_warm',
+}
+
+
+def count_rows(value):
+    if hasattr(value, 'shape') and len(getattr(value, 'shape', ())) > 0:
+        return int(value.shape[0])
+    if isinstance(value, (list, tuple)):
+        return sum(count_rows(item) for item in value)
+    return 0
+
+
+# Подставляет в вызов таска результаты вышестоящих тасков (XComArg) и значения контекста
+def resolve(value, results):
+    from airflow.models.xcom_arg import XComArg
+
+    if isinstance(value, XComArg):
+        return results[value.operator.task_id]
+    if isinstance(value, dict):
+        return {key: resolve(item, results) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(resolve(item, results) for item in value)
+    return value
+
+
+def run_dag(dag, ds, results_sink=None):
+    metrics = []
+    results = {}
+    context = {'ds': ds, 'params': {key: param.value if hasattr(param, 'value') else param
+                                    for key, param in dag.params.items()}}
+    for task in dag.topological_sort():
+        if not hasattr(task, 'python_callable'):
+            metrics.append({'dag_id': dag.dag_id, 'task_id': task.task_id, 'skipped': 'mapped or non-python task'})
+            continue
+        if '{}.{}'.format(dag.dag_id, task.task_id) in long_running_tasks:
+            metrics.append({'dag_id': dag.dag_id, 'task_id': task.task_id, 'skipped': 'long-running task'})
+            continue
+        args = resolve(list(task.op_args), results)
+        kwargs = resolve(dict(task.op_kwargs), results)
+        signature = inspect.signature(task.python_callable)
+        for name in signature.parameters:
+            if name in context and name not in kwargs:
+                kwargs[name] = context[name]
+        rows_in = count_rows(args) + count_rows(list(kwargs.values()))
+
+        with PeakRss() as rss:
+            cpu = time.process_time()
+            start = time.perf_counter()
+            result = task.python_callable(*args, **kwargs)
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+        results[task.task_id] = result
+        metrics.append({'dag_id': dag.dag_id, 'task_id': task.task_id, 'wall_s': round(wall, 4),
+                        'cpu_s': round(cpu, 4), 'peak_rss_mb': round(rss.peak / 2**20, 1),
+                        'rss_growth_mb': round((rss.peak - rss.start) / 2**20, 1),
+                        'rows_in': rows_in, 'rows_out': count_rows(result)})
+        log.info('%s.%s: %.3f s', dag.dag_id, task.task_id, wall)
+    return metrics
+
+
+# Сравнение с сохраненными замерами: время и прирост памяти не должны вырасти больше чем на tolerance
+def compare(metrics, baseline, tolerance, min_wall=0.05, min_rss=5):
+    regressions = []
+    for row in metrics:
+        saved = baseline.get('{dag_id}.{task_id}'.format(**row))
+        if not saved or 'wall_s' not in row:
+            continue
+        if row['wall_s'] > max(saved['wall_s'], min_wall) * (1 + tolerance):
+            regressions.append('{dag_id}.{task_id}: wall {wall_s}s vs {0}s'.format(saved['wall_s'], **row))
+        if row['rss_growth_mb'] > max(saved['rss_growth_mb'], min_rss) * (1 + tolerance):
+            regressions.append('{dag_id}.{task_id}: rss +{rss_growth_mb}MB vs +{0}MB'.format(
+                saved['rss_growth_mb'], **row))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--populate', action='store_true', help='regenerate synthetic source tables first')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=35)
+    parser.add_argument('--events-per-user', type=float, default=20)
+    parser.add_argument('--messages-per-user', type=float, default=2)
+    parser.add_argument('--ds', default=str(date.today() - timedelta(days=1)))
+    parser.add_argument('--dags', nargs='*', default=dag_modules)
+    parser.add_argument('--baseline')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', help='write metrics as JSON lines')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    os.environ.setdefault('CLICKHOUSE_HOST', 'http://localhost:8123')
+    # Синтетические таблицы источника - в отдельной базе simulator (по умолчанию клиент читает simulator_20230220)
+    os.environ.setdefault('CLICKHOUSE_DATABASE', 'simulator')
+
+    from benchmarks import stubs
+    stubs.install()
+
+    if args.populate:
+        from benchmarks.synthetic import populate
+        from common.clickhouse import connection, connection_test
+        log.info('populated: %s', populate(connection, connection_test, users=args.users, days=args.days,
+                                           events_per_user=args.events_per_user,
+                                           messages_per_user=args.messages_per_user))
+
+    from airflow.models.dag import DAG
+
+    metrics = []
+    for module_name in args.dags:
+        module = importlib.import_module(module_name)
+        for dag in {id(value): value for value in vars(module).values() if isinstance(value, DAG)}.values():
+            metrics.extend(run_dag(dag, args.ds))
+
+    print('{:<28} {:<26} {:>8} {:>8} {:>10} {:>10} {:>10}'.format(
+        'dag', 'task', 'wall, s', 'cpu, s', 'rss+, MB', 'rows in', 'rows out'))
+    for row in metrics:
+        if 'skipped' in row:
+            print('{dag_id:<28} {task_id:<26} skipped: {skipped}'.format(**row))
+            continue
+        print('{dag_id:<28} {task_id:<26} {wall_s:>8.3f} {cpu_s:>8.3f} {rss_growth_mb:>10.1f} '
+              '{rows_in:>10} {rows_out:>10}'.format(**row))
+    print('telegram calls (stub): {}'.format(len(stubs.StubTelegram.calls)))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            for row in metrics:
+                output.write(json.dumps(row) + '\n')
+
+    if args.baseline:
+        if args.update_baseline or not os.path.exists(args.baseline):
+            with open(args.baseline, 'w') as output:
+                json.dump({'{dag_id}.{task_id}'.format(**row): row for row in metrics if 'wall_s' in row},
+                          output, indent=2)
+            return 0
+        with open(args.baseline) as source:
+            regressions = compare(metrics, json.load(source), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+# Заглушки внешних сервисов для офлайн-прогона DAG-ов: отправка в Телеграм, которая только запоминает вызовы
+# Bot API (в сеть ничего не уходит, даже если заданы TOKEN и CHAT_ID), и Airflow Variable в памяти процесса
+import time
+
+
+class StubTelegram:
+
+    calls = []
+
+    # Подменяет TelegramDelivery.call: та же сигнатура, задержки и метрики пишутся как у настоящего вызова
+    @staticmethod
+    async def call(delivery, method, chat_id, data=None, files=None):
+        start = time.perf_counter()
+        StubTelegram.calls.append({'method': method, 'chat_id': chat_id, 'time': time.time(),
+                                   'text_length': len((data or {}).get('text') or ''),
+                                   'photo_bytes': sum(len(file[1]) for file in (files or {}).values())})
+        delivery._record(method, chat_id, start, 0.0, 1, True)
+        return {'message_id': len(StubTelegram.calls)}
+
+
+class StubVariable:
+
+    values = {}
+
+    @classmethod
+    def get(cls, key, default_var=None, deserialize_json=False):
+        return cls.values.get(key, default_var)
+
+    @classmethod
+    def set(cls, key, value, serialize_json=False):
+        cls.values[key] = value
+
+
+# Подменяет отправку в Телеграм и Airflow Variable до импорта DAG-файлов
+def install():
+    from common.telegram_delivery import TelegramDelivery
+    TelegramDelivery.call = StubTelegram.call
+
+    import airflow.models
+    airflow.models.Variable = StubVariable
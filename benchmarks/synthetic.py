@@ -0,0 +1,118 @@
+# Генератор синтетических feed_actions / message_actions в схеме симулятора и загрузка их в локальный ClickHouse.
+# Таблицы источника создаются в базе connection (CLICKHOUSE_DATABASE), harness и bench_preagg читают базу simulator:
+#   CLICKHOUSE_HOST=http://localhost:8123 CLICKHOUSE_DATABASE=simulator python -m benchmarks.synthetic --users 100000
+import argparse
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pandahouse.convert import partition
+
+from common import clickhouse as ch
+from common.loader import insert_dataframe
+
+
+log = logging.getLogger(__name__)
+
+
+feed_actions_ddl = '''CREATE TABLE IF NOT EXISTS {db}.feed_actions
+    (user_id UInt32, post_id UInt32, action String, time DateTime,
+     gender Int8, age Int16, country String, city String, os String, source String, exp_group Int8)
+    ENGINE = MergeTree() ORDER BY (toDate(time), user_id)'''
+
+message_actions_ddl = '''CREATE TABLE IF NOT EXISTS {db}.message_actions
+    (user_id UInt32, reciever_id UInt32, time DateTime, source String, exp_group Int8,
+     gender Int8, age Int16, country String, city String, os String)
+    ENGINE = MergeTree() ORDER BY (toDate(time), user_id)'''
+
+countries = ['Russia', 'Ukraine', 'Belarus', 'Kazakhstan', 'Azerbaijan', 'Turkey', 'Finland', 'Estonia',
+             'Latvia', 'Cyprus', 'Switzerland']
+cities = ['Moscow', 'Saint Petersburg', 'Novosibirsk', 'Yekaterinburg', 'Kazan', 'Kyiv', 'Minsk', 'Almaty']
+
+
+# Атрибуты пользователей: пол, возраст, страна, город, ОС, источник, группа и день первого появления
+def generate_users(users, days, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'user_id': np.arange(1, users + 1, dtype='uint32'),
+        'gender': rng.integers(0, 2, users).astype('int8'),
+        'age': rng.integers(14, 80, users).astype('int16'),
+        'country': rng.choice(countries, users, p=[0.7] + [0.03] * 10),
+        'city': rng.choice(cities, users),
+        'os': rng.choice(['Android', 'iOS'], users, p=[0.65, 0.35]),
+        'source': rng.choice(['ads', 'organic'], users),
+        'exp_group': rng.integers(0, 5, users).astype('int8'),
+        'first_day': rng.integers(0, days, users),
+    })
+
+
+# События по дням: каждый пользователь после первого дня активен с вероятностью activity,
+# число событий за день - пуассоновское со средним events_per_user. Последний день обрезан текущим временем
+def generate_events(users, days, end, events_per_user, messages_per_user, activity=0.6, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    start_day = pd.Timestamp(end).normalize() - pd.Timedelta(days=days - 1)
+    feed, messages = [], []
+    for day in range(days):
+        day_start = start_day + pd.Timedelta(days=day)
+        day_seconds = min(86400, int((pd.Timestamp(end) - day_start).total_seconds()))
+        if day_seconds <= 0:
+            break
+        active = users[(users.first_day <= day) & ((users.first_day == day) | (rng.random(len(users)) < activity))]
+
+        counts = rng.poisson(events_per_user, len(active))
+        rows = active.loc[active.index.repeat(counts)].reset_index(drop=True)
+        rows['post_id'] = rng.integers(1, 200, len(rows)).astype('uint32')
+        rows['action'] = np.where(rng.random(len(rows)) < 0.2, 'like', 'view')
+        rows['time'] = day_start + pd.to_timedelta(rng.integers(0, day_seconds, len(rows)), unit='s')
+        feed.append(rows)
+
+        counts = rng.poisson(messages_per_user, len(active))
+        rows = active.loc[active.index.repeat(counts)].reset_index(drop=True)
+        rows['reciever_id'] = rng.choice(users.user_id.values, len(rows))
+        rows['time'] = day_start + pd.to_timedelta(rng.integers(0, day_seconds, len(rows)), unit='s')
+        messages.append(rows)
+
+    feed = pd.concat(feed, ignore_index=True)[['user_id', 'post_id', 'action', 'time', 'gender', 'age', 'country',
+                                               'city', 'os', 'source', 'exp_group']]
+    messages = pd.concat(messages, ignore_index=True)[['user_id', 'reciever_id', 'time', 'source', 'exp_group',
+                                                       'gender', 'age', 'country', 'city', 'os']]
+    return feed, messages
+
+
+def load_table(df, table, connection, block_size=500000):
+    for block in partition(df, chunksize=block_size):
+        insert_dataframe(block, table, connection=connection)
+    log.info('%s: loaded %s rows', table, len(df))
+
+
+# Создает базы источника и отчетов, таблицы симулятора и заливает в них синтетические события
+def populate(connection, connection_test, users=10000, days=35, events_per_user=20, messages_per_user=2, seed=0,
+             end=None):
+    end = end or datetime.now()
+    for database in (connection['database'], connection_test['database']):
+        ch.execute('CREATE DATABASE IF NOT EXISTS {}'.format(database), connection=dict(connection, database='default'))
+    for table in ('feed_actions', 'message_actions'):
+        ch.execute('DROP TABLE IF EXISTS {{db}}.{}'.format(table), connection=connection)
+    ch.execute(feed_actions_ddl, connection=connection)
+    ch.execute(message_actions_ddl, connection=connection)
+
+    user_frame = generate_users(users, days, seed=seed)
+    feed, messages = generate_events(user_frame, days, end, events_per_user, messages_per_user, seed=seed)
+    load_table(feed, 'feed_actions', connection)
+    load_table(messages, 'message_actions', connection)
+    return {'users': users, 'days': days, 'feed_actions': len(feed), 'message_actions': len(messages)}
+
+
+if __name__ == '__main__':
+    from common.clickhouse import connection, connection_test
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=35)
+    parser.add_argument('--events-per-user', type=float, default=20)
+    parser.add_argument('--messages-per-user', type=float, default=2)
+    args = parser.parse_args()
+    print(populate(connection, connection_test, users=args.users, days=args.days,
+                   events_per_user=args.events_per_user, messages_per_user=args.messages_per_user))
@@ -0,0 +1 @@
+# Общие модули, которые переиспользуются DAG-ами отчетов и системы алертов
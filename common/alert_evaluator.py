@@ -0,0 +1,221 @@
+# Проверка 15-минутных бакетов ленты с "теплым" состоянием: детектор, клиент ClickHouse (пул соединений)
+# и отправка в Телеграм (лимиты частоты по чатам) живут в одном процессе между проверками. Используется таском run_alerts, долгоживущим таском
+# DAG-а dag_kozhevatov_8_1_warm и как отдельный сервис:
+#   python -m common.alert_evaluator --chat <id> --state-file /var/lib/alerts/state.json
+# Каждая проверка запускается через settle секунд после закрытия бакета, в лог пишется задержка
+# обнаружения - время от закрытия бакета до окончания проверки и отправки алертов
+import json
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from common import charts
+from common import clickhouse as ch
+from common.anomaly import IncrementalAnomalyState, chack_anomaly
+from common.clickhouse import connection, connection_test
+from common.migrations import Migrations
+from common.queries import alert_buckets_query, preaggregated_alert_buckets_query, uniq_mode
+from common.telegram_delivery import TelegramDelivery
+
+
+log = logging.getLogger(__name__)
+
+bucket_seconds = 15 * 60
+
+# Если последнее сохраненное состояние старше этого интервала, оно пересобирается из полной выгрузки
+max_state_gap = timedelta(days=1)
+
+
+# Начало (unix time) бакета, который закрылся последним к моменту now
+def last_closed_bucket_end(now=None):
+    now = time.time() if now is None else now
+    return now // bucket_seconds * bucket_seconds
+
+
+def alert_message(metric, df):
+    return '''Метрика {metric}:\nтекущее значение {current_val:.2f}\n
+отклонение от предыдущего значения {last_val_diff:.2%}'''.format(metric = metric,
+                                                                 current_val = df[metric].iloc[-1],
+                                                                 last_val_diff=abs(1-(df[metric].iloc[-1]/df[metric].iloc[-2])))
+
+
+class AlertEvaluator:
+
+    def __init__(self, metrics, chat_id=None, a=3, n=5, state=None, connection=connection,
+                 settings=None, timeout=None, delivery=None, baseline=None, preaggregated=False,
+                 preaggregate_connection=connection_test, sketches=None):
+        self.metrics = list(metrics)
+        # Один или несколько чатов через запятую - алерты рассылаются во все параллельно
+        self.chat_id = chat_id or os.environ.get('ALERT_CHAT_ID')
+        self.a = a
+        self.n = n
+        self.state = state
+        self.connection = connection
+        self.settings = settings
+        self.timeout = timeout
+        self.delivery = delivery or TelegramDelivery()
+        # SeasonalBaseline: полосы берутся из сезонного профиля (перечитывается раз в сутки),
+        # без него - скользящее окно IncrementalAnomalyState
+        self.baseline = baseline
+        # Бакеты из предагрегата test.kozhevatov_feed_15m (common/migrations.py) вместо feed_actions -
+        # только когда его миграция в статусе ready, иначе история в нем еще не залита
+        self.preaggregate_connection = preaggregate_connection
+        self.preaggregated = preaggregated and Migrations(connection=preaggregate_connection,
+                                                          source_connection=connection).ready(['kozhevatov_feed_15m'])
+        # UniqSketchStore (UNIQ_MODE=approx): users_feed - слияние сохраненных состояний бакетов,
+        # из feed_actions выгружаются только счетчики и состояния новых бакетов
+        self.sketches = sketches
+
+    # Unix time -> наивное время в часовом поясе сервера ClickHouse: в нем приходят ts бакетов, и с ним
+    # сравнивается состояние (часы воркера могут быть в другом поясе)
+    def server_time(self, timestamp):
+        client = ch.get_client(self.preaggregate_connection if self.preaggregated else self.connection)
+        return pd.Timestamp(timestamp, unit='s', tz='UTC').tz_convert(client.server_timezone).tz_localize(None)
+
+    def read(self, query, connection=None):
+        return ch.read_clickhouse(query = query, connection = connection or self.connection,
+                                  settings = self.settings, timeout = self.timeout)
+
+    # 15-минутные бакеты начиная с since (без since - со вчерашнего дня)
+    def buckets(self, since=None):
+        if self.preaggregated:
+            return self.read(preaggregated_alert_buckets_query(since = since), self.preaggregate_connection)
+        if self.sketches is None:
+            return self.read(alert_buckets_query(since = since))
+        self.sketches.update_buckets(since)
+        data = self.read(alert_buckets_query(since = since, users = False))
+        users = self.sketches.bucket_uniques(since)
+        users_feed = dict(zip(pd.to_datetime(users['ts']), users['users_feed']))
+        data.insert(3, 'users_feed', pd.to_datetime(data['ts']).map(users_feed).fillna(0).astype('int64'))
+        return data
+
+    # Перечитывает бакеты окна состояния и дописывает новые (O(окна), опоздавшие события попадают
+    # в уже сохраненные бакеты), либо пересобирает состояние из полной выгрузки,
+    # если состояния нет, параметры детектора поменялись или проверка долго не запускалась
+    def refresh(self):
+        state = self.state
+        if state is None or not state.is_compatible(self.metrics, self.a, self.n) or state.last_ts is None \
+                or self.server_time(time.time()) - state.last_ts > max_state_gap:
+            self.state = IncrementalAnomalyState(self.buckets(), self.metrics, a=self.a, n=self.n)
+            return len(self.state.frame)
+        return state.merge(self.buckets(since = state.first_ts))
+
+    def check(self):
+        if self.baseline is None:
+            return self.state.check()
+        if self.baseline.loaded_on != date.today():
+            self.baseline.load()
+        return self.baseline.check(self.state.frame)
+
+    # Ряды для сообщения и графиков сработавших метрик: бакеты со вчерашнего дня с полосами детектора.
+    # Состояние хранит только окно детектора (state_window(n) бакетов), в начале которого полос еще нет,
+    # поэтому для показа ряд выгружается заново - только когда алерт сработал
+    def display_series(self, metrics):
+        data = self.buckets()
+        if self.baseline is not None:
+            checks = self.baseline.check(data)
+        else:
+            checks = {metric: chack_anomaly(data[['ts', 'date', 'hm', metric]].copy(), metric, a=self.a, n=self.n)
+                      for metric in metrics}
+        return [(metric, checks[metric][1]) for metric in metrics]
+
+    # Все алерты проверки - одно сообщение и один альбом графиков. alerts - список (metric, df)
+    def send(self, alerts):
+        if not alerts:
+            return None
+        text = '\n\n'.join(alert_message(metric, df) for metric, df in alerts)
+        return self.delivery.deliver(self.chat_id, text, charts.render_many(charts.alert_jobs(alerts)))
+
+    # Проверен ли уже бакет, закрывшийся в bucket_end: он есть в состоянии как последний или раньше
+    def is_checked(self, bucket_end):
+        return self.state is not None and self.state.last_ts is not None \
+            and self.state.last_ts >= self.server_time(bucket_end - bucket_seconds)
+
+    # Одна проверка: новые бакеты -> детектор -> алерты. bucket_end - unix time закрытия
+    # проверяемого бакета, от него считается задержка обнаружения. Если бакет еще не доехал
+    # (события приходят с задержкой), выгрузка повторяется retries раз через retry_delay секунд;
+    # без него детектор не запускается - иначе повторно проверялся бы прошлый бакет и дублировались алерты
+    def evaluate(self, bucket_end=None, retries=2, retry_delay=15):
+        bucket_end = last_closed_bucket_end() if bucket_end is None else bucket_end
+        new_rows = self.refresh()
+        for _ in range(retries):
+            if self.is_checked(bucket_end):
+                break
+            time.sleep(retry_delay)
+            new_rows += self.refresh()
+        if not self.is_checked(bucket_end):
+            log.warning('bucket ending %s has no data yet, last bucket in state %s: check skipped',
+                        self.server_time(bucket_end), self.state.last_ts)
+            return {'ts': self.state.last_ts, 'new_rows': new_rows, 'alerts': [], 'skipped': True,
+                    'latency_s': time.time() - bucket_end}
+        checks = self.check()
+        alerts = [metric for metric in self.metrics if checks[metric][0] == 1]
+        if alerts:
+            self.send(self.display_series(alerts))
+        latency = time.time() - bucket_end
+        log.info('bucket %s: %s new row(s), alerts: %s, detection latency %.1f s',
+                 self.state.last_ts, new_rows, ', '.join(alerts) or '-', latency)
+        return {'ts': self.state.last_ts, 'new_rows': new_rows, 'alerts': alerts, 'skipped': False,
+                'latency_s': latency}
+
+    # Цикл проверок до момента until (unix time, None - бесконечно): ожидание закрытия следующего бакета,
+    # settle секунд на доезд событий, проверка. Бакет, закрывшийся до запуска, проверяется первым,
+    # если его еще нет в состоянии (иначе бакет на стыке запусков не проверялся бы никогда).
+    # on_evaluated(evaluator, result) вызывается после каждой проверки
+    def run(self, until=None, settle=30, on_evaluated=None):
+        results = []
+        bucket_end = last_closed_bucket_end()
+        if self.is_checked(bucket_end):
+            bucket_end += bucket_seconds
+        while True:
+            wake_at = bucket_end + settle
+            if until is not None and wake_at > until:
+                return results
+            time.sleep(max(0, wake_at - time.time()))
+            try:
+                result = self.evaluate(bucket_end)
+            except Exception:
+                # Ошибка одной проверки не останавливает сервис: следующая проверка дочитает пропущенные бакеты
+                log.exception('alert evaluation for bucket ending %s failed', self.server_time(bucket_end))
+                result = None
+            # Если проверка затянулась дольше бакета, следующей проверяется последний закрывшийся
+            bucket_end = max(bucket_end + bucket_seconds, last_closed_bucket_end())
+            if result is None:
+                continue
+            results.append(result)
+            if on_evaluated is not None:
+                on_evaluated(self, result)
+
+
+# Отдельный сервис: состояние между перезапусками хранится в JSON-файле
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chat')
+    parser.add_argument('--metrics', nargs='+', default=['users_feed', 'views', 'likes'])
+    parser.add_argument('--settle', type=int, default=30)
+    parser.add_argument('--state-file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    state = None
+    if args.state_file and os.path.exists(args.state_file):
+        with open(args.state_file) as source:
+            state = IncrementalAnomalyState.from_dict(json.load(source))
+
+    def save_state(evaluator, result):
+        if args.state_file:
+            with open(args.state_file + '.tmp', 'w') as output:
+                json.dump(evaluator.state.to_dict(), output)
+            os.replace(args.state_file + '.tmp', args.state_file)
+
+    sketches = None
+    if uniq_mode == 'approx':
+        from common.sketches import UniqSketchStore
+        sketches = UniqSketchStore()
+    AlertEvaluator(args.metrics, chat_id = args.chat, state = state, sketches = sketches) \
+        .run(settle = args.settle, on_evaluated = save_state)
@@ -0,0 +1,166 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Алгоритм поиска аномалий - межквартильный размах
+def chack_anomaly(df, metric, a=3, n=5):
+    df['q25'] = df[metric].shift(1).rolling(n).quantile(0.25)
+    df['q75'] = df[metric].shift(1).rolling(n).quantile(0.75)
+    df['iqr'] = df['q75'] - df['q25'] 
+    df['up'] = df['q75'] + a*df['iqr']
+    df['low'] = df['q25'] - a*df['iqr']
+    
+    df['up'] = df['up'].rolling(n, center = True, min_periods=1).mean()
+    df['low'] = df['low'].rolling(n, center = True,  min_periods=1).mean()
+        
+    if df[metric].iloc[-1] < df['low'].iloc[-1] or df[metric].iloc[-1] > df['up'].iloc[-1]:
+        is_alert = 1
+    else: 
+        is_alert = 0
+        
+    set_to_return = (is_alert, df)
+    
+    return set_to_return
+
+
+# Сколько последних 15-минутных точек влияет на решение по последней точке в chack_anomaly:
+# n точек для скользящих квартилей + n // 2 точек центрированного сглаживания (справа от
+# последней точки соседей нет) + сама последняя точка
+def state_window(n):
+    return n + n // 2 + 1
+
+
+class IncrementalAnomalyState:
+    # Состояние скользящего окна между запусками DAG: хранит только хвост ряда длиной
+    # state_window(n), поэтому проверка нового бакета стоит O(окна), а не O(суток),
+    # и дает те же is_alert, что и chack_anomaly на полной выгрузке
+
+    version = 1
+
+    def __init__(self, frame, metrics, a=3, n=5):
+        self.metrics = list(metrics)
+        self.a = a
+        self.n = n
+        self.frame = frame.tail(state_window(n)).reset_index(drop=True)
+
+    @property
+    def first_ts(self):
+        if self.frame.empty:
+            return None
+        return self.frame['ts'].iloc[0]
+
+    @property
+    def last_ts(self):
+        if self.frame.empty:
+            return None
+        return self.frame['ts'].iloc[-1]
+
+    def is_compatible(self, metrics, a, n):
+        return self.metrics == list(metrics) and self.a == a and self.n == n
+
+    # Сливает перечитанные бакеты с состоянием: бакеты, которые уже есть в состоянии, перезаписываются
+    # (в них могли доехать опоздавшие события), новые дописываются. Возвращает число новых бакетов
+    def merge(self, rows):
+        if rows.empty:
+            return 0
+        last_ts = self.last_ts
+        columns = ['ts', 'date', 'hm'] + self.metrics
+        kept = self.frame[~self.frame['ts'].isin(rows['ts'])]
+        self.frame = pd.concat([kept, rows[columns]], ignore_index=True) \
+            .sort_values('ts') \
+            .tail(state_window(self.n)) \
+            .reset_index(drop=True)
+        return len(rows) if last_ts is None else int((rows['ts'] > last_ts).sum())
+
+    # Возвращает {metric: (is_alert, df)} - те же значения, что и chack_anomaly по каждой метрике
+    def check(self):
+        results = {}
+        for metric in self.metrics:
+            df = self.frame[['ts', 'date', 'hm', metric]].copy()
+            results[metric] = chack_anomaly(df, metric, a=self.a, n=self.n)
+        return results
+
+    def to_dict(self):
+        frame = self.frame.copy()
+        frame['ts'] = frame['ts'].astype(str)
+        frame['date'] = frame['date'].astype(str)
+        return {'version': self.version,
+                'metrics': self.metrics,
+                'a': self.a,
+                'n': self.n,
+                'rows': frame.to_dict(orient='records')}
+
+    @classmethod
+    def from_dict(cls, state):
+        if not state or state.get('version') != cls.version:
+            return None
+        frame = pd.DataFrame(state['rows'], columns=['ts', 'date', 'hm'] + state['metrics'])
+        frame['ts'] = pd.to_datetime(frame['ts'])
+        frame['date'] = pd.to_datetime(frame['date'])
+        return cls(frame, state['metrics'], a=state['a'], n=state['n'])
+
+
+# Скользящие квартили по предыдущим n точкам (аналог shift(1).rolling(n).quantile(q)) сразу
+# для всех рядов: values - 2-D массив (ряды x время)
+def _rolling_quantiles(values, n, qs):
+    shifted = np.full(values.shape, np.nan)
+    shifted[:, 1:] = values[:, :-1]
+    out = np.full((len(qs),) + values.shape, np.nan)
+    if values.shape[1] >= n:
+        windows = sliding_window_view(shifted, n, axis=1)
+        out[:, :, n - 1:] = np.quantile(windows, qs, axis=-1)
+    return out
+
+
+# Центрированное скользящее среднее с min_periods=1 (аналог rolling(n, center=True, min_periods=1).mean())
+def _centered_mean(values, n):
+    left, right = n // 2, n - 1 - n // 2
+    padded = np.pad(values, ((0, 0), (left, right)), constant_values=np.nan)
+    windows = sliding_window_view(padded, n, axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(windows, axis=-1)
+
+
+# Векторизованный chack_anomaly: считает полосы q25/q75/iqr/up/low для всех рядов за один проход.
+# Если нужны только флаги по последней точке, last_only=True обрезает ряды до state_window(n) точек -
+# на решение по последней точке это не влияет
+def batch_check_anomaly(values, a=3, n=5, last_only=False):
+    values = np.asarray(values, dtype=float)
+    if last_only:
+        values = values[:, -state_window(n):]
+    q25, q75 = _rolling_quantiles(values, n, [0.25, 0.75])
+    iqr = q75 - q25
+    up = _centered_mean(q75 + a*iqr, n)
+    low = _centered_mean(q25 - a*iqr, n)
+    is_alert = (values[:, -1] < low[:, -1]) | (values[:, -1] > up[:, -1])
+    return {'values': values, 'q25': q25, 'q75': q75, 'iqr': iqr,
+            'up': up, 'low': low, 'is_alert': is_alert}
+
+
+# Разворачивает длинную выгрузку (ts, срезы..., метрики) в 2-D массив рядов (метрика x срез) по времени.
+# Пропущенные бакеты среза заполняются нулями: нет событий - значение метрики 0
+def pivot_series(data, keys, metrics, ts_grid=None):
+    long = data.melt(id_vars=['ts'] + keys, value_vars=metrics, var_name='metric')
+    wide = long.set_index(['metric'] + keys + ['ts'])['value'].unstack('ts', fill_value=0)
+    if ts_grid is not None:
+        wide = wide.reindex(columns=ts_grid, fill_value=0)
+    return wide
+
+
+# Проверяет последний бакет всех рядов (метрика x срез) одним вызовом.
+# Возвращает по строке на ряд: текущее значение, границы и флаг is_alert
+def batch_alerts(data, keys, metrics, a=3, n=5, ts_grid=None):
+    wide = pivot_series(data, keys, metrics, ts_grid=ts_grid)
+    result = batch_check_anomaly(wide.to_numpy(), a=a, n=n, last_only=True)
+    report = wide.index.to_frame(index=False)
+    report['ts'] = wide.columns[-1]
+    report['value'] = result['values'][:, -1]
+    report['prev_value'] = result['values'][:, -2]
+    report['low'] = result['low'][:, -1]
+    report['up'] = result['up'][:, -1]
+    report['is_alert'] = result['is_alert'].astype(int)
+    return report
@@ -0,0 +1,196 @@
+# Бэктест детекторов аномалий на истории 15-минутных бакетов. История выгружается один раз в массив
+# метрика x время, каждый детектор считает флаги сразу по всем точкам (без цикла по бакетам),
+# а сетка параметров раскладывается по процессам. Решение в точке t использует только данные до t -
+# так же, как при проверке последнего бакета в DAG-е.
+# Размеченные инциденты - CSV с колонками start, end и необязательной metric (пусто - все метрики).
+# Результат по каждому набору параметров: число алертов, precision (доля алертов внутри инцидентов),
+# recall (доля инцидентов хотя бы с одним алертом) и f1.
+#   python -m common.backtest --start 2023-02-20 --days 28 --incidents incidents.csv
+import itertools
+import logging
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from common import clickhouse as ch
+from common.anomaly import _rolling_quantiles
+from common.clickhouse import connection
+from common.queries import alert_history_query
+
+
+log = logging.getLogger(__name__)
+
+buckets_per_day = 24 * 4
+
+
+# Реестр детекторов: имя -> (функция values -> флаги, сетка параметров по умолчанию)
+detectors = {}
+
+
+def detector(name, **default_grid):
+    def register(func):
+        detectors[name] = (func, default_grid)
+        return func
+    return register
+
+
+# Скользящее среднее по последним width точкам без учета NaN (аналог rolling(width, min_periods=1).mean())
+def _trailing_mean(values, width):
+    padded = np.pad(values, ((0, 0), (width - 1, 0)), constant_values=np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(sliding_window_view(padded, width, axis=1), axis=-1)
+
+
+# Текущий детектор chack_anomaly. В последней точке центрированное сглаживание полос видит только
+# n // 2 точек слева и саму точку, поэтому при проверке каждой точки как последней оно становится
+# скользящим средним по n // 2 + 1 точкам
+@detector('iqr', a=[1.5, 2, 2.5, 3, 4], n=[3, 4, 5, 6, 8])
+def iqr_detector(values, a=3, n=5):
+    q25, q75 = _rolling_quantiles(values, n, [0.25, 0.75])
+    iqr = q75 - q25
+    up = _trailing_mean(q75 + a * iqr, n // 2 + 1)
+    low = _trailing_mean(q25 - a * iqr, n // 2 + 1)
+    return (values < low) | (values > up)
+
+
+# Отклонение от экспоненциально сглаженного среднего больше z стандартных отклонений
+@detector('ewma', span=[8, 16, 32, 96], z=[2.5, 3, 4, 5])
+def ewma_detector(values, span=16, z=3):
+    frame = pd.DataFrame(values.T)
+    mean = frame.ewm(span=span, min_periods=span).mean().shift(1).to_numpy().T
+    std = frame.ewm(span=span, min_periods=span).std().shift(1).to_numpy().T
+    return np.abs(values - mean) > z * std
+
+
+# Относительное отклонение от того же бакета lag дней назад
+@detector('day_over_day', threshold=[0.2, 0.3, 0.5, 0.75], lag=[1, 7])
+def day_over_day_detector(values, threshold=0.3, lag=1):
+    shift = lag * buckets_per_day
+    previous = np.full(values.shape, np.nan)
+    previous[:, shift:] = values[:, :-shift]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs(values / previous - 1) > threshold
+
+
+def load_history(start, days, metrics, connection=connection):
+    data = ch.read_clickhouse(alert_history_query(start, days), connection=connection)
+    return history_frame(data, metrics)
+
+
+# Выгрузка (ts, метрики...) -> (ts, массив метрика x время) на полной 15-минутной сетке (пропуски - 0)
+def history_frame(data, metrics):
+    ts = pd.date_range(data['ts'].min(), data['ts'].max(), freq='15min')
+    wide = data.set_index('ts')[metrics].reindex(ts, fill_value=0)
+    return ts, wide.to_numpy(dtype='float64').T
+
+
+def load_incidents(path):
+    incidents = pd.read_csv(path)
+    if 'metric' not in incidents:
+        incidents['metric'] = ''
+    return incidents.assign(start=pd.to_datetime(incidents['start']), end=pd.to_datetime(incidents['end']),
+                            metric=incidents['metric'].fillna('').astype(str))
+
+
+# Разметка: по каждому инциденту - индексы рядов и полуинтервал бакетов [first, last)
+def incident_spans(ts, metrics, incidents):
+    spans = []
+    for row in incidents.itertuples():
+        rows = [metrics.index(row.metric)] if row.metric else list(range(len(metrics)))
+        first, last = np.searchsorted(ts.values, [np.datetime64(row.start), np.datetime64(row.end)])
+        spans.append((rows, first, max(last, first + 1)))
+    return spans
+
+
+def label_mask(shape, spans):
+    mask = np.zeros(shape, dtype=bool)
+    for rows, first, last in spans:
+        mask[rows, first:last] = True
+    return mask
+
+
+def score(alerts, mask, spans, warmup=0):
+    alerts = alerts[:, warmup:]
+    mask = mask[:, warmup:]
+    total = int(alerts.sum())
+    true_alerts = int((alerts & mask).sum())
+    cumulative = np.concatenate([np.zeros((alerts.shape[0], 1), dtype=int), alerts.cumsum(axis=1)], axis=1)
+    detected = 0
+    for rows, first, last in spans:
+        first, last = max(first - warmup, 0), max(last - warmup, 0)
+        detected += bool((cumulative[rows, last] - cumulative[rows, first]).sum())
+    precision = true_alerts / total if total else 0.0
+    recall = detected / len(spans) if spans else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'alerts': total, 'true_alerts': true_alerts, 'incidents': len(spans), 'detected': detected,
+            'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def parameter_grid(grid):
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# Данные бэктеста в рабочих процессах пула: передаются один раз при старте процесса, а не с каждым заданием
+_history = {}
+
+
+def _init_worker(values, mask, spans, warmup):
+    _history.update(values=values, mask=mask, spans=spans, warmup=warmup)
+
+
+def _run(job):
+    name, params = job
+    func = detectors[name][0]
+    alerts = func(_history['values'], **params)
+    return dict(score(alerts, _history['mask'], _history['spans'], _history['warmup']),
+                detector=name, params=params)
+
+
+# Перебор сеток параметров: grids - {детектор: сетка}, по умолчанию все зарегистрированные детекторы со своими
+# сетками. warmup - сколько первых бакетов не оценивать (детекторам нужна история). Возвращает DataFrame,
+# отсортированный по f1
+def sweep(ts, values, metrics, incidents, grids=None, processes=None, warmup=buckets_per_day):
+    grids = grids or {name: default_grid for name, (func, default_grid) in detectors.items()}
+    jobs = [(name, params) for name, grid in grids.items() for params in parameter_grid(grid)]
+    spans = incident_spans(ts, list(metrics), incidents)
+    mask = label_mask(values.shape, spans)
+    processes = processes or os.cpu_count() or 1
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(values, mask, spans, warmup)) as pool:
+            results = list(pool.map(_run, jobs, chunksize=max(1, len(jobs) // (processes * 4))))
+    else:
+        _init_worker(values, mask, spans, warmup)
+        results = [_run(job) for job in jobs]
+    report = pd.DataFrame(results)
+    report['params'] = report['params'].map(lambda params: ', '.join('{}={}'.format(*item) for item in params.items()))
+    return report[['detector', 'params', 'alerts', 'true_alerts', 'incidents', 'detected',
+                   'precision', 'recall', 'f1']].sort_values(['f1', 'precision'], ascending=False) \
+        .reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start', required=True)
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--incidents', required=True)
+    parser.add_argument('--metrics', nargs='+', default=['users_feed', 'views', 'likes'])
+    parser.add_argument('--detectors', nargs='*', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ts, values = load_history(args.start, args.days, args.metrics)
+    grids = {name: detectors[name][1] for name in args.detectors} if args.detectors else None
+    report = sweep(ts, values, args.metrics, load_incidents(args.incidents), grids=grids,
+                   processes=args.processes)
+    print(report.head(args.top).to_string())
@@ -0,0 +1,109 @@
+# Сезонный профиль для алертов: по каждой (метрике, дню недели, 15-минутному слоту) хранится полоса
+# [q25 - a * IQR, q75 + a * IQR] по тем же бакетам за последние weeks недель. Профиль строится раз в сутки
+# (DAG dag_kozhevatov_8_1_baseline) в test.kozhevatov_alert_baseline, в памяти это массивы
+# метрика x 7 x 96, а проверка бакетов - индексация по ним сразу для всех метрик и строк.
+# В отличие от окна из предыдущих n бакетов, утренний рост и ночной спад входят в профиль и не дают алертов
+import logging
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from common import clickhouse as ch
+from common.clickhouse import connection, connection_test
+from common.loader import insert_dataframe
+from common.queries import alert_baseline_query, as_date
+
+
+log = logging.getLogger(__name__)
+
+slots_per_day = 24 * 4
+
+
+def hm_slot(hm):
+    hm = pd.Series(hm).astype(str)
+    return (hm.str[:2].astype(int) * 4 + hm.str[3:5].astype(int) // 15).to_numpy()
+
+
+class SeasonalBaseline:
+
+    ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+        (metric LowCardinality(String),
+         weekday UInt8,
+         hm FixedString(5),
+         q25 Float64,
+         q50 Float64,
+         q75 Float64,
+         low Float64,
+         up Float64,
+         samples UInt32,
+         built_at DateTime DEFAULT now())
+        ENGINE = ReplacingMergeTree(built_at)
+        ORDER BY (metric, weekday, hm)'''
+
+    # min_samples - сколько недель должно быть в ячейке, чтобы по ней проверять (иначе полоса пустая и алерта нет)
+    def __init__(self, metrics, table='kozhevatov_alert_baseline', connection=connection_test,
+                 source_connection=connection, weeks=4, a=3, min_samples=3):
+        self.metrics = list(metrics)
+        self.table = table
+        self.connection = connection
+        self.source_connection = source_connection
+        self.weeks = weeks
+        self.a = a
+        self.min_samples = min_samples
+        self.low = self.up = None
+        self.loaded_on = None
+
+    def ensure_table(self):
+        ch.execute(self.ddl.format(table=self.table), connection=self.connection)
+
+    # Пересчитывает профиль по неделям, заканчивая днем day, и сохраняет его
+    def build(self, day):
+        self.ensure_table()
+        bands = ch.read_clickhouse(alert_baseline_query(day, self.weeks, self.metrics),
+                                   connection=self.source_connection)
+        iqr = bands['q75'] - bands['q25']
+        bands = bands.assign(low=bands['q25'] - self.a * iqr, up=bands['q75'] + self.a * iqr)
+        bands = bands[['metric', 'weekday', 'hm', 'q25', 'q50', 'q75', 'low', 'up', 'samples']]
+        insert_dataframe(bands, self.table, connection=self.connection)
+        log.info('%s: %s bands from %s week(s) up to %s', self.table, len(bands), self.weeks, as_date(day))
+        self._fill(bands)
+        return len(bands)
+
+    # Читает профиль из таблицы в массивы метрика x день недели x слот
+    def load(self):
+        bands = ch.read_clickhouse('''SELECT metric, weekday, hm, low, up, samples
+                                      FROM {{db}}.{table} FINAL'''.format(table=self.table),
+                                   connection=self.connection)
+        self._fill(bands)
+        return self
+
+    def _fill(self, bands):
+        shape = (len(self.metrics), 7, slots_per_day)
+        self.low, self.up = np.full(shape, np.nan), np.full(shape, np.nan)
+        bands = bands[bands['metric'].astype(str).isin(self.metrics)
+                      & (bands['samples'].astype(int) >= self.min_samples)]
+        index = (bands['metric'].astype(str).map(self.metrics.index).to_numpy(),
+                 bands['weekday'].astype(int).to_numpy() - 1, hm_slot(bands['hm']))
+        self.low[index] = bands['low'].to_numpy(dtype='float64')
+        self.up[index] = bands['up'].to_numpy(dtype='float64')
+        self.loaded_on = date.today()
+
+    # Полосы для строк frame (колонки ts и hm) сразу по всем метрикам: массивы строки x метрики
+    def bands(self, frame):
+        weekday = pd.to_datetime(frame['ts']).dt.dayofweek.to_numpy()
+        slot = hm_slot(frame['hm'])
+        rows = np.arange(len(self.metrics))[None, :]
+        return self.low[rows, weekday[:, None], slot[:, None]], self.up[rows, weekday[:, None], slot[:, None]]
+
+    # Проверка в формате IncrementalAnomalyState.check: {metric: (is_alert, df)}, где df - строки frame
+    # с колонками up / low из профиля, а is_alert - выход последнего бакета за полосу
+    def check(self, frame):
+        low, up = self.bands(frame)
+        results = {}
+        for i, metric in enumerate(self.metrics):
+            df = frame[['ts', 'date', 'hm', metric]].assign(low=low[:, i], up=up[:, i])
+            value = df[metric].iloc[-1]
+            is_alert = 1 if value < low[-1, i] or value > up[-1, i] else 0
+            results[metric] = (is_alert, df)
+        return results
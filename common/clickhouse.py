@@ -0,0 +1,257 @@
+# Общий клиент ClickHouse для всех DAG-ов: один пул HTTP-соединений с keep-alive на процесс,
+# сжатые ответы, таймауты и настройки (max_threads и т.п.) на уровне отдельного запроса.
+# Интерфейс повторяет pandahouse: read_clickhouse / execute / to_clickhouse с теми же connection-словарями
+import collections
+import logging
+import os
+import re
+import threading
+
+import pandas as pd
+import requests
+from pandahouse.convert import partition, to_csv, to_dataframe
+from pandahouse.core import insertion, selection
+from pandahouse.http import ClickhouseException
+from pandahouse.utils import escape
+from requests.adapters import HTTPAdapter
+
+from common import instrumentation
+from common.schemas import enforce
+
+
+log = logging.getLogger(__name__)
+
+clickhouse_host = os.environ.get('CLICKHOUSE_HOST', 'https://clickhouse.lab.karpov.courses')
+
+
+# Параметры для подключения к базе CH с данными для выгрузки
+connection = {
+    'host': clickhouse_host,
+    'database': os.environ.get('CLICKHOUSE_DATABASE', 'simulator_20230220'),
+    'user': os.environ.get("DB_LOGIN"),
+    'password': os.environ.get("DB_PASS")
+}
+
+
+# Параметры для подключения к базе CH куда выгружаются готовые отчеты
+connection_test = {
+    'host': clickhouse_host,
+    'database': os.environ.get('CLICKHOUSE_TEST_DATABASE', 'test'),
+    'user': os.environ.get("test_DB_LOGIN"),
+    'password': os.environ.get("test_DB_PASS")
+}
+
+
+# Таймаут запроса по умолчанию, секунды: (соединение, чтение)
+default_timeout = (10, 600)
+
+# Формат чтения по умолчанию: arrow - ArrowStream из буферов Arrow, tsv - разбор текста как в pandahouse
+read_format = os.environ.get('CLICKHOUSE_READ_FORMAT', 'arrow')
+
+# LowCardinality отдается словарем Arrow (в pandas - categorical), String - строками, а не бинарными данными
+arrow_settings = {
+    'output_format_arrow_low_cardinality_as_dictionary': 1,
+    'output_format_arrow_string_as_string': 1,
+}
+
+
+def _strip_type(chtype):
+    for wrapper in ('LowCardinality(', 'Nullable('):
+        if chtype.startswith(wrapper):
+            chtype = chtype[len(wrapper):-1]
+    return chtype
+
+
+# Date и DateTime ClickHouse отдает в Arrow как UInt16 (дни) и UInt32 (секунды) - возвращаем им тип дат.
+# DateTime приводится к наивному времени в часовом поясе сервера, как при разборе TSV
+def _restore_dates(df, types, server_timezone):
+    for name, chtype in types.items():
+        chtype = _strip_type(chtype)
+        if name not in df or pd.api.types.is_datetime64_any_dtype(df[name]):
+            continue
+        if chtype == 'Date':
+            df[name] = pd.to_datetime(df[name], unit='D')
+        elif chtype.startswith('DateTime') and not chtype.startswith('DateTime64'):
+            timezone = chtype[len("DateTime('"):-2] if '(' in chtype else server_timezone
+            df[name] = pd.to_datetime(df[name], unit='s', utc=True).dt.tz_convert(timezone).dt.tz_localize(None)
+    return df
+
+
+# Arrow -> pandas без копирования там, где это возможно: числовые колонки без пропусков
+# ссылаются на буферы Arrow, словари становятся categorical
+def arrow_to_pandas(table, types=None, server_timezone='UTC'):
+    df = table.to_pandas(split_blocks=True, self_destruct=True, date_as_object=False)
+    return _restore_dates(df, types or {}, server_timezone)
+
+
+# Типы колонок результата (DESCRIBE) кешируются по тексту запроса без строковых литералов: запросы алертов
+# и отчетов отличаются от запуска к запуску только датами, типы колонок от них не зависят (типы, заданные
+# строкой - CAST(x, 'Type') или часовой пояс в toDateTime - в запросах проекта не встречаются)
+describe_cache_size = 256
+
+string_literal = re.compile(r"'(?:[^'\\]|\\.)*'")
+
+
+def query_shape(query):
+    return string_literal.sub("''", query.strip().strip(';'))
+
+
+class ClickHouseClient:
+
+    def __init__(self, connection, pool_size=8, timeout=default_timeout, settings=None, compress=True):
+        self.host = connection['host']
+        self.database_name = connection.get('database') or 'default'
+        self.database = escape(self.database_name)
+        self.timeout = timeout
+        self.settings = dict(settings or {})
+        self.compress = compress
+        self._server_timezone = None
+        self._types = collections.OrderedDict()
+        self._types_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+        # Учетные данные передаются заголовками, а не в URL - не попадают в логи прокси
+        if connection.get('user'):
+            self.session.headers['X-ClickHouse-User'] = connection['user']
+        if connection.get('password'):
+            self.session.headers['X-ClickHouse-Key'] = connection['password']
+        if compress:
+            self.session.headers['Accept-Encoding'] = 'gzip'
+
+    def _params(self, query, settings=None, external=None):
+        params = {'query': query.format(db=self.database), 'database': self.database_name}
+        if self.compress:
+            params['enable_http_compression'] = 1
+        params.update(self.settings)
+        params.update(settings or {})
+        # Запросы таска с замерами помечаются <dag_id>.<task_id> - для поиска в system.query_log
+        task_label = instrumentation.label()
+        if task_label:
+            params.setdefault('log_comment', task_label)
+        for name, (structure, _) in (external or {}).items():
+            params['{}_format'.format(name)] = 'CSV'
+            params['{}_structure'.format(name)] = structure
+        return params
+
+    def execute(self, query, data=None, settings=None, timeout=None, external=None, stream=False, headers=None):
+        files = {name: serialized for name, (_, serialized) in (external or {}).items()}
+        response = self.session.post(self.host, params=self._params(query, settings, external), data=data,
+                                     files=files or None, stream=stream, headers=headers,
+                                     timeout=timeout or self.timeout)
+        if response.status_code != 200:
+            raise ClickhouseException(response.content)
+        instrumentation.clickhouse_summary(response.headers.get('X-ClickHouse-Summary'))
+        return response
+
+    def read(self, query, settings=None, timeout=None, tables=None, index=True, **kwargs):
+        query, external = selection(query, tables=tables, index=index)
+        response = self.execute(query, settings=settings, timeout=timeout, external=external, stream=True)
+        # сжатый ответ распаковывается при чтении потока
+        response.raw.decode_content = True
+        try:
+            return to_dataframe(response.raw, **kwargs)
+        finally:
+            response.close()
+
+    # Имена и типы колонок результата без выполнения самого запроса
+    def describe(self, query, timeout=None):
+        description = self.read('DESCRIBE ({})'.format(query.strip().strip(';')), timeout=timeout)
+        return dict(zip(description['name'], description['type']))
+
+    # describe с кешем по query_shape: DESCRIBE выполняется один раз на вид запроса, а не перед каждым чтением
+    def result_types(self, query, timeout=None):
+        shape = query_shape(query)
+        with self._types_lock:
+            types = self._types.get(shape)
+            if types is not None:
+                self._types.move_to_end(shape)
+                return types
+        types = self.describe(query, timeout=timeout)
+        with self._types_lock:
+            self._types[shape] = types
+            if len(self._types) > describe_cache_size:
+                self._types.popitem(last=False)
+        return types
+
+    @property
+    def server_timezone(self):
+        if self._server_timezone is None:
+            self._server_timezone = self.read('SELECT timezone() AS tz')['tz'].iloc[0]
+        return self._server_timezone
+
+    # Чтение в формате ArrowStream: DataFrame собирается из буферов Arrow, без разбора текста в Python
+    def read_arrow(self, query, settings=None, timeout=None):
+        import pyarrow as pa
+
+        types = self.result_types(query, timeout=timeout)
+        query = '{} FORMAT ArrowStream'.format(query.strip().strip(';'))
+        response = self.execute(query, settings=dict(arrow_settings, **(settings or {})), timeout=timeout,
+                                stream=True)
+        response.raw.decode_content = True
+        try:
+            with pa.ipc.open_stream(response.raw) as reader:
+                table = reader.read_all()
+        finally:
+            response.close()
+        return arrow_to_pandas(table, types, self.server_timezone)
+
+    def insert(self, df, table, index=True, chunksize=1000, settings=None, timeout=None):
+        query, df = insertion(df, table, index=index)
+        for chunk in partition(df, chunksize=chunksize):
+            self.execute(query, data=to_csv(chunk), settings=settings, timeout=timeout)
+        return df.shape[0]
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Один клиент (и один пул соединений) на процесс для каждой пары host/database/user
+def get_client(connection=connection):
+    key = (connection['host'], connection.get('database'), connection.get('user'))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = ClickHouseClient(connection)
+        return client
+
+
+# schema - типы колонок результата (common/schemas.py), приводятся сразу после чтения
+def read_clickhouse(query, connection=connection, settings=None, timeout=None, format=None, schema=None, **kwargs):
+    client = get_client(connection)
+    instrumentation.add('clickhouse_queries', 1)
+    with instrumentation.timed('clickhouse'):
+        if (format or read_format) == 'arrow' and not kwargs:
+            df = client.read_arrow(query, settings=settings, timeout=timeout)
+        else:
+            df = client.read(query, settings=settings, timeout=timeout, **kwargs)
+    return enforce(df, schema) if schema else df
+
+
+def execute(query, connection=connection, settings=None, timeout=None, data=None):
+    instrumentation.add('clickhouse_queries', 1)
+    with instrumentation.timed('clickhouse'):
+        return get_client(connection).execute(query, data=data, settings=settings, timeout=timeout).content
+
+
+def to_clickhouse(df, table, index=True, chunksize=1000, connection=connection, settings=None, timeout=None):
+    instrumentation.add('clickhouse_queries', 1)
+    with instrumentation.timed('clickhouse'):
+        return get_client(connection).insert(df, table, index=index, chunksize=chunksize, settings=settings,
+                                             timeout=timeout)
+
+
+# Переносит результат SELECT с одного подключения в таблицу другого без разбора в Python: TSV ответа
+# (в том числе бинарные состояния агрегатных функций) уходит телом INSERT. Возвращает число строк
+def copy_rows(select, table, source_connection=connection, connection=connection):
+    rows = execute(select + ' FORMAT TabSeparated', connection=source_connection)
+    if rows:
+        execute('INSERT INTO {{db}}.{} FORMAT TabSeparated'.format(table), connection=connection, data=rows)
+    return rows.count(b'\n')
@@ -0,0 +1,57 @@
+import pandas as pd
+
+from common.schemas import align_categories
+
+
+# Метрики отчета в разрезах, которые суммируются по пользователям
+report_measures = ['views', 'likes', 'messages_received', 'messages_sent', 'users_received', 'users_sent']
+
+
+# Колонки итоговой таблицы отчета
+report_columns = ['event_date', 'dimension', 'dimension_value'] + report_measures
+
+
+# Объединяет поюзерные выгрузки ленты и мессенджера. Срезы остаются categorical, счетчики - nullable целыми
+def join_per_user(df_feed, df_mess, dimensions):
+    align_categories([df_feed, df_mess], dimensions)
+    return df_feed.merge(df_mess, how='outer', on=['user_id'] + dimensions + ['event_date'])
+
+
+# Единственный проход по поюзерным данным: группировка до самого мелкого зерна - все срезы сразу + дата.
+# Пустые значения срезов сохраняются (dropna=False), чтобы пользователь без пола не выпал из среза по ОС
+def partial_cube(merged_data, dimensions, measures=report_measures):
+    return merged_data.groupby(dimensions + ['event_date'], as_index=False, dropna=False, observed=True)[measures] \
+        .sum()
+
+
+# Сворачивает мелкое зерно в отдельные срезы - каждый срез считается по маленькой таблице,
+# а не по поюзерным данным
+def rollup_cube(partial, dimensions, measures=report_measures):
+    reports = []
+    for dimension in dimensions:
+        report = partial.groupby([dimension, 'event_date'], as_index=False, observed=True)[measures] \
+            .sum() \
+            .rename(columns = {dimension: 'dimension_value'})
+        report.insert(0, 'dimension', dimension)
+        reports.append(report)
+    return pd.concat(reports, axis=0, ignore_index=True)
+
+
+def build_cube(merged_data, dimensions, measures=report_measures):
+    return rollup_cube(partial_cube(merged_data, dimensions, measures), dimensions, measures)
+
+
+# Срезы, когда лента уже агрегирована до зерна (срезы, день) в предагрегате, а мессенджер - поюзерный.
+# Суммы по срезам складываются по частям: мессенджер сворачивается до того же зерна, обе части объединяются
+# и суммируются - результат тот же, что у build_cube(join_per_user(...))
+def build_cube_from_segments(feed_segments, df_mess, dimensions, measures=report_measures):
+    mess_partial = partial_cube(df_mess, dimensions, [measure for measure in measures if measure in df_mess])
+    align_categories([feed_segments, mess_partial], dimensions)
+    merged = feed_segments.merge(mess_partial, how='outer', on=dimensions + ['event_date'])
+    return build_cube(merged, dimensions, measures)
+
+
+# Приводит срезы к виду таблицы отчета: фиксированный порядок колонок. Счетчики уже целые -
+# выгрузки читаются по схемам с nullable целыми (common/schemas.py), и outer join не делает их float
+def format_report(cube):
+    return cube[report_columns]
@@ -0,0 +1,124 @@
+# Индекс первого появления пользователей (user_id -> первый день и источник) в ClickHouse.
+# Каждый запуск дописывает только новых пользователей отчетного дня, поэтому подсчет новых
+# пользователей не зависит от длины истории feed_actions. Дни добавляются по порядку: пропущенные
+# запуски (DAG без catchup) дописываются перед отчетным днем, при длинном пропуске индекс
+# пересобирается. После перезаливки истории пересборка запускается командой
+#   python -m common.first_seen rebuild
+import logging
+from datetime import timedelta
+
+from pandahouse.convert import partition
+
+from common import clickhouse as ch
+from common import schemas
+from common.clickhouse import connection, connection_test
+from common.loader import insert_dataframe
+from common.queries import as_date, day_users_query, days_list, first_seen_history_query
+
+
+log = logging.getLogger(__name__)
+
+# Пропуск длиннее этого числа дней не дописывается по дням, а закрывается полной пересборкой
+max_gap_days = 31
+
+
+class FirstSeenIndex:
+
+    # ReplacingMergeTree схлопывает повторную вставку того же дня при перезапуске таска
+    ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+        (user_id UInt32,
+         first_day Date,
+         source String)
+        ENGINE = ReplacingMergeTree()
+        PARTITION BY toYYYYMM(first_day)
+        ORDER BY (first_day, user_id)'''
+
+    def __init__(self, table='kozhevatov_first_seen', connection=connection_test, source_connection=connection,
+                 block_size=500000):
+        self.table = table
+        self.connection = connection
+        self.source_connection = source_connection
+        self.block_size = block_size
+
+    def ensure_table(self):
+        ch.execute(self.ddl.format(table=self.table), connection=self.connection)
+
+    # Последний день в индексе (None, если индекс пуст)
+    def last_day(self):
+        self.ensure_table()
+        last = ch.read_clickhouse('SELECT count() AS rows, max(first_day) AS last_day FROM {{db}}.{}'.format(self.table),
+                                  connection=self.connection, format='tsv')
+        if int(last['rows'].iloc[0]) == 0:
+            return None
+        return as_date(last['last_day'].iloc[0])
+
+    # Добавляет пользователей, впервые появившихся в день day. Индекс должен заканчиваться днем day - 1:
+    # пропущенные дни сначала дописываются по порядку, иначе у их новых пользователей first_day оказался бы
+    # позже настоящего. Пустой индекс или длинный пропуск - полная пересборка. Уже записанный день
+    # (перезапуск таска) не меняется, возвращается число его новых пользователей
+    def update(self, day):
+        day = as_date(day)
+        last = self.last_day()
+        if last is not None and last >= day:
+            log.info('%s: %s is already indexed (last day %s)', self.table, day, last)
+            return int(self.new_users([day])['cnt_dis'].sum())
+        if last is None or (day - last).days > max_gap_days:
+            log.warning('%s: last day %s, updating %s - rebuilding the index', self.table, last, day)
+            return self.rebuild(day)
+        for gap in range((day - last).days - 1, 0, -1):
+            log.warning('%s: day %s is missing, adding it before %s', self.table, day - timedelta(days=gap), day)
+            self.add_day(day - timedelta(days=gap))
+        return self.add_day(day)
+
+    # Пользователи дня day: активные за день минус уже известные раньше
+    def add_day(self, day):
+        active = ch.read_clickhouse(day_users_query(day), connection=self.source_connection,
+                                    schema=schemas.day_users)
+        known = ch.read_clickhouse('''SELECT user_id FROM {{db}}.{table}
+                                      WHERE first_day < toDate('{day}') AND user_id IN active_users'''.format(
+                                          table=self.table, day=day),
+                                   connection=self.connection, tables={'active_users': active[['user_id']]},
+                                   index=False)
+        new_users = active[~active['user_id'].isin(known['user_id'])]
+        new_users = new_users.assign(first_day=day.isoformat())[['user_id', 'first_day', 'source']]
+        if not new_users.empty:
+            insert_dataframe(new_users, self.table, connection=self.connection)
+        log.info('%s: %s active users on %s, %s new', self.table, len(active), day, len(new_users))
+        return len(new_users)
+
+    # Полная пересборка индекса по всей истории до дня until включительно. Индекс собирается в <table>_new
+    # и подменяет текущий через EXCHANGE TABLES: при сбое посередине рабочий индекс остается прежним,
+    # а не частично заполненным (иначе повтор таска принял бы день за уже записанный)
+    def rebuild(self, until):
+        self.ensure_table()
+        target = self.table + '_new'
+        ch.execute('DROP TABLE IF EXISTS {{db}}.{}'.format(target), connection=self.connection)
+        ch.execute(self.ddl.format(table=target), connection=self.connection)
+        history = ch.read_clickhouse(first_seen_history_query(until), connection=self.source_connection,
+                                     schema=schemas.first_seen_history)
+        for block in partition(history, chunksize=self.block_size):
+            insert_dataframe(block, target, connection=self.connection)
+        ch.execute('EXCHANGE TABLES {{db}}.{} AND {{db}}.{}'.format(self.table, target), connection=self.connection)
+        ch.execute('DROP TABLE {{db}}.{}'.format(target), connection=self.connection)
+        log.info('%s: rebuilt with %s users up to %s', self.table, len(history), as_date(until))
+        return len(history)
+
+    # Число новых пользователей по источникам за указанные дни
+    def new_users(self, days):
+        return ch.read_clickhouse('''SELECT first_day AS timestamp, source, count() AS cnt_dis
+                                     FROM {{db}}.{table} FINAL
+                                     WHERE first_day IN ({days})
+                                     GROUP BY source, timestamp'''.format(table=self.table, days=days_list(days)),
+                                  connection=self.connection, schema=schemas.new_users)
+
+
+if __name__ == '__main__':
+    import argparse
+    from datetime import date
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rebuild', 'update'])
+    parser.add_argument('day', nargs='?', default=str(date.today() - timedelta(days=1)))
+    args = parser.parse_args()
+    index = FirstSeenIndex()
+    print(index.rebuild(args.day) if args.command == 'rebuild' else index.update(args.day))
@@ -0,0 +1,40 @@
+import os
+import uuid
+
+import pyarrow as pa
+
+
+# Каталог, в котором лежат DataFrame-ы, переданные между тасками. Для нескольких воркеров
+# это должен быть общий каталог (NFS / общий volume)
+frame_store_dir = os.environ.get('XCOM_ARROW_DIR', '/tmp/airflow_xcom')
+
+
+def frame_path(*parts):
+    name = '__'.join(str(part) for part in parts if part is not None)
+    return os.path.join(frame_store_dir, name.replace(os.sep, '_') + '.arrow')
+
+
+# Пишет DataFrame в файл Arrow IPC без сжатия: такой файл читается через mmap без копирования буферов.
+# Запись идет во временный файл и атомарно переименовывается, чтобы ретрай таска не оставил половину файла
+def write_frame(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+# Читает DataFrame через memory map: числовые колонки без пропусков остаются видами на страницы файла,
+# поэтому каждый потребитель не держит в памяти свою копию
+def read_frame(path):
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def remove_frame(path):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,309 @@
+# Замеры тасков: декоратор instrumented вокруг функции @task записывает время (wall и CPU), пиковый RSS,
+# объем DataFrame и размер XCom результата, а вызовы ClickHouse и Телеграма внутри таска добавляют к замеру
+# число запросов, строки и байты из заголовка X-ClickHouse-Summary и задержку отправки сообщений.
+# Каждый запрос таска помечается log_comment = <dag_id>.<task_id>, по нему его можно найти в system.query_log.
+# Замер по завершении таска уходит в приемники из METRICS_SINK (через запятую):
+#   log        - строка в лог таска (по умолчанию)
+#   prometheus - файл <dag>.<task>.prom в METRICS_TEXTFILE_DIR для textfile collector node_exporter
+#   statsd     - UDP-пакеты на STATSD_HOST:STATSD_PORT
+#   clickhouse - строка в test.kozhevatov_task_metrics
+# Модуль импортируется DAG-файлами при разборе, поэтому использует только стандартную библиотеку
+import functools
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+log = logging.getLogger(__name__)
+
+metrics_sinks = [sink.strip() for sink in os.environ.get('METRICS_SINK', 'log').split(',') if sink.strip()]
+textfile_dir = os.environ.get('METRICS_TEXTFILE_DIR', '/var/lib/node_exporter/textfile')
+statsd_address = (os.environ.get('STATSD_HOST', 'localhost'), int(os.environ.get('STATSD_PORT', '8125')))
+statsd_prefix = 'airflow.task'
+metrics_table = 'kozhevatov_task_metrics'
+
+# Интервал опроса RSS во время таска, секунды
+rss_interval = 0.05
+
+# Колонки замера: имя, тип ClickHouse, единица для StatsD (ms - время, g - значение)
+fields = [
+    ('wall_s', 'Float64', 'ms'),
+    ('cpu_s', 'Float64', 'ms'),
+    ('peak_rss_bytes', 'UInt64', 'g'),
+    ('rss_growth_bytes', 'Int64', 'g'),
+    ('dataframe_bytes', 'UInt64', 'g'),
+    ('xcom_bytes', 'UInt64', 'g'),
+    ('clickhouse_queries', 'UInt32', 'g'),
+    ('clickhouse_s', 'Float64', 'ms'),
+    ('clickhouse_read_rows', 'UInt64', 'g'),
+    ('clickhouse_read_bytes', 'UInt64', 'g'),
+    ('clickhouse_written_rows', 'UInt64', 'g'),
+    ('telegram_calls', 'UInt32', 'g'),
+    ('telegram_s', 'Float64', 'ms'),
+    ('telegram_max_s', 'Float64', 'ms'),
+    ('chart_s', 'Float64', 'ms'),
+]
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Пиковый RSS во время выполнения функции: фоновый поток опрашивает RSS каждые interval секунд
+class PeakRss:
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.start = current_rss()
+        self.peak = self.start
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+# Замер текущего таска. Вызовы клиентов добавляют в него счетчики через add / clickhouse_summary;
+# вне instrumented замера нет и эти функции ничего не делают
+_local = threading.local()
+
+
+def current():
+    return getattr(_local, 'record', None)
+
+
+def label():
+    record = current()
+    return None if record is None else '{}.{}'.format(record['dag_id'], record['task_id'])
+
+
+def add(name, value):
+    record = current()
+    if record is not None:
+        record[name] = record.get(name, 0) + value
+
+
+# Время блока кода в счетчике <name>_s: with timed('chart'): ...
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name + '_s', time.perf_counter() - start)
+
+
+# Заголовок X-ClickHouse-Summary: {"read_rows": "...", "read_bytes": "...", "written_rows": "...", ...}.
+# Для потоковых ответов заголовок отправляется до конца запроса, счетчики в нем могут быть неполными -
+# точные значения в system.query_log по log_comment
+def clickhouse_summary(header):
+    if current() is None or not header:
+        return
+    try:
+        summary = json.loads(header)
+    except ValueError:
+        return
+    add('clickhouse_read_rows', int(summary.get('read_rows', 0)))
+    add('clickhouse_read_bytes', int(summary.get('read_bytes', 0)))
+    add('clickhouse_written_rows', int(summary.get('written_rows', 0)))
+
+
+def telegram_call(latency):
+    record = current()
+    if record is not None:
+        add('telegram_calls', 1)
+        add('telegram_s', latency)
+        record['telegram_max_s'] = max(record.get('telegram_max_s', 0), latency)
+
+
+# Объем результата таска: память DataFrame (pandas не импортируется - проверяется по методу) и размер XCom.
+# DataFrame через ArrowXComBackend пишется в файл, его размер пишет сам backend (xcom_bytes у замера таска
+# остается 0); остальные значения хранятся в метабазе как JSON
+def result_size(value):
+    frames = value if isinstance(value, (list, tuple)) else [value]
+    if frames and all(hasattr(frame, 'memory_usage') and hasattr(frame, 'columns') for frame in frames):
+        return int(sum(frame.memory_usage(deep=True).sum() for frame in frames)), 0
+    if value is None:
+        return 0, 0
+    try:
+        return 0, len(json.dumps(value, default=str).encode())
+    except (TypeError, ValueError):
+        return 0, 0
+
+
+def _context_labels(func):
+    try:
+        from airflow.operators.python import get_current_context
+        context = get_current_context()
+        ti = context['ti']
+        return {'dag_id': ti.dag_id, 'task_id': ti.task_id, 'run_id': ti.run_id,
+                'map_index': getattr(ti, 'map_index', -1)}
+    except Exception:
+        return {'dag_id': func.__module__.rsplit('.', 1)[-1], 'task_id': func.__name__, 'run_id': '',
+                'map_index': -1}
+
+
+# Декоратор для функций @task (ставится под @task, сигнатура сохраняется - Airflow по-прежнему
+# подставляет ds, params и т.п.). Замер отправляется и при ошибке таска, с status = failed
+def instrumented(func):
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current() is not None:
+            return func(*args, **kwargs)
+        record = _local.record = dict(_context_labels(func), status='success')
+        status = 'failed'
+        try:
+            with PeakRss(rss_interval) as rss:
+                cpu = time.process_time()
+                start = time.perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    record['wall_s'] = time.perf_counter() - start
+                    record['cpu_s'] = time.process_time() - cpu
+            record['dataframe_bytes'], record['xcom_bytes'] = result_size(result)
+            status = 'success'
+            return result
+        finally:
+            _local.record = None
+            record['status'] = status
+            record['peak_rss_bytes'] = rss.peak
+            record['rss_growth_bytes'] = rss.peak - rss.start
+            emit(record)
+
+    return wrapper
+
+
+def _statsd_name(value):
+    return str(value).replace('.', '_').replace(':', '_').replace('|', '_')
+
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def to_log(record):
+    log.info('task metrics %s.%s: %s', record['dag_id'], record['task_id'],
+             ', '.join('{}={}'.format(name, round(record.get(name, 0), 3)) for name, _, _ in fields))
+
+
+# Textfile collector: один файл на таск, перезаписывается атомарно - в Prometheus всегда последний запуск
+def to_prometheus(record):
+    labels = 'dag_id="{}",task_id="{}",status="{}"'.format(_prometheus_label(record['dag_id']),
+                                                           _prometheus_label(record['task_id']), record['status'])
+    lines = []
+    for name, _, _ in fields + [('finished_timestamp', None, None)]:
+        metric = 'airflow_task_' + (name[:-2] + '_seconds' if name.endswith('_s') else name)
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.append('{}{{{}}} {}'.format(metric, labels, record.get(name, 0)))
+    os.makedirs(textfile_dir, exist_ok=True)
+    path = os.path.join(textfile_dir, '{}.{}.prom'.format(record['dag_id'], record['task_id']))
+    with open('{}.{}.tmp'.format(path, os.getpid()), 'w') as output:
+        output.write('\n'.join(lines) + '\n')
+    os.replace('{}.{}.tmp'.format(path, os.getpid()), path)
+
+
+def to_statsd(record):
+    prefix = '{}.{}.{}'.format(statsd_prefix, _statsd_name(record['dag_id']), _statsd_name(record['task_id']))
+    packets = ['{}.{}:1|c'.format(prefix, record['status'])]
+    for name, _, kind in fields:
+        value = record.get(name, 0)
+        if kind == 'ms':
+            packets.append('{}.{}:{:.3f}|ms'.format(prefix, name[:-2], value * 1000))
+        else:
+            packets.append('{}.{}:{}|g'.format(prefix, name, value))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for packet in packets:
+            sock.sendto(packet.encode(), statsd_address)
+    finally:
+        sock.close()
+
+
+table_ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+    (finished_at DateTime,
+     dag_id LowCardinality(String),
+     task_id LowCardinality(String),
+     run_id String,
+     map_index Int32,
+     status LowCardinality(String),
+     {columns})
+    ENGINE = MergeTree()
+    PARTITION BY toYYYYMM(finished_at)
+    ORDER BY (dag_id, task_id, finished_at)
+    TTL finished_at + INTERVAL 180 DAY'''
+
+
+def to_clickhouse(record):
+    from common import clickhouse as ch
+    from common.clickhouse import connection_test
+
+    ch.execute(table_ddl.format(table=metrics_table,
+                                columns=',\n     '.join('{} {}'.format(name, chtype) for name, chtype, _ in fields)),
+               connection=connection_test)
+    row = {name: record.get(name, 0) for name, _, _ in fields}
+    row.update({key: record[key] for key in ['dag_id', 'task_id', 'run_id', 'map_index', 'status']},
+               finished_at=datetime.fromtimestamp(record['finished_timestamp']).strftime('%Y-%m-%d %H:%M:%S'))
+    ch.execute('INSERT INTO {{db}}.{} FORMAT JSONEachRow'.format(metrics_table), connection=connection_test,
+               data=json.dumps(row).encode())
+
+
+sinks = {'log': to_log, 'prometheus': to_prometheus, 'statsd': to_statsd, 'clickhouse': to_clickhouse}
+
+
+# Отправка замера во все приемники. Ошибка приемника пишется в лог и не роняет таск
+def emit(record):
+    record.setdefault('finished_timestamp', time.time())
+    for name in metrics_sinks:
+        try:
+            sinks[name](record)
+        except Exception as error:
+            log.warning('metrics sink %s failed: %s', name, error)
+
+
+# Размер XCom, который ArrowXComBackend пишет в файл, а не в метабазу: известен только после завершения
+# функции таска, поэтому отправляется отдельной метрикой xcom_file_bytes (в Prometheus - отдельным файлом)
+def report_xcom(dag_id, task_id, size):
+    for name in metrics_sinks:
+        try:
+            if name == 'prometheus':
+                os.makedirs(textfile_dir, exist_ok=True)
+                path = os.path.join(textfile_dir, '{}.{}.xcom.prom'.format(dag_id, task_id))
+                with open('{}.{}.tmp'.format(path, os.getpid()), 'w') as output:
+                    output.write('# TYPE airflow_task_xcom_file_bytes gauge\n'
+                                 'airflow_task_xcom_file_bytes{{dag_id="{}",task_id="{}"}} {}\n'.format(
+                                     _prometheus_label(dag_id), _prometheus_label(task_id), size))
+                os.replace('{}.{}.tmp'.format(path, os.getpid()), path)
+            elif name == 'statsd':
+                packet = '{}.{}.{}.xcom_file_bytes:{}|g'.format(statsd_prefix, _statsd_name(dag_id),
+                                                               _statsd_name(task_id), size)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    sock.sendto(packet.encode(), statsd_address)
+                finally:
+                    sock.close()
+        except Exception as error:
+            log.warning('metrics sink %s failed: %s', name, error)
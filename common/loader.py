@@ -0,0 +1,171 @@
+# Идемпотентная загрузка отчетов в ClickHouse.
+# Таблица отчета партиционирована по event_date (ReplacingMergeTree), данные дня сначала
+# параллельно заливаются сжатыми блоками во вспомогательную таблицу этого дня, затем партиция дня атомарно
+# подменяется через REPLACE PARTITION - ретрай или перезапуск таска не создает дублей.
+# Таблица старого формата (MergeTree без партиций) при первой загрузке переносится в новую автоматически,
+# заранее перенос запускается так: python -m common.loader migrate kozhevatov_dag
+import gzip
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from pandahouse.convert import partition, to_csv
+from pandahouse.utils import escape
+
+from common.clickhouse import connection_test, get_client
+
+
+log = logging.getLogger(__name__)
+
+
+# Колонки таблицы test.kozhevatov_dag
+report_table_columns = '''
+    event_date Date,
+    dimension String,
+    dimension_value String,
+    views Int32,
+    likes Int32,
+    messages_received Int32,
+    messages_sent Int32,
+    users_received Int32,
+    users_sent Int32'''
+
+
+# Имена колонок из описания вида "name Type, ..."
+def column_names(columns):
+    return [column.split()[0] for column in columns.split(',') if column.strip()]
+
+
+# CSV блока для вставки. Даты без времени пишутся как YYYY-MM-DD (колонка Date), categorical - как строки
+def block_to_csv(block):
+    block = block.copy()
+    for column in block.columns:
+        values = block[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            date_only = (values == values.dt.normalize()).all()
+            block[column] = values.dt.strftime('%Y-%m-%d' if date_only else '%Y-%m-%d %H:%M:%S')
+        elif isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values):
+            block[column] = values.astype(object)
+    return to_csv(block)
+
+
+# Простая вставка DataFrame одним запросом (для небольших служебных таблиц)
+def insert_dataframe(df, table, connection=connection_test):
+    query = 'INSERT INTO {{db}}.{} ({}) FORMAT CSV'.format(escape(table), ', '.join(map(escape, df.columns)))
+    get_client(connection).execute(query, data=block_to_csv(df))
+    return len(df)
+
+
+class ReportLoader:
+
+    ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+        ({columns},
+         loaded_at DateTime DEFAULT now())
+        ENGINE = ReplacingMergeTree(loaded_at)
+        PARTITION BY event_date
+        ORDER BY ({order_by})
+        SETTINGS non_replicated_deduplication_window = 1000'''
+
+    def __init__(self, table, columns=report_table_columns, order_by=('event_date', 'dimension', 'dimension_value'),
+                 connection=connection_test, block_size=100000, parallel=4, compress=True):
+        self.table = table
+        self.columns = columns
+        self.order_by = order_by
+        self.client = get_client(connection)
+        self.block_size = block_size
+        self.parallel = parallel
+        self.compress = compress
+
+    def ensure_table(self):
+        self.client.execute(self.ddl.format(table=self.table, columns=self.columns,
+                                            order_by=', '.join(self.order_by)))
+        partition_key = self.client.read('''SELECT partition_key FROM system.tables
+                                            WHERE database = currentDatabase() AND name = '{}' '''.format(self.table))
+        if partition_key.empty or partition_key['partition_key'].iloc[0] != 'event_date':
+            self.migrate()
+
+    # Разовый перенос таблицы без PARTITION BY event_date: строки копируются в новую партиционированную
+    # таблицу (INSERT ... SELECT), затем таблицы атомарно меняются местами (EXCHANGE TABLES). Дубли старых
+    # дозаписей схлопываются ReplacingMergeTree по ключу (день, срез). Старая таблица остается
+    # как {table}_unpartitioned; после сбоя перенос начинается заново
+    def migrate(self):
+        target = self.table + '_migration'
+        backup = self.table + '_unpartitioned'
+        exists = self.client.read('''SELECT count() AS tables FROM system.tables
+                                     WHERE database = currentDatabase() AND name = '{}' '''.format(backup))
+        if int(exists['tables'].iloc[0]):
+            raise ValueError('Table {} already exists; drop it before migrating {}'.format(backup, self.table))
+        columns = ', '.join(map(escape, column_names(self.columns)))
+        self.client.execute('DROP TABLE IF EXISTS {{db}}.{}'.format(target))
+        self.client.execute(self.ddl.format(table=target, columns=self.columns, order_by=', '.join(self.order_by)))
+        self.client.execute('INSERT INTO {{db}}.{target} ({columns}) SELECT {columns} FROM {{db}}.{table}'.format(
+            target=target, columns=columns, table=self.table))
+        self.client.execute('EXCHANGE TABLES {{db}}.{} AND {{db}}.{}'.format(self.table, target))
+        self.client.execute('RENAME TABLE {{db}}.{} TO {{db}}.{}'.format(target, backup))
+        log.info('%s: migrated to PARTITION BY event_date, old table kept as %s', self.table, backup)
+
+    # Один блок вставки. Токен дедупликации зависит от таблицы, дня, номера и содержимого блока:
+    # повторная отправка того же блока (ретрай HTTP или таска) не вставит строки второй раз
+    def _insert_block(self, query, staging, day, number, block):
+        payload = block_to_csv(block)
+        token = '{}:{}:{}:{}'.format(staging, day, number, hashlib.md5(payload).hexdigest())
+        headers = None
+        if self.compress:
+            payload = gzip.compress(payload, compresslevel=1)
+            headers = {'Content-Encoding': 'gzip'}
+        self.client.execute(query, data=payload, headers=headers,
+                            settings={'insert_deduplicate': 1, 'insert_deduplication_token': token})
+        return len(block)
+
+    # Вспомогательная таблица своя у каждого дня: маппированные таски перерасчета грузят дни параллельно
+    # и не должны подменять и удалять партиции друг друга
+    def staging(self, day):
+        return '{}_staging_{}'.format(self.table, day.replace('-', ''))
+
+    def load_day(self, day, df):
+        staging = self.staging(day)
+        query = 'INSERT INTO {{db}}.{} ({}) FORMAT CSV'.format(escape(staging), ', '.join(map(escape, df.columns)))
+        self.client.execute('CREATE TABLE IF NOT EXISTS {{db}}.{} AS {{db}}.{}'.format(staging, self.table))
+        self.client.execute("ALTER TABLE {{db}}.{} DROP PARTITION '{}'".format(staging, day))
+        blocks = list(partition(df, chunksize=self.block_size))
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            rows = sum(pool.map(lambda item: self._insert_block(query, staging, day, *item), enumerate(blocks)))
+        self.client.execute("ALTER TABLE {{db}}.{table} REPLACE PARTITION '{day}' FROM {{db}}.{staging}".format(
+            table=self.table, day=day, staging=staging))
+        self.client.execute('DROP TABLE {{db}}.{}'.format(staging))
+        return rows
+
+    # День, за который отчет стал пустым (данные перезалиты): его старая партиция удаляется
+    def drop_day(self, day):
+        self.client.execute("ALTER TABLE {{db}}.{} DROP PARTITION '{}'".format(self.table, day))
+        log.info('%s: no rows for %s, partition dropped', self.table, day)
+
+    # Загружает DataFrame, заменяя целиком партиции всех дней, которые в нем есть. days - дни, которые
+    # загрузка покрывает: если строк за такой день нет, его партиция удаляется, а не остается от прошлой загрузки
+    def load(self, df, days=()):
+        self.ensure_table()
+        start = time.perf_counter()
+        rows = 0
+        loaded = set()
+        for day, day_df in df.groupby(df['event_date'].astype(str).str[:10]):
+            rows += self.load_day(day, day_df)
+            loaded.add(day)
+        for day in sorted({str(day)[:10] for day in days} - loaded):
+            self.drop_day(day)
+        elapsed = time.perf_counter() - start
+        log.info('%s: loaded %s rows in %.3f s (%.0f rows/sec)', self.table, rows, elapsed,
+                 rows / elapsed if elapsed else 0)
+        return {'rows': rows, 'seconds': elapsed, 'rows_per_sec': rows / elapsed if elapsed else 0}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('table')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ReportLoader(args.table).ensure_table()
@@ -0,0 +1,131 @@
+# Хранилище дневных метрик приложения (DAU, просмотры, лайки, CTR, сообщения) в ClickHouse.
+# Каждый день агрегируется из feed_actions / message_actions один раз, дальнейшие сравнения
+# "неделю назад" / "месяц назад" в отчетах - чтение нескольких строк из маленькой таблицы
+import logging
+
+import pandas as pd
+
+from common import clickhouse as ch
+from common.clickhouse import connection, connection_test
+from common.loader import insert_dataframe
+from common.migrations import Migrations
+from common.queries import (app_metrics_query, as_date, daily_events_query, days_list, preaggregated_app_metrics_query,
+                            preaggregates_enabled, uniq_mode)
+
+
+log = logging.getLogger(__name__)
+
+metrics_columns = ['dau', 'views', 'likes', 'ctr', 'messages']
+
+
+class DailyMetricsStore:
+
+    ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+        (day Date,
+         dau UInt64,
+         views UInt64,
+         likes UInt64,
+         ctr Float64,
+         messages UInt64,
+         events UInt64,
+         computed_at DateTime DEFAULT now())
+        ENGINE = ReplacingMergeTree(computed_at)
+        ORDER BY day'''
+
+    def __init__(self, table='kozhevatov_daily_metrics', connection=connection_test, source_connection=connection,
+                 preaggregated=preaggregates_enabled, sketches=None):
+        self.table = table
+        self.connection = connection
+        self.source_connection = source_connection
+        # Новые дни считаются из дневных предагрегатов в схеме test (common/migrations.py), а не из сырых таблиц -
+        # только когда их миграции в статусе ready
+        self.preaggregated = preaggregated and Migrations(connection=connection, source_connection=source_connection) \
+            .ready(['kozhevatov_feed_daily', 'kozhevatov_messages_daily'])
+        # При UNIQ_MODE=approx DAU новых дней - слияние сохраненных состояний uniqCombined (common/sketches.py),
+        # из сырых таблиц считаются только счетчики
+        if sketches is None and uniq_mode == 'approx':
+            from common.sketches import UniqSketchStore
+            sketches = UniqSketchStore()
+        self.sketches = sketches
+        self._table_ready = False
+
+    def ensure_table(self):
+        if not self._table_ready:
+            ch.execute(self.ddl.format(table=self.table), connection=self.connection)
+            self._table_ready = True
+
+    def cached(self, days):
+        self.ensure_table()
+        return ch.read_clickhouse('''SELECT day, {columns}, events FROM {{db}}.{table} FINAL
+                                     WHERE day IN ({days})'''.format(columns=', '.join(metrics_columns),
+                                                                     table=self.table, days=days_list(days)),
+                                  connection=self.connection)
+
+    # Считает дни из сырых таблиц и сохраняет: строка с более поздним computed_at заменяет старую
+    def compute(self, days):
+        if self.preaggregated:
+            computed = ch.read_clickhouse(preaggregated_app_metrics_query(days), connection=self.connection)
+        elif self.sketches is not None:
+            computed = ch.read_clickhouse(app_metrics_query(days, dau=False), connection=self.source_connection)
+            self.sketches.ensure_days(days)
+            dau = self.sketches.dau(days)
+            computed['dau'] = computed['day'].map(as_date).map(dict(zip(dau['day'].map(as_date), dau['dau'])))
+        else:
+            computed = ch.read_clickhouse(app_metrics_query(days), connection=self.source_connection)
+        computed['events'] = computed['feed_events'] + computed['messages']
+        computed = computed[['day'] + metrics_columns + ['events']]
+        if not computed.empty:
+            insert_dataframe(computed, self.table, connection=self.connection)
+        log.info('%s: computed %s day(s) from raw events: %s', self.table, len(computed),
+                 ', '.join(str(as_date(day)) for day in computed['day']))
+        return computed
+
+    # Дни, данные которых поменялись после расчета (сверка числа событий за день)
+    def restated(self, cached):
+        if cached.empty:
+            return []
+        events = ch.read_clickhouse(daily_events_query(cached['day']), connection=self.source_connection)
+        current = dict(zip(events['day'].map(as_date), events['events']))
+        return [day for day, stored in zip(cached['day'].map(as_date), cached['events'])
+                if current.get(day, 0) != stored]
+
+    # Метрики за указанные дни: из хранилища, а отсутствующие (или переданные в refresh) -
+    # из сырых таблиц. validate=True дополнительно пересчитывает дни, в которых изменилось число событий
+    def get(self, days, refresh=(), validate=False):
+        days = sorted({as_date(day) for day in days})
+        refresh = {as_date(day) for day in refresh}
+        cached = self.cached(days)
+        cached = cached[~cached['day'].map(as_date).isin(refresh)]
+        stale = set(self.restated(cached)) if validate else set()
+        cached = cached[~cached['day'].map(as_date).isin(stale)]
+        missing = [day for day in days if day not in set(cached['day'].map(as_date))]
+        self._rebuild_sketches(refresh | stale)
+        frames = [cached]
+        if missing:
+            frames.append(self.compute(missing))
+        result = pd.concat(frames, ignore_index=True)
+        return result.sort_values('day').reset_index(drop=True)
+
+    # Пересчет дней, по которым данные были перезалиты
+    def invalidate(self, days):
+        days = sorted({as_date(day) for day in days})
+        self._rebuild_sketches(days)
+        return self.compute(days)
+
+    # Состояния uniqCombined перезалитых дней тоже устарели - они загружаются заново
+    def _rebuild_sketches(self, days):
+        if self.sketches is None:
+            return
+        for day in sorted(days):
+            self.sketches.rebuild(day)
+
+
+# Пересчет перезалитых дней: python -m common.metrics_store invalidate 2023-03-20 2023-03-21
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['invalidate'])
+    parser.add_argument('days', nargs='+')
+    args = parser.parse_args()
+    print(DailyMetricsStore().invalidate(args.days))
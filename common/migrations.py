@@ -0,0 +1,296 @@
+# Предагрегаты в ClickHouse, которыми управляет проект: таблицы AggregatingMergeTree в схеме test и
+# материализованные представления над feed_actions / message_actions источника, которые дописывают в них
+# каждую новую вставку. Алерты и отчеты при USE_PREAGGREGATES=1 читают эти таблицы вместо сырых событий:
+#   kozhevatov_feed_15m       - 15-минутные бакеты ленты: uniqExactState(user_id), просмотры, лайки
+#   kozhevatov_feed_daily     - день x (os, gender, age, source): uniqExactState(user_id), просмотры, лайки, события
+#   kozhevatov_messages_daily - день x (os, gender, age, source): сообщения
+#
+# Порядок включения: apply создает таблицу и представление, которое берет только события с time >= cutoff
+# (по умолчанию начало следующего часа по часам сервера), затем, когда cutoff пройдет, backfill по дням заливает
+# историю time < cutoff. Так ни одно событие не считается дважды. cutoff и момент начала backfill считаются по
+# now() сервера источника: колонку time пишет он, а часы воркера могут отставать или идти в другом поясе. Состояние каждой миграции (версия, cutoff, докуда
+# залита история) хранится в test.kozhevatov_migrations: прерванный backfill продолжается со следующего дня.
+# Читатели при USE_PREAGGREGATES=1 берут предагрегат, только когда его миграция в статусе ready (Migrations.ready),
+# до этого - сырые таблицы.
+# Изменение определения - новая версия, применяется через reset (удаление таблицы и представления и apply).
+# Представление должно быть на том же сервере, что и источник (таблицы в другой базе - можно).
+#   python -m common.migrations status
+#   python -m common.migrations apply
+#   python -m common.migrations backfill --wait
+# Проверка на локальном clickhouse-server и сравнение прочитанных строк: python -m benchmarks.bench_preagg
+import logging
+import time
+from datetime import datetime, timedelta
+
+from pandahouse.utils import escape
+
+from common import clickhouse as ch
+from common.clickhouse import connection, connection_test
+
+
+log = logging.getLogger(__name__)
+
+migrations_table = 'kozhevatov_migrations'
+
+# Запас после cutoff перед началом backfill: события с time < cutoff, которые еще доезжают в источник
+backfill_settle = timedelta(minutes=10)
+
+# Сколько последних вставок таблица помнит для дедупликации по insert_deduplication_token: повтор дня backfill
+# после сбоя отбрасывается. Вставки представления не дедуплицируются (deduplicate_blocks_in_dependent_materialized_views
+# по умолчанию выключен) и это окно не занимают
+deduplication_window = 1000
+
+segment_columns = '''os LowCardinality(String),
+         gender Int8,
+         age Int16,
+         source LowCardinality(String)'''
+
+# Типы колонок источника приводятся к колонкам таблицы при вставке (по именам)
+segment_select = 'os, gender, age, source'
+
+
+class PreAggregate:
+
+    ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{name}
+        ({columns})
+        ENGINE = AggregatingMergeTree()
+        PARTITION BY toYYYYMM({time_key})
+        ORDER BY ({order_by})
+        SETTINGS non_replicated_deduplication_window = {window}'''
+
+    # Для таблиц, созданных до появления окна дедупликации
+    window_ddl = 'ALTER TABLE {{db}}.{name} MODIFY SETTING non_replicated_deduplication_window = {window}'
+
+    view_ddl = '''CREATE MATERIALIZED VIEW IF NOT EXISTS {{db}}.{name}_mv TO {{db}}.{name} AS {select}'''
+
+    # select - агрегирующий SELECT по {source} с условием {where} на колонку time
+    def __init__(self, name, version, columns, order_by, select, time_key, source_table):
+        self.name = name
+        self.version = version
+        self.columns = columns
+        self.order_by = order_by
+        self.select = select
+        self.time_key = time_key
+        self.source_table = source_table
+
+    def render_select(self, source, where):
+        return self.select.format(source='{}.{}'.format(source, self.source_table), where=where)
+
+    def create_statements(self, source, cutoff):
+        return [self.ddl.format(name=self.name, columns=self.columns, time_key=self.time_key,
+                                order_by=', '.join(self.order_by), window=deduplication_window),
+                self.view_ddl.format(name=self.name,
+                                     select=self.render_select(source, "time >= toDateTime('{}')".format(cutoff)))]
+
+    def drop_statements(self):
+        return ['DROP VIEW IF EXISTS {{db}}.{}_mv'.format(self.name),
+                'DROP TABLE IF EXISTS {{db}}.{}'.format(self.name)]
+
+    # Токен дедупликации вставки истории за [start, end): повтор той же вставки таблица отбрасывает
+    def deduplication_token(self, start, end):
+        return '{}:v{}:{}:{}'.format(self.name, self.version, start, end)
+
+    def backfill_statement(self, source, start, end):
+        return 'INSERT INTO {{db}}.{name} {select}'.format(
+            name=self.name, select=self.render_select(
+                source, "time >= toDateTime('{}') AND time < toDateTime('{}')".format(start, end)))
+
+
+preaggregates = [
+    PreAggregate('kozhevatov_feed_15m', 1, '''ts DateTime,
+         users AggregateFunction(uniqExact, UInt32),
+         views SimpleAggregateFunction(sum, UInt64),
+         likes SimpleAggregateFunction(sum, UInt64)''', ['ts'], '''
+        SELECT toStartOfFifteenMinutes(time) AS ts,
+               uniqExactState(toUInt32(user_id)) AS users,
+               toUInt64(countIf(action = 'view')) AS views,
+               toUInt64(countIf(action = 'like')) AS likes
+        FROM {source}
+        WHERE {where}
+        GROUP BY ts''', 'ts', 'feed_actions'),
+    PreAggregate('kozhevatov_feed_daily', 1, '''day Date,
+         {segments},
+         users AggregateFunction(uniqExact, UInt32),
+         views SimpleAggregateFunction(sum, UInt64),
+         likes SimpleAggregateFunction(sum, UInt64),
+         events SimpleAggregateFunction(sum, UInt64)'''.format(segments=segment_columns),
+                 ['day', 'os', 'gender', 'age', 'source'], '''
+        SELECT toDate(time) AS day, {segments},
+               uniqExactState(toUInt32(user_id)) AS users,
+               toUInt64(countIf(action = 'view')) AS views,
+               toUInt64(countIf(action = 'like')) AS likes,
+               toUInt64(count()) AS events
+        FROM {{source}}
+        WHERE {{where}}
+        GROUP BY day, os, gender, age, source'''.format(segments=segment_select), 'day', 'feed_actions'),
+    PreAggregate('kozhevatov_messages_daily', 1, '''day Date,
+         {segments},
+         messages SimpleAggregateFunction(sum, UInt64)'''.format(segments=segment_columns),
+                 ['day', 'os', 'gender', 'age', 'source'], '''
+        SELECT toDate(time) AS day, {segments},
+               toUInt64(count()) AS messages
+        FROM {{source}}
+        WHERE {{where}}
+        GROUP BY day, os, gender, age, source'''.format(segments=segment_select), 'day', 'message_actions'),
+]
+
+
+class Migrations:
+
+    ddl = '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+        (name String,
+         version UInt32,
+         cutoff DateTime,
+         backfilled_until DateTime,
+         status LowCardinality(String),
+         updated_at DateTime DEFAULT now())
+        ENGINE = ReplacingMergeTree(updated_at)
+        ORDER BY name'''
+
+    def __init__(self, preaggregates=preaggregates, table=migrations_table, connection=connection_test,
+                 source_connection=connection):
+        self.preaggregates = {preaggregate.name: preaggregate for preaggregate in preaggregates}
+        self.table = table
+        self.connection = connection
+        self.source = escape(source_connection.get('database') or 'default')
+        self.source_connection = source_connection
+
+    def _selected(self, names):
+        names = names or list(self.preaggregates)
+        unknown = [name for name in names if name not in self.preaggregates]
+        if unknown:
+            raise ValueError('unknown pre-aggregates: {}'.format(', '.join(unknown)))
+        return [self.preaggregates[name] for name in names]
+
+    def _execute(self, query, settings=None):
+        return ch.execute(query, connection=self.connection, settings=settings)
+
+    # Состояние миграций: {name: {version, cutoff, backfilled_until, status}}
+    def status(self):
+        self._execute(self.ddl.format(table=self.table))
+        rows = ch.read_clickhouse('''SELECT name, version, toString(cutoff) AS cutoff,
+                                            toString(backfilled_until) AS backfilled_until, status
+                                     FROM {{db}}.{} FINAL'''.format(self.table),
+                                  connection=self.connection, format='tsv')
+        return {row['name']: row for row in rows.to_dict(orient='records')}
+
+    def _save(self, preaggregate, cutoff, backfilled_until, status):
+        self._execute('''INSERT INTO {{db}}.{table} (name, version, cutoff, backfilled_until, status, updated_at)
+                         VALUES ('{name}', {version}, toDateTime('{cutoff}'), toDateTime('{until}'), '{status}',
+                                 now())'''.format(table=self.table, name=preaggregate.name,
+                                                    version=preaggregate.version, cutoff=cutoff,
+                                                    until=backfilled_until, status=status))
+
+    # Время сервера источника: значение выражения expression (по умолчанию now())
+    def server_time(self, expression='now()'):
+        row = ch.read_clickhouse('SELECT toString({}) AS time'.format(expression),
+                                 connection=self.source_connection, format='tsv')
+        return datetime.strptime(str(row['time'].iloc[0])[:19], '%Y-%m-%d %H:%M:%S')
+
+    # Можно ли читать предагрегаты names: миграция текущей версии применена и история залита (status = ready)
+    def ready(self, names=None):
+        state = self.status()
+        pending = [preaggregate.name for preaggregate in self._selected(names)
+                   if preaggregate.name not in state
+                   or int(state[preaggregate.name]['version']) != preaggregate.version
+                   or state[preaggregate.name]['status'] != 'ready']
+        if pending:
+            log.warning('pre-aggregates are not ready, reading raw tables: %s', ', '.join(pending))
+        return not pending
+
+    def _first_day(self, preaggregate):
+        first = ch.read_clickhouse('SELECT toDate(min(time)) AS day FROM {{db}}.{}'.format(preaggregate.source_table),
+                                   connection=self.source_connection, format='tsv')
+        return datetime.strptime(str(first['day'].iloc[0])[:10], '%Y-%m-%d')
+
+    # Создает таблицы и представления. cutoff - момент, с которого события считает представление
+    # (по умолчанию начало следующего часа по часам сервера); уже примененные миграции той же версии не трогаются
+    def apply(self, names=None, cutoff=None):
+        cutoff = cutoff or self.server_time('toStartOfHour(now()) + 3600')
+        state = self.status()
+        applied = []
+        for preaggregate in self._selected(names):
+            current = state.get(preaggregate.name)
+            if current and int(current['version']) == preaggregate.version:
+                continue
+            if current:
+                raise RuntimeError('{} is at version {}, definition is {}: run reset'.format(
+                    preaggregate.name, current['version'], preaggregate.version))
+            for statement in preaggregate.create_statements(self.source, cutoff):
+                self._execute(statement)
+            self._save(preaggregate, cutoff, self._first_day(preaggregate), 'applied')
+            log.info('%s: view counts events from %s, history is not backfilled yet', preaggregate.name, cutoff)
+            applied.append(preaggregate.name)
+        return applied
+
+    # Заливает историю time < cutoff по одному дню, продолжая с backfilled_until. Вставка дня идет с токеном
+    # дедупликации (имя, версия, границы): если сбой случился после вставки, но до записи backfilled_until,
+    # повтор того же дня таблица отбрасывает, и суммы просмотров, лайков и сообщений не задваиваются.
+    # Вставка дня - несколько сотен агрегированных строк, до min_insert_block_size_rows они склеиваются в один блок,
+    # поэтому токен покрывает весь день
+    def backfill(self, names=None, wait=False, settle=backfill_settle):
+        state = self.status()
+        done = {}
+        for preaggregate in self._selected(names):
+            current = state.get(preaggregate.name)
+            if current is None:
+                raise RuntimeError('{} is not applied'.format(preaggregate.name))
+            cutoff = datetime.strptime(current['cutoff'], '%Y-%m-%d %H:%M:%S')
+            until = datetime.strptime(current['backfilled_until'], '%Y-%m-%d %H:%M:%S')
+            ready_at = cutoff + settle
+            now = self.server_time()
+            if now < ready_at:
+                if not wait:
+                    raise RuntimeError('{}: backfill is possible after {} (server time {})'.format(
+                        preaggregate.name, ready_at, now))
+                time.sleep((ready_at - now).total_seconds())
+            self._execute(preaggregate.window_ddl.format(name=preaggregate.name, window=deduplication_window))
+            days = 0
+            while until < cutoff:
+                end = min(until.replace(hour=0, minute=0, second=0) + timedelta(days=1), cutoff)
+                self._execute(preaggregate.backfill_statement(self.source, until, end),
+                              settings={'insert_deduplicate': 1,
+                                        'insert_deduplication_token': preaggregate.deduplication_token(until, end)})
+                until = end
+                self._save(preaggregate, cutoff, until, 'ready' if until >= cutoff else 'backfilling')
+                days += 1
+            if current['status'] != 'ready':
+                self._save(preaggregate, cutoff, until, 'ready')
+            log.info('%s: backfilled %s day(s) up to %s', preaggregate.name, days, cutoff)
+            done[preaggregate.name] = days
+        return done
+
+    # Удаляет представление, таблицу и запись о миграции - следующий apply создаст их заново
+    def reset(self, names=None, cutoff=None):
+        selected = self._selected(names)
+        self.status()
+        for preaggregate in selected:
+            for statement in preaggregate.drop_statements():
+                self._execute(statement)
+            self._execute('''ALTER TABLE {{db}}.{} DELETE WHERE name = '{}'
+                             SETTINGS mutations_sync = 1'''.format(self.table, preaggregate.name))
+        return self.apply([preaggregate.name for preaggregate in selected], cutoff=cutoff)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['status', 'apply', 'backfill', 'reset'])
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('--cutoff', help="'YYYY-MM-DD HH:MM:SS' or 'now' (only when the source is not written to)")
+    parser.add_argument('--wait', action='store_true', help='sleep until the cutoff has passed')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    migrations = Migrations()
+    cutoff = None
+    if args.cutoff:
+        cutoff = migrations.server_time() if args.cutoff == 'now' \
+            else datetime.strptime(args.cutoff, '%Y-%m-%d %H:%M:%S')
+    if args.command == 'status':
+        for name, row in sorted(migrations.status().items()):
+            print('{name:<28} v{version} {status:<12} cutoff {cutoff}, backfilled until {backfilled_until}'.format(**row))
+    elif args.command == 'backfill':
+        print(migrations.backfill(args.names, wait=args.wait))
+    else:
+        print(getattr(migrations, args.command)(args.names, cutoff=cutoff))
@@ -0,0 +1,352 @@
+# Общий построитель SQL для выгрузок всех DAG-ов.
+# Все фильтры по времени строятся как диапазоны time >= X AND time < Y от логической даты запуска,
+# чтобы ClickHouse мог отсечь куски по первичному ключу (toDate(time) = ... этого не дает).
+# {db} подставляется pandahouse из параметров подключения
+import logging
+import os
+from datetime import date, datetime, timedelta
+
+
+log = logging.getLogger(__name__)
+
+# Логировать оценку прочитанных строк перед каждой выгрузкой (LOG_QUERY_STATS=1)
+query_stats_enabled = os.environ.get('LOG_QUERY_STATS') == '1'
+
+# Подсчет уникальных пользователей в метриках (DAU, users_feed): exact - uniqExact (по умолчанию),
+# approx - uniqCombined(17), относительная ошибка около 0.3% (см. common/sketches.py)
+uniq_mode = os.environ.get('UNIQ_MODE', 'exact')
+uniq_precision = 17
+
+
+# Чтение из предагрегатов (USE_PREAGGREGATES=1): таблицы test.kozhevatov_feed_15m / _feed_daily /
+# _messages_daily, которые наполняют материализованные представления (common/migrations.py)
+preaggregates_enabled = os.environ.get('USE_PREAGGREGATES') == '1'
+
+# Срезы, которые есть в дневных предагрегатах
+preaggregate_dimensions = ['os', 'gender', 'age', 'source']
+
+
+def uniq(column):
+    if uniq_mode == 'approx':
+        return 'uniqCombined({})({})'.format(uniq_precision, column)
+    return 'uniqExact({})'.format(column)
+
+
+# Приводит логическую дату Airflow (ds-строка, date, datetime/pendulum) к date
+def as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+# Полуинтервал [start, start + days) по колонке column
+def day_range(start, days=1, column='time'):
+    start = as_date(start)
+    end = start + timedelta(days=days)
+    return "{column} >= toDateTime('{start}') AND {column} < toDateTime('{end}')".format(
+        column=column, start=start, end=end)
+
+
+# Несколько отдельных дней: (диапазон1) OR (диапазон2) ... - каждый день отсекается по ключу отдельно
+def days_filter(days, column='time'):
+    return ' OR '.join('({})'.format(day_range(day, column=column)) for day in days)
+
+
+def days_list(days):
+    return ', '.join("toDate('{}')".format(as_date(day)) for day in days)
+
+
+# Дни со сдвигом назад от логической даты: days_ago(ds, 0, 7, 28) -> [ds, ds - 7, ds - 28]
+def days_ago(day, *offsets):
+    day = as_date(day)
+    return [day - timedelta(days=offset) for offset in offsets]
+
+
+# Условие на часть пользователей: chunk = (номер части, всего частей), части не пересекаются по user_id
+def user_chunk_filter(chunk, column='user_id'):
+    if chunk is None:
+        return ''
+    number, chunks = chunk
+    return ' AND cityHash64({column}) % {chunks} = {number}'.format(column=column, chunks=chunks, number=number)
+
+
+# daily_cohort_report.extract_feed: лайки и просмотры по каждому пользователю за день
+# (или за days дней, начиная с day, - строки по каждому event_date)
+def feed_per_user_query(day, dimensions, chunk=None, days=1):
+    return '''
+        SELECT
+            user_id, {dims}, toDate(time) as event_date,
+            countIf(action = 'like') as likes,
+            countIf(action = 'view') as views
+        FROM {{db}}.feed_actions
+        WHERE {range}{chunk}
+        GROUP BY user_id, {dims}, event_date'''.format(dims=', '.join(dimensions), range=day_range(day, days=days),
+                                                      chunk=user_chunk_filter(chunk))
+
+
+# daily_cohort_report.extract_mess: сообщения по каждому пользователю за день (или за days дней).
+# CTE users ограничен тем же периодом: в результат попадают только отправители
+# (WHERE event_date ...), а их атрибуты берутся из их же событий за период
+def mess_per_user_query(day, dimensions, chunk=None, days=1):
+    start = as_date(day)
+    return '''
+        WITH
+        users AS (
+            SELECT distinct user_id as user_id, {dims}
+            FROM {{db}}.message_actions
+            WHERE {range}{chunk}),
+
+        recieve AS (
+            SELECT reciever_id, count(reciever_id) as messages_received,
+                   count(distinct user_id) as users_received,
+                   toDate(time) reciever_date
+            FROM {{db}}.message_actions
+            WHERE {range}{reciever_chunk}
+            GROUP BY reciever_id, reciever_date),
+
+        sent AS (
+            SELECT user_id, count(user_id) messages_sent,
+                   count(distinct reciever_id) users_sent,
+                   toDate(time) event_date
+            FROM {{db}}.message_actions
+            WHERE {range}{chunk}
+            GROUP BY user_id, event_date)
+
+        SELECT * FROM
+             (SELECT * FROM users
+             FULL outer join sent
+             on sent.user_id = users.user_id) A
+        FULL outer join recieve
+        on A.user_id = recieve.reciever_id and A.event_date = recieve.reciever_date
+        WHERE event_date >= toDate('{start}') and event_date < toDate('{end}')'''.format(
+            dims=', '.join(dimensions), range=day_range(start, days=days), start=start,
+            end=start + timedelta(days=days), chunk=user_chunk_filter(chunk),
+            reciever_chunk=user_chunk_filter(chunk, 'reciever_id'))
+
+
+# daily_cohort_report.extract_feed из предагрегата: лайки и просмотры по срезам за день (или за days дней)
+def feed_segments_query(day, dimensions, days=1):
+    missing = [dimension for dimension in dimensions if dimension not in preaggregate_dimensions]
+    if missing:
+        raise ValueError('dimensions {} are not pre-aggregated'.format(', '.join(missing)))
+    start = as_date(day)
+    return '''
+        SELECT {dims}, day as event_date, sum(likes) as likes, sum(views) as views
+        FROM {{db}}.kozhevatov_feed_daily
+        WHERE day >= toDate('{start}') AND day < toDate('{end}')
+        GROUP BY {dims}, event_date'''.format(dims=', '.join(dimensions), start=start,
+                                              end=start + timedelta(days=days))
+
+
+# daily_APP_report.extract: метрики ленты и мессенджера по отдельным дням. dau=False - без DAU
+# (в приближенном режиме он берется из сохраненных состояний uniqCombined, common/sketches.py)
+def app_metrics_query(days, dau=True):
+    return '''
+        SELECT * FROM
+            (SELECT toDate(time) as day,{dau}
+                    countIf(action = 'view') as views, countIf(action = 'like') as likes,
+                    countIf(action = 'like') / countIf(action = 'view') as ctr,
+                    count() as feed_events
+            FROM {{db}}.feed_actions
+            WHERE {filter}
+            GROUP BY day) t1
+        JOIN
+            (SELECT toDate(time) as day,
+                    count(user_id) as messages
+            FROM {{db}}.message_actions
+            WHERE {filter}
+            GROUP BY day) t2
+        using day
+        order by day asc'''.format(filter=days_filter(days),
+                                   dau='\n                    {} as dau,'.format(uniq('user_id')) if dau else '')
+
+
+# То же из дневных предагрегатов. DAU - слияние состояний uniqExact всех срезов дня (точное значение)
+def preaggregated_app_metrics_query(days):
+    return '''
+        SELECT * FROM
+            (SELECT day,
+                    uniqExactMerge(users) as dau,
+                    sum(views) as views, sum(likes) as likes,
+                    sum(likes) / sum(views) as ctr,
+                    sum(events) as feed_events
+            FROM {{db}}.kozhevatov_feed_daily
+            WHERE day IN ({days})
+            GROUP BY day) t1
+        JOIN
+            (SELECT day,
+                    sum(messages) as messages
+            FROM {{db}}.kozhevatov_messages_daily
+            WHERE day IN ({days})
+            GROUP BY day) t2
+        using day
+        order by day asc'''.format(days=days_list(days))
+
+
+# Число событий ленты и мессенджера по дням - дешевая проверка, не изменились ли данные уже посчитанного дня
+def daily_events_query(days):
+    return '''
+        SELECT day, sum(events) as events FROM
+            (SELECT toDate(time) as day, count() as events FROM {{db}}.feed_actions WHERE {filter} GROUP BY day
+             UNION ALL
+             SELECT toDate(time) as day, count() as events FROM {{db}}.message_actions WHERE {filter} GROUP BY day)
+        GROUP BY day
+        ORDER BY day'''.format(filter=days_filter(days))
+
+
+# Индекс первого появления: пользователи ленты за день с источником их первого события в этот день
+def day_users_query(day):
+    return '''
+        SELECT user_id, argMin(source, time) AS source
+        FROM {{db}}.feed_actions
+        WHERE {range}
+        GROUP BY user_id'''.format(range=day_range(day))
+
+
+# Индекс первого появления: полный пересчет по всей истории (первый день и источник каждого пользователя)
+def first_seen_history_query(until):
+    return '''
+        SELECT user_id, min(toDate(time)) AS first_day, argMin(source, time) AS source
+        FROM {{db}}.feed_actions
+        WHERE time < toDateTime('{end}')
+        GROUP BY user_id'''.format(end=as_date(until) + timedelta(days=1))
+
+
+# Когортный retention: битмапы активных пользователей ленты за день - по всем пользователям ('all')
+# и по каждому значению каждого среза. ARRAY JOIN читает таблицу один раз на все срезы
+def segment_bitmaps_query(day, dimensions):
+    return '''
+        SELECT toDate(time) AS day, segment_name, segment_value, groupBitmapState(toUInt32(user_id)) AS users
+        FROM {{db}}.feed_actions
+        ARRAY JOIN ['all', {names}] AS segment_name, ['all', {values}] AS segment_value
+        WHERE {range}
+        GROUP BY day, segment_name, segment_value'''.format(
+            names=', '.join("'{}'".format(dimension) for dimension in dimensions),
+            values=', '.join('toString({})'.format(dimension) for dimension in dimensions), range=day_range(day))
+
+
+# Начало выгрузки бакетов алертов: since - начало первого выгружаемого бакета (бакеты окна состояния
+# перечитываются целиком, чтобы учесть опоздавшие события), без него - со вчерашнего дня
+def alert_buckets_start(since=None):
+    if since is None:
+        return 'today() - 1'
+    return "toDateTime('{}')".format(since)
+
+
+# alert_system: 15-минутные бакеты ленты с начала alert_buckets_start(since). users=False - без users_feed
+# (в приближенном режиме он берется из сохраненных состояний бакетов, common/sketches.py)
+def alert_buckets_query(since=None, users=True):
+    return '''
+        SELECT toStartOfFifteenMinutes(time) as ts,
+            toDate(time) as date,
+            formatDateTime(ts, '%R') as hm,{users}
+            countIf(user_id, action = 'view') as views,
+            countIf(user_id, action = 'like') as likes
+        FROM {{db}}.feed_actions
+        WHERE time >= {start} and time < toStartOfFifteenMinutes(now())
+        GROUP BY ts, date, hm
+        ORDER BY ts'''.format(start=alert_buckets_start(since),
+                              users='\n            {} as users_feed,'.format(uniq('user_id')) if users else '')
+
+
+# То же из предагрегата 15-минутных бакетов: бакеты в нем уже выровнены, фильтр - по ts
+def preaggregated_alert_buckets_query(since=None):
+    return '''
+        SELECT ts,
+            toDate(ts) as date,
+            formatDateTime(ts, '%R') as hm,
+            uniqExactMerge(users) as users_feed,
+            sum(views) as views,
+            sum(likes) as likes
+        FROM {{db}}.kozhevatov_feed_15m
+        WHERE ts >= {start} and ts < toStartOfFifteenMinutes(now())
+        GROUP BY ts
+        ORDER BY ts'''.format(start=alert_buckets_start(since))
+
+
+# Бэктест детекторов: те же 15-минутные бакеты ленты за days дней, начиная с day
+def alert_history_query(day, days):
+    return '''
+        SELECT toStartOfFifteenMinutes(time) as ts,
+            {uniq} as users_feed,
+            countIf(user_id, action = 'view') as views,
+            countIf(user_id, action = 'like') as likes
+        FROM {{db}}.feed_actions
+        WHERE {range}
+        GROUP BY ts
+        ORDER BY ts'''.format(range=day_range(day, days=days), uniq=uniq('user_id'))
+
+
+# alert_system: 15-минутные бакеты по срезам. ARRAY JOIN раскладывает каждое событие на пары
+# (dimension, dimension_value), поэтому таблица читается один раз на все срезы
+def alert_slices_query(dimensions, buckets):
+    return '''
+        SELECT toStartOfFifteenMinutes(time) as ts,
+            dimension,
+            dimension_value,
+            {uniq} as users_feed,
+            countIf(user_id, action = 'view') as views,
+            countIf(user_id, action = 'like') as likes
+        FROM {{db}}.feed_actions
+        ARRAY JOIN [{names}] as dimension, [{values}] as dimension_value
+        WHERE time >= toStartOfFifteenMinutes(now()) - INTERVAL {buckets} * 15 MINUTE
+            and time < toStartOfFifteenMinutes(now())
+        GROUP BY ts, dimension, dimension_value
+        ORDER BY ts'''.format(uniq=uniq('user_id'), names=', '.join("'{}'".format(name) for name in dimensions),
+                              values=', '.join('toString({})'.format(expr) for expr in dimensions.values()),
+                              buckets=buckets)
+
+
+# Сезонный профиль алертов: квартили каждой метрики по (день недели, время суток) за weeks недель,
+# заканчивая днем day. Бакеты считаются так же, как в alert_buckets_query
+def alert_baseline_query(day, weeks, metrics):
+    start = as_date(day) - timedelta(days=7 * weeks - 1)
+    return '''
+        SELECT toDayOfWeek(ts) as weekday,
+            formatDateTime(ts, '%R') as hm,
+            metric,
+            quantileExact(0.25)(value) as q25,
+            quantileExact(0.5)(value) as q50,
+            quantileExact(0.75)(value) as q75,
+            count() as samples
+        FROM
+            (SELECT toStartOfFifteenMinutes(time) as ts,
+                {uniq} as users_feed,
+                countIf(user_id, action = 'view') as views,
+                countIf(user_id, action = 'like') as likes
+            FROM {{db}}.feed_actions
+            WHERE {range}
+            GROUP BY ts)
+        ARRAY JOIN [{names}] as metric, [{metrics}] as value
+        GROUP BY weekday, hm, metric
+        ORDER BY metric, weekday, hm'''.format(uniq=uniq('user_id'), range=day_range(start, days=7 * weeks),
+                                               names=', '.join("'{}'".format(metric) for metric in metrics),
+                                               metrics=', '.join(metrics))
+
+
+# Оценка объема чтения: EXPLAIN ESTIMATE возвращает по каждой таблице число кусков, засечек и строк,
+# которые ClickHouse прочитает после отсечения по ключу
+def explain_estimate(query, connection):
+    # Клиент импортируется здесь: модуль импортируется DAG-файлами при разборе, а клиент тянет pandas
+    from common import clickhouse as ch
+    return ch.read_clickhouse(query='EXPLAIN ESTIMATE ' + query, connection=connection, format='tsv')
+
+
+# Ошибки сервера и сети только пишутся в лог - статистика не должна ронять таск. Остальные исключения
+# (ошибки в коде, как NameError) пробрасываются, иначе LOG_QUERY_STATS молча перестает работать
+def log_query_stats(name, query, connection):
+    if not query_stats_enabled:
+        return None
+    import requests
+    from pandahouse.http import ClickhouseException
+    try:
+        stats = explain_estimate(query, connection)
+    except (ClickhouseException, requests.RequestException) as error:
+        log.warning('EXPLAIN ESTIMATE for %s failed: %s', name, error)
+        return None
+    for row in stats.to_dict(orient='records'):
+        log.info('%s: %s.%s - %s rows, %s marks, %s parts', name, row.get('database'), row.get('table'),
+                 row.get('rows'), row.get('marks'), row.get('parts'))
+    return stats
@@ -0,0 +1,166 @@
+# Когортный retention по битмапам: на каждый (день, срез) хранится битмап пользователей ленты
+# (groupBitmapState, Roaring) в test.kozhevatov_active_bitmaps, отдельно - битмап новых пользователей дня
+# из индекса первого появления (common/first_seen.py). Когорта дня D в срезе - пересечение активных в срезе
+# за D с новыми за D, удержание на день D + k - мощность пересечения когорты с активными за D + k.
+# Каждую ночь добавляются битмапы одного дня и считается одна новая диагональ треугольника (k = ds - D
+# для всех когорт за последние max_days дней); результат - test.kozhevatov_retention.
+# Перед загрузкой битмапов индекс первого появления дописывается до дня отчета (FirstSeenIndex.update
+# идемпотентен): если daily_APP_report пропустил или еще не выполнил запуск, когорта дня не окажется пустой.
+#   python -m common.retention rebuild 2023-02-01 2023-03-20
+import logging
+from datetime import timedelta
+
+from common import clickhouse as ch
+from common.clickhouse import connection, connection_test
+from common.first_seen import FirstSeenIndex
+from common.queries import as_date, segment_bitmaps_query
+
+
+log = logging.getLogger(__name__)
+
+
+class RetentionEngine:
+
+    ddl = ['''CREATE TABLE IF NOT EXISTS {{db}}.{bitmaps}
+        (day Date,
+         segment_name LowCardinality(String),
+         segment_value String,
+         users AggregateFunction(groupBitmap, UInt32))
+        ENGINE = AggregatingMergeTree()
+        PARTITION BY toYYYYMM(day)
+        ORDER BY (day, segment_name, segment_value)''',
+           '''CREATE TABLE IF NOT EXISTS {{db}}.{table}
+        (cohort_day Date,
+         segment_name LowCardinality(String),
+         segment_value String,
+         day_number UInt16,
+         cohort_size UInt64,
+         retained UInt64,
+         retention Float64,
+         computed_at DateTime DEFAULT now())
+        ENGINE = ReplacingMergeTree(computed_at)
+        PARTITION BY toYYYYMM(cohort_day)
+        ORDER BY (cohort_day, segment_name, segment_value, day_number)''']
+
+    # Пересечение когорт (активные в срезе за cohort_day И новые за cohort_day) с активными за day.
+    # Условие на пары (cohort_day, day) задает диапазон треугольника
+    triangle_query = '''
+        INSERT INTO {{db}}.{table} (cohort_day, segment_name, segment_value, day_number, cohort_size, retained, retention)
+        SELECT cohort_day, segment_name, segment_value,
+               toUInt16(dateDiff('day', cohort_day, active.day)) AS day_number,
+               bitmapCardinality(cohort.users) AS cohort_size,
+               bitmapAndCardinality(cohort.users, active.users) AS retained,
+               if(cohort_size = 0, 0, retained / cohort_size) AS retention
+        FROM
+            (SELECT segments.day AS cohort_day, segment_name, segment_value,
+                    bitmapAnd(segments.users, new_users.users) AS users
+             FROM
+                 (SELECT day, segment_name, segment_value, groupBitmapMergeState(users) AS users
+                  FROM {{db}}.{bitmaps}
+                  WHERE segment_name != 'new' AND day >= toDate('{cohort_start}') AND day <= toDate('{cohort_end}')
+                  GROUP BY day, segment_name, segment_value) AS segments
+             JOIN
+                 (SELECT day, groupBitmapMergeState(users) AS users
+                  FROM {{db}}.{bitmaps}
+                  WHERE segment_name = 'new' AND day >= toDate('{cohort_start}') AND day <= toDate('{cohort_end}')
+                  GROUP BY day) AS new_users
+             USING day) AS cohort
+        CROSS JOIN
+            (SELECT day, groupBitmapMergeState(users) AS users
+             FROM {{db}}.{bitmaps}
+             WHERE segment_name = 'all' AND day >= toDate('{day_start}') AND day <= toDate('{day_end}')
+             GROUP BY day) AS active
+        WHERE active.day >= cohort_day AND active.day <= cohort_day + {max_days}'''
+
+    def __init__(self, dimensions, table='kozhevatov_retention', bitmaps='kozhevatov_active_bitmaps',
+                 first_seen='kozhevatov_first_seen', connection=connection_test, source_connection=connection,
+                 max_days=30):
+        self.dimensions = list(dimensions)
+        self.table = table
+        self.bitmaps = bitmaps
+        self.first_seen = first_seen
+        self.connection = connection
+        self.source_connection = source_connection
+        self.max_days = max_days
+        self._tables_ready = False
+
+    def ensure_tables(self):
+        if not self._tables_ready:
+            for ddl in self.ddl:
+                ch.execute(ddl.format(table=self.table, bitmaps=self.bitmaps), connection=self.connection)
+            self._tables_ready = True
+
+    # Битмапы дня: активные по срезам - с сервера-источника, новые пользователи - из индекса первого появления
+    def load_bitmaps(self, day):
+        day = as_date(day)
+        active = ch.copy_rows(segment_bitmaps_query(day, self.dimensions), self.bitmaps,
+                              source_connection=self.source_connection, connection=self.connection)
+        ch.execute('''INSERT INTO {{db}}.{bitmaps}
+                      SELECT first_day AS day, 'new' AS segment_name, '' AS segment_value,
+                             groupBitmapState(toUInt32(user_id)) AS users
+                      FROM {{db}}.{first_seen} FINAL
+                      WHERE first_day = toDate('{day}')
+                      GROUP BY first_day'''.format(bitmaps=self.bitmaps, first_seen=self.first_seen, day=day),
+                   connection=self.connection)
+        log.info('%s: %s segment bitmap(s) for %s', self.bitmaps, active, day)
+        return active
+
+    def _triangle(self, cohort_start, cohort_end, day_start, day_end):
+        ch.execute(self.triangle_query.format(table=self.table, bitmaps=self.bitmaps, max_days=self.max_days,
+                                              cohort_start=cohort_start, cohort_end=cohort_end,
+                                              day_start=day_start, day_end=day_end),
+                   connection=self.connection)
+
+    # Индекс первого появления до дня day включительно - источник битмапов новых пользователей
+    def ensure_first_seen(self, day):
+        return FirstSeenIndex(self.first_seen, connection=self.connection,
+                              source_connection=self.source_connection).update(day)
+
+    # Ночное обновление: битмапы дня day и новая диагональ - удержание на day всех когорт за max_days дней
+    def update(self, day):
+        day = as_date(day)
+        self.ensure_tables()
+        self.ensure_first_seen(day)
+        self.load_bitmaps(day)
+        self._triangle(day - timedelta(days=self.max_days), day, day, day)
+        log.info('%s: retention diagonal for %s', self.table, day)
+
+    # Полный пересчет треугольника за когорты [start, end] по уже загруженным битмапам (load=True - с загрузкой)
+    def rebuild(self, start, end, load=False):
+        start, end = as_date(start), as_date(end)
+        self.ensure_tables()
+        if load:
+            self.ensure_first_seen(end)
+            for offset in range((end - start).days + 1):
+                self.load_bitmaps(start + timedelta(days=offset))
+        self._triangle(start, end, start, end)
+
+    # Треугольник в широком виде: строка на когорту и срез, колонки - дни от первого появления
+    def triangle(self, start, end, segment_name='all'):
+        retention = ch.read_clickhouse('''SELECT cohort_day, segment_value, day_number, cohort_size, retention
+                                          FROM {{db}}.{table} FINAL
+                                          WHERE cohort_day >= toDate('{start}') AND cohort_day <= toDate('{end}')
+                                            AND segment_name = '{segment_name}' '''.format(
+                                              table=self.table, start=as_date(start), end=as_date(end),
+                                              segment_name=segment_name),
+                                       connection=self.connection)
+        return retention.pivot_table(index=['cohort_day', 'segment_value', 'cohort_size'], columns='day_number',
+                                     values='retention', observed=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['update', 'rebuild'])
+    parser.add_argument('start')
+    parser.add_argument('end', nargs='?')
+    parser.add_argument('--dimensions', nargs='+', default=['gender', 'os', 'age'])
+    parser.add_argument('--load', action='store_true', help='load bitmaps for every day before rebuilding')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    engine = RetentionEngine(args.dimensions)
+    if args.command == 'update':
+        engine.update(args.start)
+    else:
+        engine.rebuild(args.start, args.end or args.start, load=args.load)
@@ -0,0 +1,89 @@
+# Схемы выгрузок: типы колонок, которые приводятся сразу при чтении (read_clickhouse(..., schema=...)).
+#   category - строки и срезы с малым числом значений (os, gender, source, dimension_value)
+#   uint     - наименьший беззнаковый тип, в который помещается максимум колонки (uint8 / 16 / 32 / 64)
+#   UInt     - то же, но nullable: после outer join у пользователя без событий счетчик <NA>, а не float NaN,
+#              сумма по группе остается целой, поэтому повторное приведение к int не нужно
+#   date     - дата без времени (date32 Arrow, 4 байта) вместо Timestamp
+# Остальные значения - обычные типы pandas ('uint32', 'float32' и т.п.). Колонки, которых нет в выгрузке,
+# пропускаются. Счетчики, из которых в тасках вычитают (метрики алертов и дневных отчетов), остаются знаковыми
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+
+date_dtype = pd.ArrowDtype(pa.date32())
+
+
+# daily_cohort_report: поюзерные выгрузки ленты и мессенджера (срезы добавляются через with_dimensions)
+feed_per_user = {'user_id': 'uint32', 'event_date': 'date', 'likes': 'UInt', 'views': 'UInt'}
+
+mess_per_user = {'user_id': 'uint32', 'event_date': 'date', 'messages_sent': 'UInt', 'users_sent': 'UInt',
+                 'reciever_id': 'UInt32', 'reciever_date': 'date', 'messages_received': 'UInt',
+                 'users_received': 'UInt'}
+
+# daily_cohort_report: лайки и просмотры по срезам из предагрегата kozhevatov_feed_daily
+feed_segments = {'event_date': 'date', 'likes': 'UInt', 'views': 'UInt'}
+
+# Индекс первого появления: пользователи дня, полная история и число новых пользователей по источникам
+day_users = {'user_id': 'uint32', 'source': 'category'}
+
+first_seen_history = {'user_id': 'uint32', 'first_day': 'date', 'source': 'category'}
+
+new_users = {'timestamp': 'date', 'source': 'category'}
+
+# alert_system: метрики бакетов по срезам
+alert_slices = {'dimension': 'category', 'dimension_value': 'category'}
+
+
+def with_dimensions(schema, dimensions):
+    return dict(schema, **{dimension: 'category' for dimension in dimensions})
+
+
+def smallest_uint(values, nullable=False):
+    top = values.max() if len(values) else 0
+    top = 0 if pd.isna(top) else int(top)
+    for bits in (8, 16, 32):
+        if top < 2 ** bits:
+            break
+    else:
+        bits = 64
+    return '{}{}'.format('UInt' if nullable else 'uint', bits)
+
+
+def to_date(values):
+    if values.dtype == date_dtype:
+        return values
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.to_datetime(values)
+    return values.astype(date_dtype)
+
+
+def enforce(df, schema):
+    for column, kind in schema.items():
+        if column not in df:
+            continue
+        values = df[column]
+        if kind == 'category':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype('category')
+        elif kind in ('uint', 'UInt'):
+            dtype = smallest_uint(values, nullable=kind == 'UInt' or bool(values.isna().any()))
+            if values.dtype != dtype:
+                df[column] = values.astype(dtype)
+        elif kind == 'date':
+            df[column] = to_date(values)
+        elif values.dtype != kind:
+            df[column] = values.astype(kind)
+    return df
+
+
+# Общий набор категорий у одноименных колонок нескольких выгрузок: merge по categorical-ключам
+# с разными категориями превращает ключ в строки
+def align_categories(frames, columns):
+    for column in columns:
+        if not all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            continue
+        categories = union_categoricals([frame[column].array for frame in frames], ignore_order=True).categories
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return frames
@@ -0,0 +1,200 @@
+# Хранилище состояний uniqCombined(17) по пользователям ленты: на каждый 15-минутный бакет
+# (test.kozhevatov_uniq_buckets) и на каждый день (test.kozhevatov_uniq_days), таблицы AggregatingMergeTree.
+# Уникальные пользователи за любой диапазон дней (DAU, недельные), и скользящие окна из бакетов
+# считаются слиянием сохраненных состояний, без чтения feed_actions.
+#
+# Точность: uniqCombined(17) до нескольких десятков тысяч значений считает почти точно (массив / хеш-таблица),
+# дальше переходит на HyperLogLog с 2^17 ячейками - стандартная относительная ошибка около 1.04 / sqrt(2^17),
+# т.е. 0.3%; ошибка слияния не накапливается - слитое состояние равно состоянию по объединению данных.
+# Повторная вставка того же дня не меняет результат (слияние множества с самим собой), поэтому перезапуск
+# безопасен; после удаления или перезаливки сырых данных день пересобирается через rebuild.
+#
+# При UNIQ_MODE=approx из состояний читают: хранилище дневных метрик (DAU), отчет по приложению
+# (уникальные за 7 дней и пик уникальных за скользящий час) и алерты (users_feed по бакетам). Дни, которых
+# еще нет в хранилище, загружаются при первом обращении, бакеты алертов дописываются на каждой проверке.
+#   python -m common.sketches update 2023-03-01 30
+#   python -m common.sketches rebuild 2023-03-20 1
+import logging
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from common import clickhouse as ch
+from common.clickhouse import connection, connection_test
+from common.queries import alert_buckets_start, as_date, day_range, days_list, uniq_precision
+
+
+log = logging.getLogger(__name__)
+
+state_type = 'AggregateFunction(uniqCombined({}), UInt32)'.format(uniq_precision)
+
+state_expression = 'uniqCombinedState({})(toUInt32(user_id))'.format(uniq_precision)
+
+
+class UniqSketchStore:
+
+    ddl = ['''CREATE TABLE IF NOT EXISTS {{db}}.{prefix}_buckets
+        (ts DateTime,
+         users {state})
+        ENGINE = AggregatingMergeTree()
+        PARTITION BY toYYYYMM(ts)
+        ORDER BY ts''',
+           '''CREATE TABLE IF NOT EXISTS {{db}}.{prefix}_days
+        (day Date,
+         users {state})
+        ENGINE = AggregatingMergeTree()
+        PARTITION BY toYYYYMM(day)
+        ORDER BY day''']
+
+    def __init__(self, prefix='kozhevatov_uniq', connection=connection_test, source_connection=connection):
+        self.prefix = prefix
+        self.connection = connection
+        self.source_connection = source_connection
+        self._tables_ready = False
+
+    def ensure_tables(self):
+        if not self._tables_ready:
+            for ddl in self.ddl:
+                ch.execute(ddl.format(prefix=self.prefix, state=state_type), connection=self.connection)
+            self._tables_ready = True
+
+    # Состояния считаются на сервере-источнике и переносятся как есть, без разбора в Python
+    def _copy(self, select, table):
+        return ch.copy_rows(select, '{}_{}'.format(self.prefix, table), source_connection=self.source_connection,
+                            connection=self.connection)
+
+    # Добавляет состояния бакетов и дней за days дней, начиная с start
+    def update(self, start, days=1):
+        self.ensure_tables()
+        state = state_expression
+        condition = day_range(start, days=days)
+        buckets = self._copy('''SELECT toStartOfFifteenMinutes(time) AS ts, {state} AS users
+                                FROM {{db}}.feed_actions WHERE {condition} GROUP BY ts'''.format(
+                                    state=state, condition=condition), 'buckets')
+        days_loaded = self._copy('''SELECT toDate(time) AS day, {state} AS users
+                                    FROM {{db}}.feed_actions WHERE {condition} GROUP BY day'''.format(
+                                        state=state, condition=condition), 'days')
+        log.info('%s: %s bucket and %s day state(s) from %s', self.prefix, buckets, days_loaded, as_date(start))
+        return days_loaded
+
+    # Дни из days, состояния которых уже есть в хранилище
+    def stored_days(self, days):
+        self.ensure_tables()
+        stored = self._merge('''SELECT DISTINCT day FROM {{{{db}}}}.{{prefix}}_days
+                                WHERE day IN ({days})'''.format(days=days_list(days)))
+        return {as_date(day) for day in stored['day']}
+
+    # Загружает дни, которых еще нет в хранилище (первый запуск, пропущенные дни), подряд идущие дни -
+    # одной выгрузкой. Возвращает список загруженных дней
+    def ensure_days(self, days):
+        days = sorted({as_date(day) for day in days})
+        stored = self.stored_days(days)
+        missing = [day for day in days if day not in stored]
+        start = None
+        for i, day in enumerate(missing):
+            start = start or day
+            if i + 1 == len(missing) or missing[i + 1] != day + timedelta(days=1):
+                self.update(start, (day - start).days + 1)
+                start = None
+        return missing
+
+    # Состояния бакетов с начала alert_buckets_start(since) до последнего закрывшегося - для алертов.
+    # Повторная вставка бакета сливается с сохраненным состоянием: опоздавшие события добавляются, а не задваиваются
+    def update_buckets(self, since=None):
+        self.ensure_tables()
+        return self._copy('''SELECT toStartOfFifteenMinutes(time) AS ts, {state} AS users
+                             FROM {{db}}.feed_actions
+                             WHERE time >= {start} AND time < toStartOfFifteenMinutes(now())
+                             GROUP BY ts'''.format(state=state_expression, start=alert_buckets_start(since)),
+                          'buckets')
+
+    # Уникальные пользователи по бакетам с начала alert_buckets_start(since) (users_feed алертов)
+    def bucket_uniques(self, since=None):
+        return self._merge('''SELECT ts, uniqCombinedMerge({{precision}})(users) AS users_feed
+                              FROM {{{{db}}}}.{{prefix}}_buckets
+                              WHERE ts >= {start} AND ts < toStartOfFifteenMinutes(now())
+                              GROUP BY ts
+                              ORDER BY ts'''.format(start=alert_buckets_start(since)))
+
+    # Пересборка дней после перезаливки сырых данных: удаляет их состояния и загружает заново
+    def rebuild(self, start, days=1):
+        self.ensure_tables()
+        start = as_date(start)
+        end = start + timedelta(days=days)
+        for table, column in [('buckets', 'ts'), ('days', 'day')]:
+            ch.execute('''ALTER TABLE {{db}}.{prefix}_{table} DELETE
+                          WHERE {column} >= toDateTime('{start}') AND {column} < toDateTime('{end}')
+                          SETTINGS mutations_sync = 1'''.format(prefix=self.prefix, table=table, column=column,
+                                                               start=start, end=end),
+                       connection=self.connection)
+        return self.update(start, days)
+
+    def _merge(self, query):
+        return ch.read_clickhouse(query.format(prefix=self.prefix, precision=uniq_precision),
+                                  connection=self.connection, format='tsv')
+
+    # DAU по каждому из дней
+    def dau(self, days):
+        return self._merge('''SELECT day, uniqCombinedMerge({{precision}})(users) AS dau
+                              FROM {{{{db}}}}.{{prefix}}_days
+                              WHERE day IN ({days})
+                              GROUP BY day
+                              ORDER BY day'''.format(days=days_list(days)))
+
+    # Уникальные пользователи за диапазон дней [start, start + days) одним числом (недельные, месячные)
+    def range_uniques(self, start, days=7):
+        start = as_date(start)
+        result = self._merge('''SELECT uniqCombinedMerge({{precision}})(users) AS users
+                                FROM {{{{db}}}}.{{prefix}}_days
+                                WHERE day >= toDate('{start}') AND day < toDate('{end}')'''.format(
+                                    start=start, end=start + timedelta(days=days)))
+        return int(result['users'].iloc[0])
+
+    # Уникальные пользователи в скользящем окне из window бакетов, заканчивающемся каждым бакетом
+    # за days дней, начиная с start (window=4 - последний час, window=96 - последние сутки)
+    def rolling_uniques(self, start, days=1, window=4):
+        start = datetime.combine(as_date(start), datetime.min.time())
+        return self._merge('''SELECT ts, users FROM
+                                  (SELECT ts, uniqCombinedMerge({{precision}})(users) OVER
+                                       (ORDER BY ts ROWS BETWEEN {preceding} PRECEDING AND CURRENT ROW) AS users
+                                   FROM
+                                       (SELECT ts, uniqCombinedMergeState({{precision}})(users) AS users
+                                        FROM {{{{db}}}}.{{prefix}}_buckets
+                                        WHERE ts >= toDateTime('{first}') AND ts < toDateTime('{end}')
+                                        GROUP BY ts))
+                              WHERE ts >= toDateTime('{start}')
+                              ORDER BY ts'''.format(preceding=window - 1, start=start,
+                                                    first=start - timedelta(minutes=15 * (window - 1)),
+                                                    end=start + timedelta(days=days)))
+
+    # Для каждого дня отчета: уникальные за week дней, заканчивающихся этим днем, и пик уникальных за скользящее
+    # окно из window бакетов внутри дня. Недостающие дни загружаются один раз и дальше переиспользуются
+    def report_uniques(self, days, week=7, window=4):
+        days = sorted({as_date(day) for day in days})
+        self.ensure_days([day - timedelta(days=offset) for day in days for offset in range(week)])
+        rows = []
+        for day in days:
+            rolling = self.rolling_uniques(day, 1, window)
+            rows.append({'day': day,
+                         'wau': self.range_uniques(day - timedelta(days=week - 1), week),
+                         'peak_hour_users': int(rolling['users'].max()) if not rolling.empty else 0})
+        return pd.DataFrame(rows)
+
+    # Добавляет к дневным метрикам колонки report_uniques по колонке day
+    def with_report_uniques(self, data):
+        uniques = self.report_uniques(data['day']).set_index('day')
+        days = data['day'].map(as_date)
+        return data.assign(**{column: days.map(uniques[column]) for column in uniques.columns})
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['update', 'rebuild'])
+    parser.add_argument('start')
+    parser.add_argument('days', type=int, nargs='?', default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    store = UniqSketchStore()
+    print(getattr(store, args.command)(args.start, args.days))
@@ -0,0 +1,39 @@
+# Потоковая сборка отчета в разрезах с ограниченной памятью: поюзерные данные читаются частями
+# по хешу user_id, каждая часть сразу сворачивается в частичный агрегат (мелкое зерно срезов),
+# а в конце суммируются только маленькие частичные агрегаты
+import logging
+
+import pandas as pd
+
+from common import clickhouse as ch
+from common import schemas
+from common.clickhouse import connection
+from common.cube import join_per_user, partial_cube, report_measures, rollup_cube
+from common.queries import feed_per_user_query, mess_per_user_query
+
+
+log = logging.getLogger(__name__)
+
+
+# Генератор поюзерных частей: у каждого пользователя (и как отправителя, и как получателя)
+# все строки попадают в одну часть, поэтому outer join внутри части дает тот же результат, что и целиком
+def iter_user_chunks(day, dimensions, chunks, connection=connection):
+    for number in range(chunks):
+        df_feed = ch.read_clickhouse(feed_per_user_query(day, dimensions, chunk=(number, chunks)),
+                                     connection=connection,
+                                     schema=schemas.with_dimensions(schemas.feed_per_user, dimensions))
+        df_mess = ch.read_clickhouse(mess_per_user_query(day, dimensions, chunk=(number, chunks)),
+                                     connection=connection,
+                                     schema=schemas.with_dimensions(schemas.mess_per_user, dimensions))
+        yield number, join_per_user(df_feed, df_mess, dimensions)
+
+
+def stream_cube(day, dimensions, chunks, measures=report_measures, connection=connection):
+    partials = []
+    for number, merged_data in iter_user_chunks(day, dimensions, chunks, connection=connection):
+        partials.append(partial_cube(merged_data, dimensions, measures))
+        log.info('chunk %s/%s: %s users -> %s partial rows', number + 1, chunks, len(merged_data),
+                 len(partials[-1]))
+        del merged_data
+    partial = partial_cube(pd.concat(partials, ignore_index=True), dimensions, measures)
+    return rollup_cube(partial, dimensions, measures)
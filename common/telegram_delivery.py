@@ -0,0 +1,243 @@
+# Асинхронная отправка в Телеграм через Bot API: один цикл событий и один пул HTTP-соединений на объект
+# TelegramDelivery (долгоживущий объект переиспользует соединения между отправками), ограничение частоты
+# на каждый чат и на бота в целом (token bucket), повторы с экспоненциальной задержкой (на 429 - ровно
+# столько, сколько просит Телеграм в retry_after; отправка сообщения повторяется, только если запрос точно
+# не был обработан, иначе повтор задвоил бы сообщение), алерты одного запуска - одно сообщение и альбом
+# графиков (sendMediaGroup), параллельная рассылка по нескольким чатам.
+# По каждому вызову API сохраняется задержка (ожидание лимита + запрос + повторы), сводка - stats()
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import time
+
+from common import instrumentation
+
+
+log = logging.getLogger(__name__)
+
+api_url = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Лимиты Телеграма: около 1 сообщения в секунду в один чат (20 в минуту в группу) и 30 в секунду на бота
+chat_rate = 1.0
+chat_burst = 3
+bot_rate = 30.0
+
+# Сколько последних вызовов API хранит объект для stats(): теплый evaluator и сервис живут часами
+calls_history = 1000
+
+# В альбоме от 2 до 10 фото
+media_group_limit = 10
+
+# Методы, которые создают сообщение: при 5xx, таймауте чтения или обрыве соединения после отправки запроса
+# неизвестно, дошло ли сообщение, поэтому они повторяются только на 429 и ошибках установки соединения
+send_methods = {'sendMessage', 'sendPhoto', 'sendMediaGroup'}
+
+
+def chat_ids(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [str(chat).strip() for chat in value if str(chat).strip()]
+    return [chat.strip() for chat in str(value).split(',') if chat.strip()]
+
+
+class TokenBucket:
+    # Без блокировок: проверка и резервирование токена происходят без await между ними,
+    # поэтому корутины одного цикла событий не могут занять один токен дважды
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Резервирует токен и возвращает, сколько секунд нужно подождать перед запросом
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class TelegramError(Exception):
+
+    def __init__(self, method, status, description):
+        super().__init__('{} failed with {}: {}'.format(method, status, description))
+        self.status = status
+        self.description = description
+
+
+class TelegramDelivery:
+
+    # Ошибки транспорта (до первого запроса - только OSError, затем httpx.TransportError)
+    _transport_errors = OSError
+    # Ошибки, при которых запрос не дошел до сервера (соединение не установлено) - повтор безопасен
+    _unsent_errors = (ConnectionRefusedError,)
+
+    def __init__(self, token=None, retries=4, backoff=1.0, timeout=30, chat_rate=chat_rate, chat_burst=chat_burst,
+                 bot_rate=bot_rate, max_connections=20):
+        self.token = token or os.environ.get('TOKEN')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_connections = max_connections
+        self.bot_bucket = TokenBucket(bot_rate, max(1, int(bot_rate)))
+        self.chat_buckets = {}
+        self.calls = collections.deque(maxlen=calls_history)
+        self._client = None
+        self._loop = None
+
+    def _bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    # Клиент создается при первом вызове API внутри цикла событий объекта и живет до close()
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_connections)
+            self._transport_errors = httpx.TransportError
+            self._unsent_errors = (ConnectionRefusedError, httpx.ConnectError, httpx.ConnectTimeout,
+                                   httpx.PoolTimeout)
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return self._client
+
+    async def call(self, method, chat_id, data=None, files=None):
+        start = time.perf_counter()
+        waited = await self._bucket(chat_id).acquire()
+        waited += await self.bot_bucket.acquire()
+        client = self._get_client()
+        url = '{}/bot{}/{}'.format(api_url, self.token, method)
+        payload = dict(data or {}, chat_id=chat_id)
+        idempotent = method not in send_methods
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await client.post(url, data=payload, files=files)
+                body = response.json()
+                if response.status_code == 200 and body.get('ok'):
+                    break
+                error = TelegramError(method, response.status_code, body.get('description'))
+                retry_after = (body.get('parameters') or {}).get('retry_after')
+                retryable = response.status_code == 429 or (idempotent and response.status_code >= 500)
+            except self._unsent_errors as exc:
+                error, retry_after, retryable = exc, None, True
+            except (ValueError, OSError, self._transport_errors) as exc:
+                error, retry_after, retryable = exc, None, idempotent
+            if not retryable or attempt > self.retries:
+                self._record(method, chat_id, start, waited, attempt, False)
+                raise error
+            delay = retry_after if retry_after else self.backoff * 2 ** (attempt - 1) * (1 + random.random() / 2)
+            log.warning('%s to %s failed (%s), retry %s in %.1f s', method, chat_id, error, attempt, delay)
+            waited += delay
+            await asyncio.sleep(delay)
+        self._record(method, chat_id, start, waited, attempt, True)
+        return body['result']
+
+    def _record(self, method, chat_id, start, waited, attempts, ok):
+        latency = time.perf_counter() - start
+        self.calls.append({'method': method, 'chat_id': chat_id, 'latency_s': latency,
+                           'waited_s': waited, 'attempts': attempts, 'ok': ok})
+        instrumentation.telegram_call(latency)
+
+    async def send_message(self, chat_id, text):
+        return await self.call('sendMessage', chat_id, {'text': text})
+
+    async def send_photo(self, chat_id, photo, caption=None):
+        data = {'caption': caption} if caption else {}
+        return await self.call('sendPhoto', chat_id, data, files={'photo': ('0.png', photo, 'image/png')})
+
+    # Альбом графиков: одна фотография отправляется через sendPhoto, больше 10 - несколькими альбомами
+    async def send_media_group(self, chat_id, photos, caption=None):
+        results = []
+        for offset in range(0, len(photos), media_group_limit):
+            group = photos[offset:offset + media_group_limit]
+            if len(group) == 1:
+                results.append(await self.send_photo(chat_id, group[0], caption if offset == 0 else None))
+                continue
+            media = [{'type': 'photo', 'media': 'attach://photo{}'.format(i)} for i in range(len(group))]
+            if caption and offset == 0:
+                media[0]['caption'] = caption
+            files = {'photo{}'.format(i): ('{}.png'.format(i), photo, 'image/png') for i, photo in enumerate(group)}
+            results.append(await self.call('sendMediaGroup', chat_id, {'media': json.dumps(media)}, files=files))
+        return results
+
+    # Сообщение и альбом в один чат: сначала текст, затем графики
+    async def send_report(self, chat_id, text=None, photos=()):
+        if text:
+            await self.send_message(chat_id, text)
+        if photos:
+            await self.send_media_group(chat_id, photos)
+
+    async def _fan_out(self, chats, text, photos):
+        return await asyncio.gather(*(self.send_report(chat, text, photos) for chat in chats), return_exceptions=True)
+
+    # Отправка одного и того же текста и альбома во все чаты параллельно. Ошибка в одном чате не мешает
+    # остальным: она пишется в лог, а в конце поднимается первая из них. Возвращает сводку задержек.
+    # Все отправки объекта идут через один цикл событий, поэтому соединения пула и лимиты сохраняются
+    def deliver(self, chats, text=None, photos=()):
+        chats = chat_ids(chats)
+        if not chats or (not text and not photos):
+            return self.stats()
+        photos = [photo.getvalue() if hasattr(photo, 'getvalue') else photo for photo in photos]
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        results = self._loop.run_until_complete(self._fan_out(chats, text, photos))
+        errors = [result for result in results if isinstance(result, Exception)]
+        for chat, result in zip(chats, results):
+            if isinstance(result, Exception):
+                log.error('delivery to %s failed: %s', chat, result)
+        stats = self.stats()
+        log.info('telegram delivery: %s', stats)
+        if errors:
+            raise errors[0]
+        return stats
+
+    # Закрывает пул соединений и цикл событий
+    def close(self):
+        if self._loop is None or self._loop.is_closed():
+            return
+        if self._client is not None:
+            self._loop.run_until_complete(self._client.aclose())
+            self._client = None
+        self._loop.close()
+
+    # Задержки по методам за последние calls_history вызовов: число вызовов, повторы, p50 / p95 / max (секунды)
+    def stats(self):
+        summary = {}
+        for method in sorted({call['method'] for call in self.calls}):
+            latencies = sorted(call['latency_s'] for call in self.calls if call['method'] == method)
+            calls = [call for call in self.calls if call['method'] == method]
+            summary[method] = {'calls': len(calls),
+                               'failed': sum(not call['ok'] for call in calls),
+                               'retries': sum(call['attempts'] - 1 for call in calls),
+                               'p50_s': round(latencies[len(latencies) // 2], 3),
+                               'p95_s': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                               'max_s': round(latencies[-1], 3)}
+        return summary
+
+
+# Синхронная обертка для тасков с одной отправкой: deliver(os.environ.get('CHAT_ID'), text, [plot_object])
+def deliver(chats, text=None, photos=(), token=None):
+    delivery = TelegramDelivery(token)
+    try:
+        return delivery.deliver(chats, text, photos)
+    finally:
+        delivery.close()
@@ -0,0 +1,66 @@
+# XCom backend, который передает DataFrame-ы между тасками через файлы Arrow вместо pickle в метабазе.
+# Подключение: AIRFLOW__CORE__XCOM_BACKEND=common.xcom_backend.ArrowXComBackend
+# и общий для воркеров каталог XCOM_ARROW_DIR. Остальные значения XCom хранятся как обычно
+import logging
+import time
+
+import pandas as pd
+from airflow.models.xcom import BaseXCom
+
+from common import instrumentation
+from common.frame_store import frame_path, read_frame, remove_frame, write_frame
+
+
+log = logging.getLogger(__name__)
+
+# Ключ, по которому в XCom лежит ссылка на файл вместо самого DataFrame
+frame_ref_key = '__arrow_frame__'
+
+
+def _frame_ref(value):
+    if isinstance(value, dict) and frame_ref_key in value:
+        return value[frame_ref_key]
+    return None
+
+
+class ArrowXComBackend(BaseXCom):
+
+    @staticmethod
+    def serialize_value(value, *, key=None, task_id=None, dag_id=None, run_id=None, map_index=None, **kwargs):
+        if isinstance(value, pd.DataFrame):
+            path = frame_path(dag_id, run_id, task_id, map_index if map_index not in (None, -1) else None, key)
+            start = time.perf_counter()
+            size = write_frame(value, path)
+            log.info('XCom %s.%s: %s rows, %.1f MB in memory -> %.1f MB arrow file %s in %.3f s',
+                     task_id, key, len(value), value.memory_usage(deep=True).sum() / 2**20,
+                     size / 2**20, path, time.perf_counter() - start)
+            instrumentation.report_xcom(dag_id, task_id, size)
+            value = {frame_ref_key: path}
+        return BaseXCom.serialize_value(value)
+
+    @staticmethod
+    def deserialize_value(result):
+        value = BaseXCom.deserialize_value(result)
+        path = _frame_ref(value)
+        if path is None:
+            return value
+        start = time.perf_counter()
+        df = read_frame(path)
+        log.info('XCom %s.%s: mapped %s rows from %s in %.3f s',
+                 result.task_id, result.key, len(df), path, time.perf_counter() - start)
+        return df
+
+    # В UI показывается путь к файлу, а не содержимое DataFrame
+    def orm_deserialize_value(self):
+        value = super().orm_deserialize_value()
+        path = _frame_ref(value)
+        if path is None:
+            return value
+        return 'DataFrame: {}'.format(path)
+
+    # Вызывается Airflow при очистке XCom таска - удаляем файл вместе со ссылкой
+    @classmethod
+    def purge(cls, xcom, session=None):
+        path = _frame_ref(BaseXCom.deserialize_value(xcom))
+        if path is not None:
+            remove_frame(path)
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.anomaly import IncrementalAnomalyState, batch_check_anomaly, chack_anomaly, state_window
+from common.backtest import iqr_detector
+
+
+def series(length=60, seed=0):
+    values = np.random.default_rng(seed).poisson(100, length).astype(float)
+    values[np.random.default_rng(seed + 1).random(length) < 0.1] *= 3
+    return values
+
+
+def frame(values):
+    ts = pd.date_range('2023-03-23', periods=len(values), freq='15min')
+    return pd.DataFrame({'ts': ts, 'date': ts.normalize(), 'hm': ts.strftime('%H:%M'), 'm': values})
+
+
+@pytest.mark.parametrize('n', [3, 4, 5, 6])
+def test_state_window(n):
+    assert state_window(n) == n + n // 2 + 1
+    # Точки раньше окна не влияют на решение по последней точке
+    values = series()
+    noisy = values.copy()
+    noisy[:-state_window(n)] = 0
+    assert chack_anomaly(frame(values), 'm', n=n)[0] == chack_anomaly(frame(noisy), 'm', n=n)[0]
+
+
+@pytest.mark.parametrize('a, n', [(3, 5), (1.5, 4), (2, 3)])
+def test_detectors_agree(a, n):
+    values = series()
+    data = frame(values)
+    flags = iqr_detector(values[None, :], a=a, n=n)[0]
+    state = IncrementalAnomalyState(data.iloc[:n], ['m'], a=a, n=n)
+    alerts = 0
+    for end in range(n + 1, len(values) + 1):
+        expected, expected_df = chack_anomaly(data.iloc[:end].copy(), 'm', a=a, n=n)
+        full = batch_check_anomaly(values[None, :end], a=a, n=n)
+        last = batch_check_anomaly(values[None, :end], a=a, n=n, last_only=True)
+        state.merge(data.iloc[:end])
+        assert int(full['is_alert'][0]) == expected
+        assert int(last['is_alert'][0]) == expected
+        assert state.check()['m'][0] == expected
+        assert bool(flags[end - 1]) == bool(expected)
+        np.testing.assert_allclose(full['up'][0], expected_df['up'])
+        np.testing.assert_allclose(full['low'][0], expected_df['low'])
+        alerts += expected
+    assert alerts > 0
+
+
+def test_merge_overwrites_late_buckets():
+    data = frame(series(20))
+    state = IncrementalAnomalyState(data.iloc[:10], ['m'])
+    late = data.iloc[8:12].copy()
+    late['m'] += 1
+    assert state.merge(late) == 2
+    assert len(state.frame) == state_window(5)
+    assert state.last_ts == data['ts'].iloc[11]
+    assert state.frame['m'].iloc[-4:].tolist() == late['m'].tolist()
+
+
+def test_state_roundtrip():
+    state = IncrementalAnomalyState(frame(series(20)), ['m'], a=2, n=4)
+    restored = IncrementalAnomalyState.from_dict(state.to_dict())
+    assert restored.is_compatible(['m'], 2, 4)
+    pd.testing.assert_frame_equal(restored.frame, state.frame, check_dtype=False)
+    assert restored.check()['m'][0] == state.check()['m'][0]
+
+
+def test_state_from_incompatible_dict():
+    assert IncrementalAnomalyState.from_dict(None) is None
+    assert IncrementalAnomalyState.from_dict({'version': IncrementalAnomalyState.version + 1}) is None
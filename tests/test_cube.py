@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+from common.cube import (build_cube, build_cube_from_segments, format_report, join_per_user, partial_cube,
+                         report_columns, report_measures, rollup_cube)
+
+
+dimensions = ['gender', 'os', 'age']
+
+
+def per_user(users=300, seed=0):
+    rng = np.random.default_rng(seed)
+    base = pd.DataFrame({'user_id': np.arange(users),
+                         'gender': rng.integers(0, 2, users),
+                         'os': rng.choice(['iOS', 'Android'], users),
+                         'age': rng.integers(14, 60, users),
+                         'event_date': pd.Timestamp('2023-03-20')})
+    feed = base.sample(frac=0.8, random_state=seed).assign(views=lambda df: rng.integers(0, 50, len(df)),
+                                                           likes=lambda df: rng.integers(0, 10, len(df)))
+    mess = base.sample(frac=0.4, random_state=seed + 1).assign(
+        messages_sent=lambda df: rng.integers(0, 5, len(df)), users_sent=lambda df: rng.integers(0, 3, len(df)),
+        messages_received=lambda df: rng.integers(0, 5, len(df)), users_received=lambda df: rng.integers(0, 3, len(df)),
+        reciever_id=lambda df: df['user_id'])
+    return feed.reset_index(drop=True), mess.reset_index(drop=True)
+
+
+# Исходные transform_gender / transform_os / transform_age + join_transforms из daily_cohort_report.py
+def original_report(merged_data):
+    reports = []
+    for dimension in dimensions:
+        others = [column for column in dimensions if column != dimension]
+        report = merged_data.drop(columns=others + ['user_id', 'reciever_id']) \
+            .groupby([dimension, 'event_date'], as_index=False) \
+            .sum() \
+            .rename(columns={dimension: 'dimension_value'})
+        report.insert(0, 'dimension', dimension)
+        reports.append(report)
+    concat_reports = pd.concat(reports, axis=0)
+    concat_reports[report_measures] = concat_reports[report_measures].astype(int)
+    return concat_reports[report_columns]
+
+
+def normalized(report):
+    report = report.astype({'dimension_value': str, **{measure: 'int64' for measure in report_measures}})
+    return report.sort_values(['dimension', 'dimension_value']).reset_index(drop=True)
+
+
+def test_build_cube_matches_original_transforms():
+    feed, mess = per_user()
+    merged = feed.merge(mess, how='outer', on=['user_id'] + dimensions + ['event_date'])
+    expected = normalized(original_report(merged))
+    cube = normalized(format_report(build_cube(join_per_user(feed, mess.drop(columns='reciever_id'), dimensions),
+                                               dimensions)))
+    pd.testing.assert_frame_equal(cube, expected)
+
+
+def test_partial_rollup_and_segments_match_build_cube():
+    feed, mess = per_user(seed=1)
+    mess = mess.drop(columns='reciever_id')
+    merged = join_per_user(feed, mess, dimensions)
+    expected = normalized(format_report(build_cube(merged, dimensions)))
+    rolled = format_report(rollup_cube(partial_cube(merged, dimensions), dimensions))
+    segments = partial_cube(feed, dimensions, ['views', 'likes'])
+    from_segments = format_report(build_cube_from_segments(segments, mess, dimensions))
+    pd.testing.assert_frame_equal(normalized(rolled), expected)
+    pd.testing.assert_frame_equal(normalized(from_segments), expected)
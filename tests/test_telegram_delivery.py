@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from common import telegram_delivery
+from common.telegram_delivery import TokenBucket, chat_ids
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(telegram_delivery.time, 'monotonic', clock)
+    return clock
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2.0, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=1.0, burst=2)
+    bucket.reserve()
+    bucket.reserve()
+    clock.now += 10
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_token_bucket_acquire_waits(clock, monkeypatch):
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(telegram_delivery.asyncio, 'sleep', sleep)
+    async def acquire_twice(bucket):
+        return [await bucket.acquire(), await bucket.acquire()]
+
+    waits = asyncio.run(acquire_twice(TokenBucket(rate=4.0, burst=1)))
+    assert waits == [0.0, pytest.approx(0.25)]
+    assert slept == [pytest.approx(0.25)]
+
+
+def test_chat_ids():
+    assert chat_ids(None) == []
+    assert chat_ids(' 1, 2 ,,3') == ['1', '2', '3']
+    assert chat_ids([1, ' 2 ', '']) == ['1', '2']